@@ -0,0 +1,229 @@
+# api/admission.py
+"""
+Admission control cho /generate_answer: khi quá tải, từ chối nhanh (429/503 kèm Retry-After)
+thay vì nhận mọi request rồi để tất cả cùng chậm.
+
+  - giới hạn số request đang xử lý trên worker và số request đồng thời của mỗi user,
+  - giới hạn độ sâu hàng đợi của stage inference (lời gọi model encode/rerank) và hàng đợi LLM,
+  - CoDel: nếu thời gian chờ trong hàng đợi liên tục vượt `target` suốt `interval`
+    (hàng đợi "đứng" chứ không phải burst ngắn), bắt đầu từ chối request mới với nhịp tăng dần.
+"""
+
+import os
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+from api.llm_gateway import FairSemaphore, gateway
+from core import metrics
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") != "0"
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "64"))
+ADMISSION_MAX_PER_USER = int(os.getenv("ADMISSION_MAX_PER_USER", "2"))
+# Số request được chạy stage inference cùng lúc, và số request tối đa được xếp hàng chờ stage này + LLM
+INFERENCE_MAX_CONCURRENCY = int(os.getenv("INFERENCE_MAX_CONCURRENCY", "4"))
+ADMISSION_MAX_QUEUE_DEPTH = int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH", "32"))
+# Request đã được nhận nhưng chờ stage inference quá lâu thì bỏ (trả lời "hệ thống bận" trong stream)
+INFERENCE_MAX_QUEUE_WAIT = float(os.getenv("INFERENCE_MAX_QUEUE_WAIT_MS", "5000")) / 1000
+CODEL_TARGET = float(os.getenv("CODEL_TARGET_MS", "200")) / 1000
+CODEL_INTERVAL = float(os.getenv("CODEL_INTERVAL_MS", "1000")) / 1000
+RETRY_AFTER_MAX = 30
+
+
+class Rejected(Exception):
+    """Request bị từ chối ở cửa vào; endpoint trả về `status` kèm header Retry-After."""
+
+    def __init__(self, status: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Overloaded(Exception):
+    """Request đã được nhận nhưng chờ stage inference quá `INFERENCE_MAX_QUEUE_WAIT`."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("inference queue timeout")
+        self.retry_after = retry_after
+
+
+class CoDel:
+    """
+    Controlled Delay (Nichols & Jacobson) áp dụng ở mức request. `observe()` nhận thời gian chờ
+    (sojourn) mỗi khi một request ra khỏi hàng đợi; `should_shed()` được gọi khi có request mới.
+    Khi ở trạng thái dropping, request mới bị từ chối tại các thời điểm cách nhau interval/sqrt(count),
+    tức tỉ lệ từ chối tăng dần cho tới khi thời gian chờ trở lại dưới target.
+    """
+
+    def __init__(self, target: float = CODEL_TARGET, interval: float = CODEL_INTERVAL):
+        self.target = target
+        self.interval = interval
+        self.dropping = False
+        self._first_above = None
+        self._drop_next = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, sojourn: float, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if sojourn < self.target:
+                self._first_above = None
+                self._set_dropping(False)
+            elif self._first_above is None:
+                self._first_above = now + self.interval
+            elif now >= self._first_above and not self.dropping:
+                self._set_dropping(True)
+                # Như CoDel gốc: vừa thoát trạng thái dropping gần đây thì tiếp tục với nhịp cũ
+                recently = now - self._drop_next < 16 * self.interval
+                self._count = self._count - 2 if recently and self._count > 2 else 1
+                self._drop_next = now
+
+    def should_shed(self, queue_empty: bool, now: float | None = None) -> bool:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if not self.dropping:
+                return False
+            if queue_empty:
+                # Hàng đợi đã rút hết: không còn tắc nghẽn để kiểm soát
+                self._first_above = None
+                self._set_dropping(False)
+                return False
+            if now < self._drop_next:
+                return False
+            self._count += 1
+            self._drop_next = now + self.interval / math.sqrt(self._count)
+            return True
+
+    def _set_dropping(self, dropping: bool):
+        if dropping != self.dropping:
+            self.dropping = dropping
+            metrics.set_gauge("admission_codel_dropping", int(dropping))
+
+
+class AdmissionTicket:
+    """Suất xử lý của một request đã được nhận; `release()` khi stream kết thúc (gọi nhiều lần cũng được)."""
+
+    __slots__ = ("controller", "username", "started", "released")
+
+    def __init__(self, controller, username):
+        self.controller = controller
+        self.username = username
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        self.controller._release(self)
+
+    def __del__(self):
+        # Stream không bao giờ được chạy (client ngắt kết nối trước khi Starlette gửi body)
+        if not self.released:
+            self.release()
+
+
+class AdmissionController:
+    def __init__(self, enabled: bool = ADMISSION_ENABLED, max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+                 max_per_user: int = ADMISSION_MAX_PER_USER, max_queue_depth: int = ADMISSION_MAX_QUEUE_DEPTH,
+                 inference_concurrency: int = INFERENCE_MAX_CONCURRENCY,
+                 inference_max_wait: float = INFERENCE_MAX_QUEUE_WAIT, codel: CoDel | None = None):
+        self.enabled = enabled
+        self.max_in_flight = max_in_flight
+        self.max_per_user = max_per_user
+        self.max_queue_depth = max_queue_depth
+        self.inference_max_wait = inference_max_wait
+        self.codel = codel or CoDel()
+        self._inference = FairSemaphore(inference_concurrency)
+        self._in_flight = 0
+        self._per_user = {}
+        # Thời gian xử lý trung bình (EWMA) của một request, dùng để ước lượng Retry-After
+        self._avg_request_seconds = 2.0
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._inference.queue_depth + gateway.queue_depth
+
+    def _retry_after(self, backlog: int) -> int:
+        concurrency = max(1, self._inference.limit)
+        seconds = self._avg_request_seconds * max(1, backlog) / concurrency
+        return int(min(RETRY_AFTER_MAX, max(1, math.ceil(seconds))))
+
+    def _reject(self, status, reason, backlog):
+        metrics.inc("admission_rejected_total")
+        metrics.inc(f"admission_rejected_{reason}_total")
+        raise Rejected(status, reason, self._retry_after(backlog))
+
+    def admit(self, username: str) -> AdmissionTicket | None:
+        """
+        Nhận request hoặc raise Rejected (429 khi user vượt giới hạn, 503 khi worker quá tải).
+        Trả về None khi admission control bị tắt.
+        """
+        if not self.enabled:
+            return None
+        depth = self.queue_depth
+        with self._lock:
+            if self._per_user.get(username, 0) >= self.max_per_user:
+                self._reject(429, "per_user", 1)
+            if self._in_flight >= self.max_in_flight:
+                self._reject(503, "in_flight", self._in_flight)
+            if depth >= self.max_queue_depth:
+                self._reject(503, "queue_depth", depth)
+            if self.codel.should_shed(queue_empty=depth == 0):
+                self._reject(503, "queue_delay", depth)
+            ticket = AdmissionTicket(self, username)
+            self._in_flight += 1
+            self._per_user[username] = self._per_user.get(username, 0) + 1
+            metrics.set_gauge("admission_in_flight", self._in_flight)
+        metrics.inc("admission_admitted_total")
+        return ticket
+
+    def _release(self, ticket: AdmissionTicket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self._in_flight -= 1
+            remaining = self._per_user.get(ticket.username, 1) - 1
+            if remaining > 0:
+                self._per_user[ticket.username] = remaining
+            else:
+                self._per_user.pop(ticket.username, None)
+            elapsed = time.monotonic() - ticket.started
+            self._avg_request_seconds = 0.9 * self._avg_request_seconds + 0.1 * elapsed
+            metrics.set_gauge("admission_in_flight", self._in_flight)
+
+    def track(self, ticket: AdmissionTicket | None, generator):
+        """Bọc generator SSE để trả suất xử lý khi stream kết thúc, lỗi hoặc bị hủy."""
+        try:
+            yield from generator
+        finally:
+            if ticket is not None:
+                ticket.release()
+
+    @contextmanager
+    def inference_slot(self, should_cancel=None):
+        """Giới hạn số request chạy stage inference cùng lúc; thời gian chờ được đưa vào CoDel."""
+        if not self.enabled:
+            yield
+            return
+        queued_at = time.monotonic()
+        metrics.set_gauge("inference_queue_depth", self._inference.queue_depth + 1)
+        acquired = self._inference.acquire(should_cancel, timeout=self.inference_max_wait)
+        waited = time.monotonic() - queued_at
+        metrics.set_gauge("inference_queue_depth", self._inference.queue_depth)
+        metrics.inc("inference_queue_wait_seconds_total", waited)
+        self.codel.observe(waited)
+        if not acquired:
+            metrics.inc("admission_shed_in_queue_total")
+            raise Overloaded(self._retry_after(self._inference.queue_depth))
+        try:
+            yield
+        finally:
+            self._inference.release()
+
+
+admission = AdmissionController()
+if admission.enabled:
+    gateway.queue_wait_listeners.append(admission.codel.observe)
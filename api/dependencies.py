@@ -1,6 +1,12 @@
 # api/dependencies.py
 from retriever.retrieval_system import RetrievalSystem
+from api.intent_classifier import build_intent_classifier, SEED_EXAMPLES
+from api.admission import admission
+from core.storage import get_chat_store
+from fastapi import Header, HTTPException
 import os
+import secrets
+import logging
 
 # Đường dẫn có thể được load từ file config
 PROCESSED_DATA_DIR = "data/processed_data_chunks" 
@@ -13,6 +19,27 @@ retriever = RetrievalSystem(
     embedding_model_path=EMBEDDING_MODEL_PATH,
     reranker_model_path=RERANKER_MODEL_PATH
 )
+# Admission control chỉ giữ suất inference trong lúc encode/rerank thật sự chạy
+retriever.inference_slot = admission.inference_slot
+
+# Bổ sung câu hội thoại vào mô hình ngôn ngữ của QueryNormalizer (corpus luật thiếu các câu như "chào bạn")
+retriever.query_normalizer.add_texts([text for examples in SEED_EXAMPLES.values() for text in examples], weight=20)
+
+# Bộ phân loại ý định cục bộ, huấn luyện từ tập seed + các nhãn trong bảng `intent_labels`
+try:
+    intent_classifier = build_intent_classifier(retriever.encode_batch, get_chat_store())
+except Exception as e:
+    logging.error(f"Không khởi tạo được intent classifier, mọi câu hỏi sẽ đi qua Gemini: {e}")
+    intent_classifier = None
 
 def get_retriever():
-    return retriever
\ No newline at end of file
+    return retriever
+
+def get_intent_classifier():
+    return intent_classifier
+
+def require_admin(x_admin_key: str | None = Header(default=None)):
+    """Bảo vệ các endpoint quản trị bằng header X-Admin-Key (so với biến môi trường ADMIN_API_KEY)."""
+    admin_key = os.getenv("ADMIN_API_KEY")
+    if not admin_key or not x_admin_key or not secrets.compare_digest(x_admin_key, admin_key):
+        raise HTTPException(status_code=403, detail="Forbidden")
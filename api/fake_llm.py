@@ -0,0 +1,70 @@
+# api/fake_llm.py
+import os
+import re
+import json
+import time
+import random
+import threading
+
+
+class FakeResourceExhausted(Exception):
+    """Giả lập lỗi 429 của Gemini (google.api_core.exceptions.ResourceExhausted)."""
+    code = 429
+
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """
+    LLM giả lập chạy local, cùng giao diện `generate_content` với genai.GenerativeModel.
+    Dùng để chạy thử gateway và load test mà không tốn quota Gemini.
+
+    Cấu hình qua biến môi trường khi chạy API với LLM_BACKEND=fake:
+      FAKE_LLM_LATENCY_MS  độ trễ trước token đầu tiên
+      FAKE_LLM_TOKEN_MS    độ trễ giữa các token khi stream
+      FAKE_LLM_429_RATE    tỉ lệ request bị trả về 429
+    """
+
+    def __init__(self, model_name, latency_ms=None, token_ms=None, rate_limit_rate=None, seed=None):
+        self.model_name = model_name
+        self.latency_ms = float(os.getenv("FAKE_LLM_LATENCY_MS", "300")) if latency_ms is None else latency_ms
+        self.token_ms = float(os.getenv("FAKE_LLM_TOKEN_MS", "20")) if token_ms is None else token_ms
+        self.rate_limit_rate = float(os.getenv("FAKE_LLM_429_RATE", "0")) if rate_limit_rate is None else rate_limit_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _answer(self, prompt: str) -> str:
+        if "corrected_query" in prompt:
+            query = re.findall(r'Câu gốc: "(.*)"', prompt)[-1]
+            return json.dumps({"corrected_query": query, "intent": "Legal Question",
+                               "is_rag_required": True}, ensure_ascii=False)
+        if "Câu hỏi độc lập:" in prompt:
+            return re.findall(r"Câu hỏi cuối cùng: (.*)", prompt)[-1]
+        if prompt.rstrip().endswith("Tiêu đề:"):
+            return "Hỏi đáp pháp luật"
+        return ("Theo quy định hiện hành, người lao động được hưởng quyền lợi tương ứng với "
+                "thời gian làm việc và các điều kiện trong hợp đồng lao động [Nguồn 1].")
+
+    def _before_call(self):
+        with self._lock:
+            self.calls += 1
+            limited = self._rng.random() < self.rate_limit_rate
+        time.sleep(self.latency_ms / 1000)
+        if limited:
+            raise FakeResourceExhausted("429 Resource has been exhausted (fake)")
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        self._before_call()
+        text = self._answer(prompt)
+        if not stream:
+            return _FakeResponse(text)
+        return self._stream(text)
+
+    def _stream(self, text):
+        for word in re.findall(r"\S+\s*", text):
+            time.sleep(self.token_ms / 1000)
+            yield _FakeResponse(word)
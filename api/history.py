@@ -0,0 +1,85 @@
+# api/history.py
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+
+from api.schemas import ChatMessage, QueryRequest
+from core import metrics
+from core.storage import ChatStore
+
+# Số tin nhắn gần nhất đưa vào prompt (viết lại câu hỏi, sinh câu trả lời)
+CHAT_HISTORY_WINDOW = int(os.getenv("CHAT_HISTORY_WINDOW", "10"))
+# Cache cửa sổ lịch sử theo conversation_id. Khi chạy nhiều replica dùng chung DB, đặt TTL ngắn
+# (hoặc 0 để tắt) vì replica khác có thể đã ghi thêm tin nhắn vào cùng cuộc trò chuyện.
+CHAT_HISTORY_CACHE_TTL = float(os.getenv("CHAT_HISTORY_CACHE_TTL", "600"))
+CHAT_HISTORY_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_HISTORY_CACHE_MAX_ENTRIES", "5000"))
+
+
+class ConversationHistoryCache:
+    """
+    Giữ `window` tin nhắn gần nhất của mỗi cuộc trò chuyện để request chỉ cần gửi tin nhắn mới.
+    Nạp từ store khi chưa có, được cập nhật (write-through) mỗi khi API ghi tin nhắn mới.
+    Loại bỏ theo TTL tính từ lần nạp từ store và theo LRU khi vượt giới hạn.
+    """
+
+    def __init__(self, window: int = CHAT_HISTORY_WINDOW, ttl: float = CHAT_HISTORY_CACHE_TTL,
+                 max_entries: int = CHAT_HISTORY_CACHE_MAX_ENTRIES):
+        self.window = window
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # conversation_id -> (thời điểm nạp, deque[(role, content)])
+        self._lock = threading.Lock()
+
+    def get(self, store: ChatStore, conversation_id: str) -> list[tuple[str, str]]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._entries.move_to_end(conversation_id)
+                metrics.inc("chat_history_cache_hits_total")
+                return list(entry[1])
+        metrics.inc("chat_history_cache_misses_total")
+        messages = store.get_recent_messages(conversation_id, self.window)
+        window = deque(((m["role"], m["content"]) for m in messages), maxlen=self.window)
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[conversation_id] = (now, window)
+                self._entries.move_to_end(conversation_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                metrics.set_gauge("chat_history_cache_entries", len(self._entries))
+        return list(window)
+
+    def append(self, conversation_id: str, role: str, content: str):
+        """Gọi sau khi tin nhắn đã được ghi vào store; chỉ cập nhật nếu cuộc trò chuyện đang được cache."""
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is not None:
+                entry[1].append((role, content))
+
+    def discard(self, conversation_id: str):
+        with self._lock:
+            self._entries.pop(conversation_id, None)
+            metrics.set_gauge("chat_history_cache_entries", len(self._entries))
+
+
+history_cache = ConversationHistoryCache()
+
+
+def resolve_chat_history(request: QueryRequest, store: ChatStore) -> list[ChatMessage]:
+    """
+    Lịch sử dùng cho request, kết thúc bằng câu hỏi hiện tại của người dùng:
+      - chế độ `message`: cửa sổ lịch sử lấy từ server (cache/store) + tin nhắn mới,
+      - chế độ cũ `chat_history`: dùng lịch sử client gửi lên.
+    Quyền sở hữu `conversation_id` phải được kiểm tra trước (xem /generate_answer trong api/main.py).
+    """
+    if request.message is None:
+        metrics.inc("chat_history_client_requests_total")
+        return list(request.chat_history)
+    metrics.inc("chat_history_server_requests_total")
+    history = []
+    if request.conversation_id is not None:
+        history = [ChatMessage(role=role, content=content)
+                   for role, content in history_cache.get(store, request.conversation_id)]
+    return history + [ChatMessage(role="user", content=request.message)]
@@ -0,0 +1,160 @@
+# api/intent_classifier.py
+import os
+import logging
+import numpy as np
+
+from core import metrics
+
+INTENT_CONFIDENCE_THRESHOLD = float(os.getenv("INTENT_CONFIDENCE_THRESHOLD", "0.85"))
+
+# Nguồn gốc của nhãn trong bảng `intent_labels`. Chỉ học từ nhãn do Gemini quyết định hoặc do người
+# gán; nhãn do chính bộ phân loại dự đoán thì không bao giờ được ghi lại, tránh tự củng cố lỗi của nó.
+LABEL_SOURCE_LLM = "llm"
+LABEL_SOURCE_HUMAN = "human"
+TRAINING_LABEL_SOURCES = (LABEL_SOURCE_LLM, LABEL_SOURCE_HUMAN)
+
+# Tập dữ liệu gán nhãn ban đầu (người gán), được bổ sung thêm bằng các nhãn trong bảng `intent_labels`
+SEED_EXAMPLES = {
+    "Legal Question": [
+        "Công ty nợ lương 2 tháng thì phải làm sao?",
+        "Được nghỉ bao nhiêu ngày phép 1 năm?",
+        "Thủ tục ly hôn đơn phương như thế nào?",
+        "Không đội mũ bảo hiểm bị phạt bao nhiêu tiền?",
+        "Người lao động đơn phương chấm dứt hợp đồng cần báo trước bao lâu?",
+        "Điều kiện để được hưởng bảo hiểm thất nghiệp là gì?",
+        "Thời hạn sử dụng đất nông nghiệp là bao lâu?",
+        "Vượt đèn đỏ bị xử phạt như thế nào?",
+        "Thành lập công ty trách nhiệm hữu hạn cần những giấy tờ gì?",
+        "Hàng xóm lấn chiếm đất thì tôi phải khởi kiện ở đâu?",
+        "Tuổi nghỉ hưu của lao động nữ hiện nay là bao nhiêu?",
+        "Chồng tôi vay nợ riêng thì tôi có phải trả không?",
+        "Mức đóng bảo hiểm xã hội bắt buộc là bao nhiêu phần trăm?",
+        "Làm thêm giờ vào ngày lễ được trả lương thế nào?",
+        "Thuế thu nhập cá nhân được tính như thế nào?",
+        "Điều 113 Bộ luật Lao động quy định gì?",
+        "Tôi bị công ty sa thải khi đang mang thai có đúng luật không?",
+        "Quy định về thừa kế khi không có di chúc?",
+    ],
+    "Greeting": [
+        "Chào bạn", "Xin chào", "Hello", "Hi bot", "Chào buổi sáng",
+        "Alo, có ai ở đó không?", "Chào trợ lý", "Hey",
+    ],
+    "Farewell": [
+        "Tạm biệt", "Bye", "Cảm ơn, tạm biệt nhé", "Hẹn gặp lại",
+        "Thôi mình đi đây", "Chào tạm biệt bạn", "Bai bai",
+    ],
+    "Help Request": [
+        "Bạn làm được gì?", "Bạn có thể giúp tôi những gì?", "Hướng dẫn sử dụng",
+        "Chức năng của bạn là gì?", "Tôi nên hỏi bạn như thế nào?",
+        "Bạn hỗ trợ những lĩnh vực nào?",
+    ],
+    "Other": [
+        "Hôm nay thời tiết thế nào?", "Kể cho tôi một câu chuyện cười",
+        "Bạn bao nhiêu tuổi?", "1 + 1 bằng mấy?", "Giá vàng hôm nay",
+        "Cảm ơn bạn", "Ok", "Bạn là ai?", "Viết giúp tôi một bài thơ",
+    ],
+}
+
+
+class IntentClassifier:
+    """
+    Bộ phân loại ý định nearest-centroid trên embedding e5 đã được load sẵn.
+    Việc dự đoán chỉ là một phép nhân ma trận nhỏ nên tốn cỡ micro giây.
+    """
+
+    def __init__(self, encode_fn, confidence_threshold=INTENT_CONFIDENCE_THRESHOLD, temperature=0.05):
+        # encode_fn: list[str] -> np.ndarray (n, dim)
+        self.encode_fn = encode_fn
+        self.confidence_threshold = confidence_threshold
+        self.temperature = temperature
+        self.labels = []
+        self.centroids = None
+        self.cv_accuracy = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self.centroids is not None
+
+    @staticmethod
+    def _normalize(matrix):
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+    @staticmethod
+    def _centroids(embeddings, y, n_labels):
+        centroids = np.zeros((n_labels, embeddings.shape[1]), dtype=np.float32)
+        for label_idx in range(n_labels):
+            members = embeddings[y == label_idx]
+            if len(members):
+                centroids[label_idx] = members.mean(axis=0)
+        return IntentClassifier._normalize(centroids)
+
+    def fit(self, texts: list[str], labels: list[str], n_folds: int = 5):
+        """Huấn luyện centroid cho từng nhãn và đo độ chính xác bằng cross-validation."""
+        self.labels = sorted(set(labels))
+        label_to_idx = {label: i for i, label in enumerate(self.labels)}
+        y = np.array([label_to_idx[label] for label in labels])
+        embeddings = self._normalize(np.asarray(self.encode_fn(texts), dtype=np.float32))
+
+        # K-fold cross-validation để báo cáo độ chính xác của bộ phân loại
+        order = np.random.default_rng(0).permutation(len(texts))
+        folds = np.array_split(order, min(n_folds, len(texts)))
+        correct = 0
+        for fold in folds:
+            train_mask = np.ones(len(texts), dtype=bool)
+            train_mask[fold] = False
+            fold_centroids = self._centroids(embeddings[train_mask], y[train_mask], len(self.labels))
+            predictions = np.argmax(embeddings[fold] @ fold_centroids.T, axis=1)
+            correct += int((predictions == y[fold]).sum())
+        self.cv_accuracy = correct / len(texts) if len(texts) else None
+
+        self.centroids = self._centroids(embeddings, y, len(self.labels))
+        if self.cv_accuracy is not None:
+            metrics.set_gauge("intent_classifier_cv_accuracy", round(self.cv_accuracy, 4))
+        metrics.set_gauge("intent_classifier_training_examples", len(texts))
+        return self
+
+    def predict(self, embedding) -> tuple[str, float]:
+        """Trả về (nhãn, độ tin cậy) từ embedding của câu hỏi."""
+        vector = self._normalize(np.asarray(embedding, dtype=np.float32))
+        sims = self.centroids @ vector
+        logits = (sims - sims.max()) / self.temperature
+        probs = np.exp(logits) / np.exp(logits).sum()
+        best = int(np.argmax(probs))
+        return self.labels[best], float(probs[best])
+
+
+def load_labelled_examples(store, limit: int = 5000) -> tuple[list, list, dict]:
+    """
+    Đọc các nhãn đã lưu trong bảng `intent_labels` (chỉ nguồn TRAINING_LABEL_SOURCES).
+    Trả về (texts, labels, số mẫu theo từng nguồn); nhãn lạ (không có trong SEED_EXAMPLES) bị bỏ qua.
+    """
+    texts, labels, counts = [], [], {}
+    for row in store.get_intent_labels(TRAINING_LABEL_SOURCES, limit):
+        if row["intent"] not in SEED_EXAMPLES:
+            continue
+        texts.append(row["text"])
+        labels.append(row["intent"])
+        counts[row["source"]] = counts.get(row["source"], 0) + 1
+    return texts, labels, counts
+
+
+def build_intent_classifier(encode_fn, store=None) -> IntentClassifier:
+    """Huấn luyện bộ phân loại từ tập seed cộng với các nhãn đã lưu (Gemini quyết định / người gán)."""
+    texts, labels = [], []
+    for label, examples in SEED_EXAMPLES.items():
+        texts.extend(examples)
+        labels.extend([label] * len(examples))
+
+    if store is not None:
+        try:
+            stored_texts, stored_labels, counts = load_labelled_examples(store)
+            texts.extend(stored_texts)
+            labels.extend(stored_labels)
+            logging.info(f"Intent classifier: thêm {len(stored_texts)} mẫu đã gán nhãn theo nguồn {counts}.")
+        except Exception as e:
+            logging.warning(f"Không đọc được nhãn ý định đã lưu để huấn luyện intent classifier: {e}")
+
+    classifier = IntentClassifier(encode_fn).fit(texts, labels)
+    logging.info(f"Intent classifier sẵn sàng: {len(texts)} mẫu, CV accuracy = {classifier.cv_accuracy:.3f}")
+    return classifier
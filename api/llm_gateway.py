@@ -0,0 +1,244 @@
+# api/llm_gateway.py
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+import google.generativeai as genai
+
+from api.fake_llm import FakeGenerativeModel
+from core import metrics
+from core.cancellation import Cancelled, check_cancelled
+from core.singleflight import SingleFlight
+
+DEFAULT_MODEL = 'gemini-1.5-flash-latest'
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "1000000"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+
+# Mã lỗi HTTP đáng để thử lại (429 quota, lỗi tạm thời phía server)
+RETRYABLE_CODES = {429, 500, 503, 504}
+
+try:
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+except Exception as e:
+    print(f"Lỗi cấu hình Gemini API: {e}")
+
+
+class FairSemaphore:
+    """Semaphore phục vụ theo thứ tự đến (FIFO), tránh để một số request bị bỏ đói."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._active = 0
+        self._waiters = deque()
+        self._cond = threading.Condition()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def acquire(self, should_cancel=None, timeout: float | None = None) -> bool:
+        """Chờ tới lượt. Trả về False nếu quá `timeout` giây (đã rời hàng đợi)."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            ticket = object()
+            self._waiters.append(ticket)
+            while self._waiters[0] is not ticket or self._active >= self.limit:
+                wait = 0.1 if should_cancel else None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._waiters.remove(ticket)
+                        self._cond.notify_all()
+                        return False
+                    wait = min(wait, remaining) if wait is not None else remaining
+                self._cond.wait(timeout=wait)
+                if should_cancel is not None and should_cancel():
+                    # Rời hàng đợi, nhường chỗ cho request phía sau
+                    self._waiters.remove(ticket)
+                    self._cond.notify_all()
+                    raise Cancelled()
+            self._waiters.popleft()
+            self._active += 1
+            self._cond.notify_all()
+            return True
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+
+class TokenBucket:
+    """Giới hạn số token (ước lượng) gửi lên model mỗi phút."""
+
+    def __init__(self, tokens_per_minute):
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens, should_cancel=None):
+        tokens = min(float(tokens), self.capacity)
+        while True:
+            check_cancelled(should_cancel)
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_seconds = (tokens - self._tokens) / self.rate
+            metrics.inc("llm_rate_limited_waits_total")
+            time.sleep(min(wait_seconds, 0.1) if should_cancel else wait_seconds)
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _is_retryable(error: Exception) -> bool:
+    code = getattr(error, 'code', None)
+    code = getattr(code, 'value', code)
+    return code in RETRYABLE_CODES or type(error).__name__ in {"ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded"}
+
+
+class LLMGateway:
+    """
+    Điểm gọi LLM duy nhất cho mọi nơi trong api/services.py:
+      - tái sử dụng client cho từng model,
+      - giới hạn số request đồng thời và token/phút cho mỗi model (hàng đợi FIFO),
+      - retry với exponential backoff + jitter khi gặp 429/5xx,
+      - gộp các prompt giống hệt nhau đang chạy (chỉ cho lời gọi không stream).
+    """
+
+    def __init__(self, backend="gemini", max_concurrency=LLM_MAX_CONCURRENCY,
+                 tokens_per_minute=LLM_TOKENS_PER_MINUTE, max_retries=LLM_MAX_RETRIES, base_delay=0.5):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self._models = {}
+        self._limits = {}
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight("llm")
+        # Hàm nhận thời gian chờ trong hàng đợi của mỗi lời gọi (admission control dùng để phát hiện quá tải)
+        self.queue_wait_listeners = []
+
+    @property
+    def queue_depth(self) -> int:
+        """Tổng số lời gọi đang chờ tới lượt trên mọi model."""
+        with self._lock:
+            return sum(semaphore.queue_depth for semaphore, _ in self._limits.values())
+
+    def _model(self, model_name):
+        with self._lock:
+            if model_name not in self._models:
+                if self.backend == "fake":
+                    self._models[model_name] = FakeGenerativeModel(model_name)
+                else:
+                    self._models[model_name] = genai.GenerativeModel(model_name)
+                self._limits[model_name] = (FairSemaphore(self.max_concurrency), TokenBucket(self.tokens_per_minute))
+            return self._models[model_name], self._limits[model_name]
+
+    def _backoff(self, attempt, should_cancel=None):
+        delay = random.uniform(0, self.base_delay * (2 ** attempt))  # full jitter
+        deadline = time.monotonic() + delay
+        while time.monotonic() < deadline:
+            check_cancelled(should_cancel)
+            time.sleep(min(0.1, max(0.0, deadline - time.monotonic())))
+
+    def _acquire(self, model_name, prompt, should_cancel=None):
+        check_cancelled(should_cancel)
+        model, (semaphore, bucket) = self._model(model_name)
+        bucket.acquire(estimate_tokens(prompt), should_cancel)
+        queued_at = time.perf_counter()
+        semaphore.acquire(should_cancel)
+        waited = time.perf_counter() - queued_at
+        metrics.set_gauge("llm_queue_depth", semaphore.queue_depth)
+        metrics.inc("llm_queue_wait_seconds_total", waited)
+        for listener in self.queue_wait_listeners:
+            listener(waited)
+        return model, semaphore
+
+    def generate(self, prompt: str, model_name: str = DEFAULT_MODEL, coalesce: bool = True, should_cancel=None) -> str:
+        """Gọi không stream, trả về text. Các prompt giống nhau đang chạy sẽ dùng chung một lời gọi."""
+        if coalesce:
+            return self._single_flight.do(
+                (model_name, prompt), lambda: self._generate(prompt, model_name, should_cancel), should_cancel=should_cancel
+            )
+        return self._generate(prompt, model_name, should_cancel)
+
+    def _generate(self, prompt, model_name, should_cancel=None):
+        for attempt in range(self.max_retries + 1):
+            model, semaphore = self._acquire(model_name, prompt, should_cancel)
+            try:
+                metrics.inc("llm_requests_total")
+                return model.generate_content(prompt).text
+            except Cancelled:
+                raise
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_retryable(e):
+                    metrics.inc("llm_errors_total")
+                    raise
+                metrics.inc("llm_retries_total")
+                logging.warning(f"LLM lỗi tạm thời ({e}), thử lại lần {attempt + 1}")
+            finally:
+                semaphore.release()
+            self._backoff(attempt, should_cancel)
+
+    def stream(self, prompt: str, model_name: str = DEFAULT_MODEL, should_cancel=None):
+        """
+        Gọi có stream, yield từng đoạn text. Chỉ retry nếu lỗi xảy ra trước khi
+        có đoạn text đầu tiên (sau đó thì không thể phát lại cho client).
+        Khi `should_cancel()` trả về True, đóng stream upstream và raise Cancelled.
+        """
+        for attempt in range(self.max_retries + 1):
+            model, semaphore = self._acquire(model_name, prompt, should_cancel)
+            started = False
+            output_chars = 0
+            upstream = None
+            try:
+                metrics.inc("llm_requests_total")
+                upstream = model.generate_content(prompt, stream=True)
+                for chunk in upstream:
+                    if should_cancel is not None and should_cancel():
+                        metrics.inc("llm_streams_cancelled_total")
+                        raise Cancelled()
+                    if chunk.text:
+                        started = True
+                        output_chars += len(chunk.text)
+                        yield chunk.text
+                # Thống kê token trung bình của một câu trả lời (để ước lượng phần tiết kiệm khi hủy)
+                metrics.inc("llm_stream_completed_total")
+                metrics.inc("llm_stream_output_tokens_total", max(1, output_chars // 4))
+                metrics.inc("llm_stream_prompt_tokens_total", estimate_tokens(prompt))
+                return
+            except Cancelled:
+                raise
+            except Exception as e:
+                if started or attempt >= self.max_retries or not _is_retryable(e):
+                    metrics.inc("llm_errors_total")
+                    raise
+                metrics.inc("llm_retries_total")
+                logging.warning(f"LLM stream lỗi tạm thời ({e}), thử lại lần {attempt + 1}")
+            finally:
+                close = getattr(upstream, 'close', None)
+                if close is not None:
+                    close()
+                semaphore.release()
+            self._backoff(attempt, should_cancel)
+
+
+# Singleton dùng chung cho cả worker
+gateway = LLMGateway(backend=os.getenv("LLM_BACKEND", "gemini"))
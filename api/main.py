@@ -3,70 +3,110 @@ import os
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(PROJECT_ROOT)
 
-import sqlite3
 import logging
-from fastapi import FastAPI, Depends
-from fastapi.responses import StreamingResponse, JSONResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, Request
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from dotenv import load_dotenv
 
 # Import từ các file đã tách ra
 from api import services, schemas
-from api.dependencies import get_retriever
-from core.database import (
-    get_db, get_user_id, get_user_conversations, get_conversation_messages,
-    delete_conversation, update_conversation_title, register_user_in_db, add_conversation
-)
+from api.admission import Rejected, admission
+from api.history import history_cache
+from api.dependencies import get_retriever, get_intent_classifier, require_admin
+from api.intent_classifier import IntentClassifier
+from api.streaming import stream_with_cancellation
+from core.cancellation import CancellationToken
+from core import metrics, profiling
+from core.storage import ChatStore, StorageError, get_chat_store
 from retriever.retrieval_system import RetrievalSystem
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI(title="Zalo Legal RAG API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Tạo/nâng cấp schema lịch sử chat và đánh chỉ mục tìm kiếm cho DB cũ trước khi nhận request
+    get_chat_store()
+    yield
+
+app = FastAPI(title="Zalo Legal RAG API", lifespan=lifespan)
         
 # --- API Endpoints ---
 @app.post("/generate_answer")
-def generate_answer(request: schemas.QueryRequest, retriever: RetrievalSystem = Depends(get_retriever)):
-    return StreamingResponse(services.stream_response_generator(request, retriever), media_type="text/event-stream")
+def generate_answer(request: schemas.QueryRequest, http_request: Request,
+                    retriever: RetrievalSystem = Depends(get_retriever),
+                    intent_classifier: IntentClassifier | None = Depends(get_intent_classifier),
+                    store: ChatStore = Depends(get_chat_store)):
+    # Chỉ chủ cuộc trò chuyện mới được đọc lịch sử và ghi thêm tin nhắn vào đó
+    if request.conversation_id is not None and not store.is_conversation_owner(request.username, request.conversation_id):
+        return JSONResponse(status_code=403, content={"error": "Forbidden or conversation not found"})
+    try:
+        ticket = admission.admit(request.username)
+    except Rejected as e:
+        # Từ chối nhanh khi quá tải thay vì nhận request rồi để mọi request cùng chậm
+        return JSONResponse(status_code=e.status, content={"error": "Server is overloaded", "reason": e.reason},
+                            headers={"Retry-After": str(e.retry_after)})
+    # Token hủy được đặt khi client đóng kết nối SSE, các bước retrieval/LLM sẽ dừng sớm
+    token = CancellationToken()
+    generator = admission.track(ticket, services.stream_response_generator(request, retriever, intent_classifier, token))
+    return StreamingResponse(stream_with_cancellation(http_request, generator, token), media_type="text/event-stream")
+
+@app.get("/metrics")
+def get_metrics():
+    """Các chỉ số vận hành của worker (tỉ lệ bỏ qua LLM, độ chính xác intent classifier, ...)."""
+    return metrics.snapshot()
 
 @app.get("/conversations/{username}")
-def get_conversations(username: str, conn: sqlite3.Connection = Depends(get_db)):
-    user_id = get_user_id(conn, username) # Truyền conn
-    if not user_id: return []
-    conversations = get_user_conversations(conn, user_id) # Truyền conn
+def get_conversations(username: str, store: ChatStore = Depends(get_chat_store)):
+    conversations = store.get_conversations_by_username(username)
     return [{"id": convo["id"], "title": convo["title"]} for convo in conversations]
 
+@app.get("/conversations/{username}/search")
+def search_conversations(username: str, q: str, limit: int = 20, store: ChatStore = Depends(get_chat_store)):
+    """Tìm trong tin nhắn và tiêu đề các cuộc trò chuyện của user (không phân biệt dấu), kèm snippet đã đánh dấu."""
+    if not 1 <= limit <= 100:
+        return JSONResponse(status_code=400, content={"error": "limit must be between 1 and 100"})
+    user_id = store.get_user_id(username)
+    if not user_id:
+        return JSONResponse(status_code=404, content={"error": "User not found"})
+    metrics.inc("conversation_search_total")
+    return store.search_conversations(user_id, q[:200], limit)
+
 @app.get("/messages/{conversation_id}")
-def get_messages(conversation_id: str, conn: sqlite3.Connection = Depends(get_db)):
-    return get_conversation_messages(conn, conversation_id) # Truyền conn
+def get_messages(conversation_id: str, store: ChatStore = Depends(get_chat_store)):
+    return store.get_conversation_messages(conversation_id)
 
 @app.post("/register")
-def register_user(request: schemas.RegisterRequest, conn: sqlite3.Connection = Depends(get_db)):
+def register_user(request: schemas.RegisterRequest, store: ChatStore = Depends(get_chat_store)):
     try:
-        # Gọi hàm mới đã sửa
-        register_user_in_db(conn, request.username, request.hashed_password)
+        store.register_user(request.username, request.hashed_password)
         logging.info(f"User '{request.username}' registered successfully in DB.")
         return {"message": "User registered successfully in DB"}
-    except sqlite3.Error as e: # Bắt lỗi cụ thể của sqlite
+    except StorageError as e: # Lỗi của backend lưu trữ (sqlite/postgres)
         logging.error(f"Failed to register user '{request.username}' in DB: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 @app.post("/conversations/delete")
-def delete_conversation_endpoint(request: schemas.DeleteConversationRequest, conn: sqlite3.Connection = Depends(get_db)):
-    user_id = get_user_id(conn, request.username) # Truyền conn
+def delete_conversation_endpoint(request: schemas.DeleteConversationRequest, store: ChatStore = Depends(get_chat_store),
+                                 retriever: RetrievalSystem = Depends(get_retriever)):
+    user_id = store.get_user_id(request.username)
     if not user_id:
         return JSONResponse(status_code=404, content={"error": "User not found"})
     
-    success = delete_conversation(conn, request.conversation_id, user_id) # Truyền conn
+    success = store.delete_conversation(request.conversation_id, user_id)
     
     if success:
+        retriever.conversation_cache.discard(request.conversation_id)
+        history_cache.discard(request.conversation_id)
         return JSONResponse(status_code=200, content={"message": "Conversation deleted successfully"})
     else:
         return JSONResponse(status_code=403, content={"error": "Forbidden or conversation not found"})
     
 @app.post("/conversations/update_title")
-def update_title_endpoint(request: schemas.UpdateTitleRequest, conn: sqlite3.Connection = Depends(get_db)):
+def update_title_endpoint(request: schemas.UpdateTitleRequest, store: ChatStore = Depends(get_chat_store)):
     """Cập nhật tiêu đề của một cuộc trò chuyện."""
-    user_id = get_user_id(conn, request.username)
+    user_id = store.get_user_id(request.username)
     if not user_id:
         return JSONResponse(status_code=404, content={"error": "User not found"})
     
@@ -74,10 +114,48 @@ def update_title_endpoint(request: schemas.UpdateTitleRequest, conn: sqlite3.Con
     if len(request.new_title) > 100:
         return JSONResponse(status_code=400, content={"error": "Title is too long"})
 
-    success = update_conversation_title(conn, request.conversation_id, user_id, request.new_title)
+    success = store.update_conversation_title(request.conversation_id, user_id, request.new_title)
     
     if success:
         return JSONResponse(status_code=200, content={"message": "Title updated successfully"})
     else:
         # Lỗi có thể do conversation_id không tồn tại hoặc không thuộc về user này
-        return JSONResponse(status_code=403, content={"error": "Forbidden or conversation not found"})
\ No newline at end of file
+        return JSONResponse(status_code=403, content={"error": "Forbidden or conversation not found"})
+
+# --- Admin: profiling worker đang chạy ---
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+def profile_worker(mode: str = "sample", seconds: float = 10.0, requests: int = 5, interval_ms: float = 5.0,
+                   memory: bool = True, format: str = "json"):
+    """
+    Lấy mẫu stack của worker trong `seconds` giây (mode=sample) hoặc của N request /generate_answer
+    kế tiếp (mode=requests, chờ tối đa `seconds`). `format=collapsed` trả về collapsed stack cho flamegraph.
+    """
+    try:
+        session = profiling.run_session(mode=mode, seconds=seconds, requests=requests,
+                                        interval_ms=interval_ms, trace_memory=memory)
+    except profiling.ProfilerBusy:
+        return JSONResponse(status_code=409, content={"error": "Another profiling session is running"})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    if format == "collapsed":
+        return PlainTextResponse(session.collapsed())
+    return session.to_dict()
+
+# --- Admin: cập nhật corpus tăng dần ---
+@app.post("/admin/documents", dependencies=[Depends(require_admin)])
+def upsert_document(request: schemas.UpsertDocumentRequest, retriever: RetrievalSystem = Depends(get_retriever)):
+    """Thêm mới hoặc thay thế toàn bộ chunk của một văn bản theo doc_id."""
+    if not request.chunks:
+        return JSONResponse(status_code=400, content={"error": "Document has no chunks"})
+    result = retriever.upsert_document(request.doc_id, [chunk.model_dump() for chunk in request.chunks])
+    logging.info(f"Upserted document '{request.doc_id}': {result}")
+    return result
+
+@app.delete("/admin/documents/{doc_id:path}", dependencies=[Depends(require_admin)])
+def delete_document(doc_id: str, retriever: RetrievalSystem = Depends(get_retriever)):
+    """Xóa một văn bản khỏi corpus theo doc_id."""
+    result = retriever.delete_document(doc_id)
+    if not result["removed_chunks"]:
+        return JSONResponse(status_code=404, content={"error": "Document not found"})
+    logging.info(f"Deleted document '{doc_id}': {result}")
+    return result
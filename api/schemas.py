@@ -1,17 +1,41 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, model_validator
+
+# Giới hạn kích thước request /generate_answer
+MAX_MESSAGE_CHARS = 8000
+MAX_CLIENT_HISTORY_MESSAGES = 50
 
 
 # --- Pydantic Models ---
 class ChatMessage(BaseModel):
     role: str
-    content: str
+    content: str = Field(max_length=MAX_MESSAGE_CHARS)
+
+class DocumentFilterRequest(BaseModel):
+    """Giới hạn phạm vi văn bản khi retrieval (OR trong một trường, AND giữa các trường)."""
+    doc_ids: list[str] | None = None
+    doc_types: list[str] | None = None   # luat, nghi_dinh, thong_tu, thong_tu_lien_tich, quyet_dinh, nghi_quyet, ...
+    years: list[int] | None = None
+    domains: list[str] | None = None     # lao_dong, giao_thong, dat_dai, ...
 
 class QueryRequest(BaseModel):
-    chat_history: list[ChatMessage]
-    conversation_id: str | None
+    """
+    Hai cách gửi câu hỏi:
+      - `message` (+ `conversation_id` nếu đã có): server tự nạp lịch sử gần nhất của cuộc trò chuyện,
+      - `chat_history`: client gửi cả lịch sử (dùng cho cuộc trò chuyện chưa được lưu trên server).
+    """
+    chat_history: list[ChatMessage] | None = Field(default=None, max_length=MAX_CLIENT_HISTORY_MESSAGES)
+    message: str | None = Field(default=None, min_length=1, max_length=MAX_MESSAGE_CHARS)
+    conversation_id: str | None = None
     username: str
     top_k_rerank: int = 5
     is_first_message: bool = False
+    filters: DocumentFilterRequest | None = None
+
+    @model_validator(mode="after")
+    def _check_mode(self):
+        if (self.message is None) == (not self.chat_history):
+            raise ValueError("Cần gửi đúng một trong hai: `message` hoặc `chat_history` (không rỗng)")
+        return self
 
 class RegisterRequest(BaseModel):
     username: str
@@ -28,4 +52,12 @@ class DeleteConversationRequest(BaseModel):
 class UpdateTitleRequest(BaseModel):
     username: str
     conversation_id: str
-    new_title: str
\ No newline at end of file
+    new_title: str
+
+class DocumentChunk(BaseModel):
+    chunk_id: str | None = None
+    text: str
+
+class UpsertDocumentRequest(BaseModel):
+    doc_id: str
+    chunks: list[DocumentChunk]
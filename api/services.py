@@ -1,22 +1,20 @@
 import json
-import os
 import logging
-import google.generativeai as genai
 import openai
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
-from api.schemas import QueryRequest 
-from core.database import (
-    get_db_connection, add_message, get_user_id, add_conversation
-)
+from api.admission import Overloaded
+from api.schemas import ChatMessage, QueryRequest
+from api.history import history_cache, resolve_chat_history
+from api.intent_classifier import LABEL_SOURCE_LLM, SEED_EXAMPLES, IntentClassifier
+from api.llm_gateway import gateway
+from core import metrics, profiling
+from core.cancellation import Cancelled, CancellationToken
+from core.storage import get_chat_store
 from retriever.retrieval_system import RetrievalSystem
 
 RERANKER_SCORE_THRESHOLD = 0.5
 
-try:
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-except Exception as e:
-    print(f"Lỗi cấu hình Gemini API: {e}")
-
 # try:
 #     client = openai.OpenAI()
 # except openai.OpenAIError as e:
@@ -28,6 +26,22 @@ GREETING_KEYWORDS = ["chào", "hello", "hi", "xin chào"]
 FAREWELL_KEYWORDS = ["tạm biệt", "bye", "bai bai"]
 HELP_KEYWORDS = ["giúp", "cứu", "bạn làm được gì", "chức năng"]
 
+# Các câu trả lời mẫu
+FAST_INTENT_RESPONSES = {
+    "Greeting": "Chào bạn. Tôi là trợ lý pháp lý ảo. Bạn cần tôi giúp gì về pháp luật Việt Nam?",
+    "Farewell": "Tạm biệt bạn. Nếu cần hỗ trợ, hãy liên hệ lại nhé!",
+    "Help Request": "Tôi có thể trả lời các câu hỏi liên quan đến dữ liệu pháp luật được cung cấp. Bạn hãy đặt một câu hỏi cụ thể về một vấn đề pháp lý nhé."
+}
+SMALL_TALK_RESPONSES = {
+    "Greeting": "Chào bạn. Tôi có thể giúp gì cho bạn về pháp luật?",
+    "Farewell": "Tạm biệt!",
+    "Help Request": "Hãy đặt câu hỏi về pháp luật và tôi sẽ cố gắng trả lời dựa trên dữ liệu của mình.",
+    "Other": "Tôi là trợ lý pháp luật và chỉ có thể giúp bạn các kiến thức trong lĩnh vực luật pháp mà thôi."
+}
+NO_RESULT_RESPONSE = "Tôi xin lỗi, tôi không tìm thấy thông tin đủ liên quan trong cơ sở dữ liệu để trả lời câu hỏi này."
+LOW_CONFIDENCE_RESPONSE = "Mặc dù đã tìm thấy một vài thông tin, nhưng chúng không đủ độ tin cậy để đưa ra câu trả lời chính xác."
+BUSY_RESPONSE = "Hệ thống đang quá tải, bạn vui lòng thử lại sau ít phút."
+
 def pre_filter_intent(query: str) -> str | None:
     """Bộ lọc siêu nhanh dựa trên từ khóa, chạy trước cả LLM."""
     lower_query = query.lower().strip()
@@ -43,18 +57,12 @@ def pre_filter_intent(query: str) -> str | None:
     return None
 
 
-def get_structured_input_analysis(query: str, is_first_message: bool) -> dict:
+def get_structured_input_analysis(query: str, should_cancel=None) -> dict:
     """
-    Một lệnh gọi LLM duy nhất để sửa chính tả, phân loại ý định,
-    VÀ TẠO TIÊU ĐỀ cho tin nhắn đầu tiên. (Đã tối ưu cho Zalo Legal Dataset)
+    Một lệnh gọi LLM duy nhất để sửa chính tả và phân loại ý định.
+    (Tiêu đề cuộc trò chuyện được tạo riêng ở background, xem generate_conversation_title)
     """
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        
-        title_instruction = ""
-        if is_first_message:
-            title_instruction = """4. `conversation_title`: Dựa vào `corrected_query`, tạo một tiêu đề ngắn gọn (3-5 từ) cho cuộc trò chuyện. Nếu ý định không phải là "Legal Question", trả về null."""
-
         prompt = f"""Bạn là một bộ xử lý ngôn ngữ đầu vào thông minh cho một trợ lý chuyên về pháp luật Việt Nam. 
 Cơ sở dữ liệu của trợ lý này chứa các điều khoản, luật, và nghị định của Việt Nam.
 
@@ -66,59 +74,110 @@ JSON trả về phải có các trường sau:
     - "Legal Question": Bất kỳ câu hỏi nào, dù là hỏi trực tiếp hay mô tả một tình huống, mà câu trả lời có thể nằm trong một văn bản pháp luật.
     - Các loại khác: "Greeting", "Farewell", "Help Request", "Other".
 3.  `is_rag_required`: Luôn là `true` nếu intent là "Legal Question", ngược lại là `false`.
-{title_instruction}
 
 Ví dụ:
 - Câu gốc: "Công ty nợ lương 2 tháng thì phải làm sao?"
-- JSON trả về: {{"corrected_query": "Công ty nợ lương 2 tháng thì phải làm sao?", "intent": "Legal Question", "is_rag_required": true, "conversation_title": "Xử lý nợ lương"}}
+- JSON trả về: {{"corrected_query": "Công ty nợ lương 2 tháng thì phải làm sao?", "intent": "Legal Question", "is_rag_required": true}}
 - Câu gốc: "được nghỉ bao nhiêu ngày phép 1 năm"
-- JSON trả về: {{"corrected_query": "Được nghỉ bao nhiêu ngày phép 1 năm?", "intent": "Legal Question", "is_rag_required": true, "conversation_title": "Quy định ngày phép"}}
+- JSON trả về: {{"corrected_query": "Được nghỉ bao nhiêu ngày phép 1 năm?", "intent": "Legal Question", "is_rag_required": true}}
 - Câu gốc: "chao ban"
-- JSON trả về: {{"corrected_query": "Chào bạn.", "intent": "Greeting", "is_rag_required": false, "conversation_title": null}}
+- JSON trả về: {{"corrected_query": "Chào bạn.", "intent": "Greeting", "is_rag_required": false}}
 
 ---
 Bây giờ, hãy xử lý câu sau đây. Chỉ trả về đối tượng JSON.
 Câu gốc: "{query}"
 """
         
-        response = model.generate_content(prompt)
+        response_text = gateway.generate(prompt, should_cancel=should_cancel)
         # response = client.chat.completions.create(
         #     model="gpt-4o-mini", 
         #     messages=[{"role": "user", "content": prompt}],
         #     temperature=0,
         #     response_format={"type": "json_object"} 
         # )
-        json_text = response.text.strip().replace("```json", "").replace("```", "")
+        json_text = response_text.strip().replace("```json", "").replace("```", "")
         analysis = json.loads(json_text)
-        
-        # Đảm bảo trường title luôn tồn tại, kể cả khi LLM quên
-        if is_first_message and 'conversation_title' not in analysis:
-            analysis['conversation_title'] = None
-            
+        analysis["intent_source"] = LABEL_SOURCE_LLM
         return analysis
 
+    except Cancelled:
+        raise
     except Exception as e:
         logging.error(f"Lỗi khi phân tích có cấu trúc: {e}")
         # Mặc định an toàn
-        default_response = {
+        return {
             "corrected_query": query,
             "intent": "Legal Question",
-            "is_rag_required": True
+            "is_rag_required": True,
+            "intent_source": "fallback"
         }
-        if is_first_message:
-            default_response['conversation_title'] = query[:30] + "..." # Tiêu đề tạm
-        return default_response
 
-def rewrite_query_with_history(chat_history: list) -> str:
+def analyze_input(query: str, retriever: RetrievalSystem,
+                  intent_classifier: IntentClassifier | None = None, should_cancel=None) -> dict:
+    """
+    Sửa chính tả/khôi phục dấu bằng QueryNormalizer và phân loại ý định bằng bộ phân loại
+    cục bộ trên embedding e5. Chỉ gọi Gemini (get_structured_input_analysis) khi một trong
+    hai bước không đủ tin cậy. Nhãn Gemini trả về được lưu vào `intent_labels` (nguồn "llm") làm dữ liệu
+    huấn luyện; `intent_source` cho biết kết quả đến từ đâu (local | llm | fallback).
+    """
+    metrics.inc("intent_requests_total")
+    normalized_query, normalizer_confident = retriever.normalize_query(query)
+    if normalized_query != query:
+        metrics.inc("query_normalizer_corrected_total")
+
+    local_intent = None
+    if intent_classifier is not None and intent_classifier.is_ready and normalizer_confident:
+        try:
+            local_intent, confidence = intent_classifier.predict(retriever.encode_query(normalized_query, should_cancel))
+        except Overloaded:
+            raise
+        except Exception as e:
+            logging.warning(f"Intent classifier lỗi, chuyển sang Gemini: {e}")
+            local_intent, confidence = None, 0.0
+
+        if local_intent and confidence >= intent_classifier.confidence_threshold:
+            metrics.inc("intent_llm_skipped_total")
+            _update_intent_skip_ratio()
+            return {"corrected_query": normalized_query, "intent": local_intent,
+                    "is_rag_required": local_intent == "Legal Question", "intent_source": "local"}
+
+    _update_intent_skip_ratio()
+    analysis = get_structured_input_analysis(query, should_cancel)
+    if analysis.get("intent_source") == LABEL_SOURCE_LLM:
+        _record_intent_label(analysis.get("corrected_query") or normalized_query, analysis.get("intent"))
+
+    # So sánh với kết quả của Gemini để theo dõi độ chính xác trên các ca khó
+    if local_intent:
+        metrics.inc("intent_llm_checked_total")
+        if analysis.get('intent') == local_intent:
+            metrics.inc("intent_llm_agreed_total")
+    return analysis
+
+def _record_intent_label(text: str, intent) -> None:
+    """Lưu nhãn do Gemini quyết định để lần khởi động sau intent classifier học thêm; lỗi chỉ ghi log."""
+    if intent not in SEED_EXAMPLES:
+        return
+    try:
+        get_chat_store().add_intent_label(text, intent, LABEL_SOURCE_LLM)
+        metrics.inc("intent_labels_recorded_total")
+    except Exception as e:
+        logging.warning(f"Không lưu được nhãn ý định: {e}")
+
+def _update_intent_skip_ratio():
+    total = metrics.get_counter("intent_requests_total")
+    if total:
+        metrics.set_gauge("intent_llm_skip_ratio", round(metrics.get_counter("intent_llm_skipped_total") / total, 4))
+
+def rewrite_query_with_history(chat_history: list, should_cancel=None) -> str:
     if len(chat_history) < 2:
         return chat_history[-1].content
     history_str = "\n".join([f"{'Người dùng' if msg.role == 'user' else 'Trợ lý'}: {msg.content}" for msg in chat_history[:-1]])
     current_question = chat_history[-1].content
     prompt = f"Dựa vào lịch sử trò chuyện, viết lại câu hỏi cuối cùng thành một câu hỏi độc lập, đầy đủ ngữ nghĩa để tìm kiếm. Nếu câu hỏi đã đủ nghĩa, trả về chính nó.\n\nLịch sử trò chuyện:\n{history_str}\n\nCâu hỏi cuối cùng: {current_question}\n\nCâu hỏi độc lập:"
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        response = model.generate_content(prompt)
-        return response.text.strip()
+        return gateway.generate(prompt, should_cancel=should_cancel).strip()
+    except Cancelled:
+        raise
     except Exception:
         return current_question
 
@@ -127,122 +186,223 @@ def create_final_prompt(chat_history: list, source_context: str) -> str:
     history_context = "\n".join([f"{'Người dùng' if msg.role == 'user' else 'Trợ lý'}: {msg.content}" for msg in chat_history[:-1]])
     return f"""**LỊCH SỬ TRÒ CHUYỆN:**\n---\n{history_context}\n---\n**KIẾN THỨC NỀN (Dùng để trả lời câu hỏi cuối cùng):**\n---\n{source_context}\n---\n**CÂU HỎI CUỐI CÙNG CỦA NGƯỜI DÙNG:** {current_question}\n---\n**HƯỚNG DẪN:**\nBạn là một trợ lý pháp lý chuyên nghiệp. Dựa vào KIẾN THỨC NỀN và LỊCH SỬ TRÒ CHUYỆN ở trên để trả lời câu hỏi cuối cùng của người dùng.\n- **Quan trọng:** Nhập vai một chuyên gia, trả lời trực tiếp, **không được nhắc đến "kiến thức nền" hay "nguồn được cung cấp"**.\n- Trích dẫn các nguồn liên quan bằng cách ghi `[Nguồn X]` ở cuối câu.\n- Nếu không có thông tin để trả lời, hãy nói rằng bạn không có thông tin về vấn đề này.\n\n**Câu trả lời của bạn:**"""
 
-def stream_response_generator(request: QueryRequest, retriever: RetrievalSystem):
-    conn = get_db_connection()
+def _record_cancellation(stage: str, streamed_chars: int = 0):
+    """Ghi nhận request bị hủy và ước lượng phần compute/token đã tiết kiệm được."""
+    metrics.inc(f"requests_cancelled_during_{stage}_total")
+    if stage in ("analysis", "rewrite", "retrieval"):
+        metrics.inc("retrievals_or_llm_calls_skipped_total")
+    completed = metrics.get_counter("llm_stream_completed_total")
+    if completed:
+        avg_prompt = metrics.get_counter("llm_stream_prompt_tokens_total") / completed
+        avg_output = metrics.get_counter("llm_stream_output_tokens_total") / completed
+        if stage == "generation":
+            saved = max(0.0, avg_output - streamed_chars / 4)
+        else:
+            saved = avg_prompt + avg_output
+        metrics.inc("llm_tokens_saved_estimate_total", round(saved))
+
+def provisional_title(query: str) -> str:
+    return query if len(query) <= 30 else query[:30] + "..."
+
+def generate_conversation_title(question: str) -> str:
+    """Sinh tiêu đề ngắn (3-5 từ) cho cuộc trò chuyện từ câu hỏi đầu tiên."""
+    prompt = f"Tạo một tiêu đề ngắn gọn (3-5 từ) cho cuộc trò chuyện bắt đầu bằng câu hỏi dưới đây. Chỉ trả về tiêu đề, không có dấu ngoặc kép.\n\nCâu hỏi: {question}\n\nTiêu đề:"
+    title = gateway.generate(prompt).strip().strip('"').strip()
+    return title[:100] if title else provisional_title(question)
+
+def _generate_and_save_title(conversation_id: str, user_id: int, question: str) -> str | None:
+    """
+    Chạy ở background: sinh tiêu đề và cập nhật vào DB (sidebar sẽ thấy ở lần refresh tới).
+    Không bao giờ raise, vì kết quả được stream đọc lại sau khi câu trả lời đã gửi xong.
+    """
+    try:
+        title = generate_conversation_title(question)
+        if not get_chat_store().update_conversation_title(conversation_id, user_id, title):
+            return None
+    except Exception as e:
+        logging.warning(f"Không sinh/lưu được tiêu đề cho cuộc trò chuyện {conversation_id}: {e}")
+        return None
+    return title
+
+# Thread pool riêng cho việc sinh tiêu đề, tách khỏi luồng trả lời chính
+_title_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="conversation-title")
+# Thời gian tối đa stream chờ tiêu đề sau khi trả lời xong (chỉ với cuộc trò chuyện mới)
+TITLE_EVENT_WAIT_SECONDS = 0.5
+
+def stream_response_generator(request: QueryRequest, retriever: RetrievalSystem,
+                              intent_classifier: IntentClassifier | None = None,
+                              token: CancellationToken | None = None):
+    """
+    Stream câu trả lời; nếu một cuộc trò chuyện mới được tạo, sau khi trả lời xong sẽ gửi thêm
+    event `conversation_title` khi tiêu đề được sinh kịp ở background. Vì vậy với cuộc trò chuyện mới,
+    stream có thể kết thúc muộn hơn tối đa TITLE_EVENT_WAIT_SECONDS sau phần trả lời.
+    """
+    with profiling.request():
+        title_job = {}
+        yield from _answer_events(request, retriever, intent_classifier, token, title_job)
+
+        future = title_job.get("future")
+        if future is not None and (token is None or not token.is_cancelled()):
+            try:
+                with profiling.stage("title_wait"):
+                    title = future.result(timeout=TITLE_EVENT_WAIT_SECONDS)
+            except FutureTimeoutError:
+                title = None
+            except Exception as e:
+                # Câu trả lời đã gửi xong: không để lỗi của tác vụ tiêu đề cắt ngang stream
+                logging.warning(f"Tác vụ sinh tiêu đề lỗi: {e}")
+                title = None
+            if title:
+                yield f"data: {json.dumps({'conversation_title': {'id': title_job['conversation_id'], 'title': title}})}\n\n"
+
+def _save_message(store, conversation_id: str, role: str, content: str, sources: list | None = None):
+    """Ghi tin nhắn vào store và cập nhật cửa sổ lịch sử đang cache của cuộc trò chuyện."""
+    store.add_message(conversation_id, role, content, sources)
+    history_cache.append(conversation_id, role, content)
+
+def _answer_events(request: QueryRequest, retriever: RetrievalSystem,
+                   intent_classifier: IntentClassifier | None = None,
+                   token: CancellationToken | None = None, title_job: dict | None = None):
+    store = get_chat_store()
+    should_cancel = token.is_cancelled if token is not None else None
+    stage = "analysis"
+    full_bot_response = ""
+    sources_data = None
+    answer_saved = False
     try:
         # --- BƯỚC 1: LƯU TIN NHẮN CỦA NGƯỜI DÙNG NGAY LẬP TỨC ---
-        user_message_content = request.chat_history[-1].content
+        with profiling.stage("storage"):
+            chat_history = resolve_chat_history(request, store)
+        user_message_content = chat_history[-1].content
         # === LỚP 1: BỘ LỌC NHANH ===
         fast_intent = pre_filter_intent(user_message_content)
         if fast_intent:
             logging.info(f"Phát hiện ý định nhanh: {fast_intent}")
-            intent_responses = {
-                "Greeting": "Chào bạn. Tôi là trợ lý pháp lý ảo. Bạn cần tôi giúp gì về pháp luật Việt Nam?",
-                "Farewell": "Tạm biệt bạn. Nếu cần hỗ trợ, hãy liên hệ lại nhé!",
-                "Help Request": "Tôi có thể trả lời các câu hỏi liên quan đến dữ liệu pháp luật được cung cấp. Bạn hãy đặt một câu hỏi cụ thể về một vấn đề pháp lý nhé."
-            }
-            response_text = intent_responses.get(fast_intent)
+            response_text = FAST_INTENT_RESPONSES.get(fast_intent)
+            answer_saved = True
             yield f"data: {json.dumps({'text': response_text})}\n\n"
             return
 
-        # === LỚP 2: LỆNH GỌI LLM THÔNG MINH ===
+        # === LỚP 2: BỘ PHÂN LOẠI CỤC BỘ, CHỈ GỌI LLM KHI KHÔNG CHẮC CHẮN ===
         is_new_conversation_thread = request.conversation_id is None
-        analysis = get_structured_input_analysis(user_message_content, is_new_conversation_thread)
+        with profiling.stage("analysis"):
+            analysis = analyze_input(user_message_content, retriever, intent_classifier, should_cancel)
         corrected_query = analysis['corrected_query']
 
         # Cập nhật chat history với câu đã sửa
-        request.chat_history[-1].content = corrected_query
+        chat_history[-1] = ChatMessage(role="user", content=corrected_query)
         if corrected_query != user_message_content:
             logging.info(f"Sửa chính tả: '{user_message_content}' -> '{corrected_query}'")
         
         # === LOGIC "KHAI SINH" CUỘC TRÒ CHUYỆN MỚI ===
-        if is_new_conversation_thread and analysis.get("conversation_title"):
-            # Thời điểm để tạo và lưu trữ!
-            title = analysis["conversation_title"]
-            logging.info(f"Tạo cuộc trò chuyện mới với tiêu đề: '{title}'")
+        if is_new_conversation_thread and analysis['is_rag_required']:
+            # Tạo ngay với tiêu đề tạm, tiêu đề thật được sinh ở background
+            title = provisional_title(corrected_query)
+            logging.info(f"Tạo cuộc trò chuyện mới với tiêu đề tạm: '{title}'")
             
-            # 1. Tạo cuộc trò chuyện trong DB
-            user_id = get_user_id(conn, request.username)
+            # 1. Tạo cuộc trò chuyện và lưu TOÀN BỘ lịch sử chat "lơ lửng" trong một transaction
+            user_id = store.get_user_id(request.username)
             if not user_id: 
                 # Xử lý trường hợp user không tồn tại, mặc dù hiếm
                 raise Exception(f"User {request.username} không tìm thấy khi đang tạo convo.")
-            created_convo_id = add_conversation(conn, user_id, title)
-
-            # 2. Lưu TOÀN BỘ lịch sử chat "lơ lửng" vào DB
-            for message in request.chat_history:
-                add_message(conn, created_convo_id, message.role, message.content)
+            with profiling.stage("storage"):
+                created_convo_id = store.add_conversation_with_messages(
+                    user_id, title, [(message.role, message.content) for message in chat_history]
+                )
+            request.conversation_id = created_convo_id
+            if title_job is not None:
+                title_job["future"] = _title_executor.submit(
+                    _generate_and_save_title, created_convo_id, user_id, corrected_query
+                )
+                title_job["conversation_id"] = created_convo_id
             
-            # 3. Gửi thông tin về cho frontend để cập nhật state
+            # 2. Gửi thông tin về cho frontend để cập nhật state
             yield f"data: {json.dumps({'new_conversation': {'id': created_convo_id, 'title': title}})}\n\n"
 
-            request.conversation_id = created_convo_id
-
         elif not is_new_conversation_thread:
-            add_message(conn, request.conversation_id, "user", corrected_query)
+            _save_message(store, request.conversation_id, "user", corrected_query)
 
         # === ĐỊNH TUYẾN DỰA TRÊN KẾT QUẢ PHÂN TÍCH ===
         if not analysis['is_rag_required']:
             # Xử lý các trường hợp small-talk khác mà bộ lọc nhanh bỏ lỡ
             intent = analysis['intent']
-            response_text = "Tôi là trợ lý pháp luật và chỉ có thể giúp bạn các kiến thức trong lĩnh vực luật pháp mà thôi." 
-            if intent == "Greeting":
-                 response_text = "Chào bạn. Tôi có thể giúp gì cho bạn về pháp luật?"
-            elif intent == "Farewell":
-                 response_text = "Tạm biệt!"
-            elif intent == "Help Request":
-                 response_text = "Hãy đặt câu hỏi về pháp luật và tôi sẽ cố gắng trả lời dựa trên dữ liệu của mình."
+            response_text = SMALL_TALK_RESPONSES.get(intent, SMALL_TALK_RESPONSES["Other"])
 
             if request.conversation_id:
-                add_message(conn, request.conversation_id, "assistant", response_text)
+                _save_message(store, request.conversation_id, "assistant", response_text)
+            answer_saved = True
             yield f"data: {json.dumps({'text': response_text})}\n\n"
             return
         
         # --- BƯỚC 2: BIẾN ĐỔI CÂU HỎI VÀ RETRIEVAL (như cũ) ---
-        standalone_question = rewrite_query_with_history(request.chat_history)
-        retrieved_chunks = retriever.retrieve_chunks(standalone_question, top_k_rerank=request.top_k_rerank)
+        stage = "rewrite"
+        with profiling.stage("rewrite"):
+            standalone_question = rewrite_query_with_history(chat_history, should_cancel)
+        stage = "retrieval"
+        with profiling.stage("retrieval"):
+            retrieved_chunks = retriever.retrieve_chunks(standalone_question, top_k_rerank=request.top_k_rerank,
+                                                         should_cancel=should_cancel,
+                                                         conversation_id=request.conversation_id,
+                                                         filters=request.filters.model_dump() if request.filters else None)
 
         # --- BƯỚC 3: KIỂM TRA "GÁC CỔNG" ---
         if not retrieved_chunks or retrieved_chunks[0]['score'] < RERANKER_SCORE_THRESHOLD:
-            bot_response_content = "Tôi xin lỗi, tôi không tìm thấy thông tin đủ liên quan trong cơ sở dữ liệu để trả lời câu hỏi này."
+            bot_response_content = NO_RESULT_RESPONSE
             # Lưu lại câu trả lời "từ chối" của bot
-            add_message(conn, request.conversation_id, "assistant", bot_response_content)
+            _save_message(store, request.conversation_id, "assistant", bot_response_content)
+            answer_saved = True
             # Stream câu trả lời này về và kết thúc
             yield f"data: {json.dumps({'text': bot_response_content})}\n\n"
             return
 
         high_quality_chunks = [chunk for chunk in retrieved_chunks if chunk['score'] >= RERANKER_SCORE_THRESHOLD]
         if not high_quality_chunks:
-            bot_response_content = "Mặc dù đã tìm thấy một vài thông tin, nhưng chúng không đủ độ tin cậy để đưa ra câu trả lời chính xác."
+            bot_response_content = LOW_CONFIDENCE_RESPONSE
             # Lưu lại câu trả lời "từ chối" của bot
-            add_message(conn, request.conversation_id, "assistant", bot_response_content)
+            _save_message(store, request.conversation_id, "assistant", bot_response_content)
+            answer_saved = True
             # Stream câu trả lời này về và kết thúc
             yield f"data: {json.dumps({'text': bot_response_content})}\n\n"
             return
         
         # --- BƯỚC 4: GỬI SOURCES VÀ STREAM CÂU TRẢ LỜI TỪ LLM ---
+        stage = "generation"
         sources_data = [{"doc_id": c["doc_id"], "text": c["text"], "score": c["score"]} for c in high_quality_chunks]
         yield f"data: {json.dumps({'sources': sources_data})}\n\n"
 
         source_context = "\n\n".join([f"Nguồn {i+1} (từ văn bản {c['doc_id']}):\n\"\"\"\n{c['text']}\n\"\"\"" for i, c in enumerate(high_quality_chunks)])
-        final_prompt = create_final_prompt(request.chat_history, source_context)
+        final_prompt = create_final_prompt(chat_history, source_context)
         
-        full_bot_response = ""
         try:
-            model = genai.GenerativeModel('gemini-1.5-flash-latest')
-            stream = model.generate_content(final_prompt, stream=True)
-            for chunk in stream:
-                if chunk.text:
-                    full_bot_response += chunk.text
-                    yield f"data: {json.dumps({'text': chunk.text})}\n\n"
+            with profiling.stage("generation"):
+                for text in gateway.stream(final_prompt, should_cancel=should_cancel):
+                    full_bot_response += text
+                    yield f"data: {json.dumps({'text': text})}\n\n"
             
             # Sau khi stream xong, chỉ cần lưu câu trả lời thành công của bot
-            add_message(conn, request.conversation_id, "assistant", full_bot_response, sources_data)
+            _save_message(store, request.conversation_id, "assistant", full_bot_response, sources_data)
+            answer_saved = True
 
+        except Cancelled:
+            raise
         except Exception as e:
             error_message = f"Lỗi khi gọi Gemini API: {e}"
             # Lưu lại thông báo lỗi
-            add_message(conn, request.conversation_id, "assistant", error_message)
+            _save_message(store, request.conversation_id, "assistant", error_message)
+            answer_saved = True
             yield f"data: {json.dumps({'text': error_message})}\n\n"
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+    except Overloaded as e:
+        # Đã trả về 200 nên không thể đổi sang 503: báo lỗi trong stream kèm thời gian nên thử lại
+        if request.conversation_id:
+            _save_message(store, request.conversation_id, "assistant", BUSY_RESPONSE)
+        answer_saved = True
+        yield f"data: {json.dumps({'error': BUSY_RESPONSE, 'retry_after': e.retry_after})}\n\n"
+    except (Cancelled, GeneratorExit) as e:
+        # Client đã ngắt kết nối: dừng xử lý, giữ lại phần câu trả lời đã sinh được
+        if not answer_saved:
+            _record_cancellation(stage, len(full_bot_response))
+            if full_bot_response and request.conversation_id:
+                _save_message(store, request.conversation_id, "assistant", full_bot_response, sources_data)
+            logging.info(f"Request bị hủy ở bước '{stage}', đã lưu {len(full_bot_response)} ký tự trả lời.")
+        if isinstance(e, GeneratorExit):
+            raise
@@ -0,0 +1,53 @@
+# api/streaming.py
+import asyncio
+import logging
+import threading
+
+from core import metrics
+from core.cancellation import CancellationToken
+
+_DONE = object()
+DISCONNECT_POLL_SECONDS = 0.5
+
+
+def _produce(generator, token: CancellationToken, loop, queue):
+    """Chạy generator đồng bộ trong thread riêng và đẩy từng event sang event loop."""
+    try:
+        for item in generator:
+            if token.is_cancelled():
+                break
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+    except Exception as e:
+        logging.error(f"Lỗi trong stream: {e}")
+    finally:
+        # close() ném GeneratorExit tại điểm yield -> generator lưu phần trả lời dở dang
+        generator.close()
+        loop.call_soon_threadsafe(queue.put_nowait, _DONE)
+
+
+async def stream_with_cancellation(request, generator, token: CancellationToken):
+    """
+    Bọc generator SSE đồng bộ: khi client ngắt kết nối (Starlette hủy stream hoặc
+    `request.is_disconnected()`), đặt token để các bước retrieval/LLM đang chạy dừng sớm.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    threading.Thread(target=_produce, args=(generator, token, loop, queue), daemon=True).start()
+    finished = False
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=DISCONNECT_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                continue
+            if item is _DONE:
+                finished = True
+                break
+            yield item
+    finally:
+        if not finished:
+            token.cancel()
+            metrics.inc("requests_cancelled_total")
+            logging.info("Client ngắt kết nối, hủy xử lý request.")
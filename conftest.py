@@ -0,0 +1,2 @@
+# conftest.py
+# Đặt ở thư mục gốc để pytest thêm thư mục repo vào sys.path (import api/core/retriever như khi chạy uvicorn).
@@ -0,0 +1,489 @@
+# core/async_storage.py
+import re
+import json
+import uuid
+import asyncio
+import sqlite3
+import threading
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from core import database, metrics, text_search
+from core.storage import ChatStore, StorageError
+
+# Schema viết một lần cho cả hai dialect, chỉ khác kiểu khóa tự tăng và kiểu thời gian
+_SCHEMA = {
+    "postgres": [
+        '''CREATE TABLE IF NOT EXISTS users (
+            id BIGSERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            hashed_password TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            user_id BIGINT NOT NULL REFERENCES users (id),
+            title TEXT NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT now()
+        )''',
+        '''CREATE TABLE IF NOT EXISTS messages (
+            id BIGSERIAL PRIMARY KEY,
+            conversation_id TEXT NOT NULL REFERENCES conversations (id),
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            sources TEXT,
+            created_at TIMESTAMPTZ DEFAULT now()
+        )''',
+        '''CREATE TABLE IF NOT EXISTS intent_labels (
+            id BIGSERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            intent TEXT NOT NULL,
+            source TEXT NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT now()
+        )''',
+    ],
+    "sqlite": [
+        '''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            hashed_password TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            sources TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+        )''',
+        database.INTENT_LABELS_SCHEMA,
+    ],
+}
+_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_conversations_user ON conversations (user_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, id)',
+    'CREATE INDEX IF NOT EXISTS idx_intent_labels_source ON intent_labels (source, id)',
+]
+
+# Chỉ mục tìm kiếm full-text. SQLite dùng FTS5 (core/database.py); Postgres dùng tsvector trên văn bản
+# đã bỏ dấu bằng text_search.fold, nên không cần extension unaccent và hai backend khớp giống nhau.
+_SEARCH_SCHEMA = {
+    "postgres": [
+        '''CREATE TABLE IF NOT EXISTS chat_search (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            conversation_id TEXT NOT NULL,
+            message_id BIGINT,
+            body TEXT NOT NULL,
+            body_tsv tsvector GENERATED ALWAYS AS (to_tsvector('simple', body)) STORED
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_chat_search_tsv ON chat_search USING GIN (body_tsv)',
+        'CREATE INDEX IF NOT EXISTS idx_chat_search_conversation ON chat_search (conversation_id)',
+    ],
+    "sqlite": [database.SEARCH_SCHEMA],
+}
+# Cùng tham số với database.SEARCH_SQL
+_SEARCH_SQL = {
+    "postgres": {
+        "exists": "SELECT to_regclass('chat_search') IS NOT NULL",
+        "index_message": 'INSERT INTO chat_search (user_id, conversation_id, message_id, body) '
+                         'SELECT user_id, id, $2, $3 FROM conversations WHERE id = $1',
+        "index_title": 'INSERT INTO chat_search (user_id, conversation_id, body) '
+                       'SELECT user_id, id, $2 FROM conversations WHERE id = $1',
+        "delete_title": 'DELETE FROM chat_search WHERE conversation_id = $1 AND message_id IS NULL',
+        "delete_conversation": 'DELETE FROM chat_search WHERE conversation_id = $1',
+        # (user_id, text_search.tsquery(terms), limit)
+        "search": '''
+            SELECT s.conversation_id, s.message_id, c.title, m.role, m.content, s.score FROM (
+                SELECT conversation_id, message_id, ts_rank_cd(body_tsv, q) AS score
+                FROM chat_search, to_tsquery('simple', $2) q
+                WHERE user_id = $1 AND body_tsv @@ q
+                ORDER BY score DESC LIMIT $3
+            ) s
+            JOIN conversations c ON c.id = s.conversation_id
+            LEFT JOIN messages m ON m.id = s.message_id
+            ORDER BY s.score DESC
+        ''',
+    },
+    "sqlite": database.SEARCH_SQL,
+}
+
+
+class SQLiteAsyncPool:
+    """
+    Bản thay thế asyncpg.Pool chạy trên một file SQLite (không cần server/container):
+    cùng giao diện acquire()/fetch/fetchrow/fetchval/execute/executemany/transaction,
+    cùng cú pháp tham số `$1, $2...` (SQLite hiểu `?1, ?2...`). Mỗi kết nối chạy trong
+    một thread riêng của executor, số kết nối tối đa = `size`.
+    """
+
+    def __init__(self, db_path: str, size: int = 10):
+        self.db_path = db_path
+        self.size = size
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="sqlite-pool")
+        self._connections = None
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self._connections = asyncio.Queue()
+        for _ in range(self.size):
+            conn = await loop.run_in_executor(self._executor, self._connect)
+            self._connections.put_nowait(_SQLiteAsyncConnection(conn, self._executor))
+        return self
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        return conn
+
+    @asynccontextmanager
+    async def acquire(self):
+        conn = await self._connections.get()
+        try:
+            yield conn
+        finally:
+            self._connections.put_nowait(conn)
+
+    async def close(self):
+        while not self._connections.empty():
+            self._connections.get_nowait().raw.close()
+        self._executor.shutdown(wait=False)
+
+
+class _SQLiteAsyncConnection:
+    _PARAM = re.compile(r"\$(\d+)")
+
+    def __init__(self, conn, executor):
+        self.raw = conn
+        self._executor = executor
+
+    async def _run(self, fn):
+        # Kết nối chỉ thuộc về một coroutine tại một thời điểm nên các lệnh không chạy chồng nhau
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn)
+
+    def _sql(self, sql):
+        return self._PARAM.sub(r"?\1", sql)
+
+    async def fetch(self, sql, *args):
+        return await self._run(lambda: self.raw.execute(self._sql(sql), args).fetchall())
+
+    async def fetchrow(self, sql, *args):
+        return await self._run(lambda: self.raw.execute(self._sql(sql), args).fetchone())
+
+    async def fetchval(self, sql, *args):
+        row = await self.fetchrow(sql, *args)
+        return row[0] if row is not None else None
+
+    async def execute(self, sql, *args):
+        await self._run(lambda: self.raw.execute(self._sql(sql), args))
+
+    async def executemany(self, sql, args_list):
+        await self._run(lambda: self.raw.executemany(self._sql(sql), args_list))
+
+    @asynccontextmanager
+    async def transaction(self):
+        await self.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            await self.execute("ROLLBACK")
+            raise
+        await self.execute("COMMIT")
+
+
+def _storage_errors():
+    """Các exception của driver được quy về StorageError."""
+    errors = [sqlite3.Error]
+    try:
+        import asyncpg
+        errors.append(asyncpg.PostgresError)
+        errors.append(asyncpg.InterfaceError)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+class AsyncChatStore:
+    """
+    Cài đặt async của ChatStore trên một connection pool (asyncpg hoặc SQLiteAsyncPool).
+    Mọi thao tác nhiều câu lệnh (tạo cuộc trò chuyện kèm lịch sử, xóa) chạy trong một
+    transaction và dùng executemany, nên chỉ tốn một lượt mượn kết nối.
+    """
+
+    def __init__(self, pool, dialect: str):
+        self.pool = pool
+        self.dialect = dialect
+        self._search_sql = _SEARCH_SQL[dialect]
+        self._errors = _storage_errors()
+
+    @asynccontextmanager
+    async def _conn(self):
+        try:
+            async with self.pool.acquire() as conn:
+                yield conn
+        except self._errors as e:
+            metrics.inc("chat_store_errors_total")
+            raise StorageError(str(e)) from e
+
+    async def init_schema(self):
+        async with self._conn() as conn:
+            for statement in _SCHEMA[self.dialect] + _INDEXES:
+                await conn.execute(statement)
+            search_index_exists = bool(await conn.fetchval(self._search_sql["exists"]))
+            for statement in _SEARCH_SCHEMA[self.dialect]:
+                await conn.execute(statement)
+            if not search_index_exists:
+                # DB có từ trước khi có chỉ mục tìm kiếm: đánh chỉ mục toàn bộ lịch sử một lần
+                async with conn.transaction():
+                    await self._rebuild_search_index(conn)
+
+    async def _rebuild_search_index(self, conn):
+        await conn.execute('DELETE FROM chat_search')
+        titles = await conn.fetch('SELECT id, title FROM conversations')
+        if titles:
+            await conn.executemany(self._search_sql["index_title"],
+                                   [(row["id"], text_search.fold(row["title"])) for row in titles])
+        messages = await conn.fetch('SELECT id, conversation_id, content FROM messages')
+        if messages:
+            await conn.executemany(self._search_sql["index_message"], [
+                (row["conversation_id"], row["id"], text_search.fold(row["content"])) for row in messages
+            ])
+
+    async def get_user_id(self, username):
+        async with self._conn() as conn:
+            return await conn.fetchval('SELECT id FROM users WHERE username = $1', username)
+
+    async def register_user(self, username, hashed_password):
+        async with self._conn() as conn:
+            await conn.execute('INSERT INTO users (username, hashed_password) VALUES ($1, $2)', username, hashed_password)
+
+    async def get_user_conversations(self, user_id):
+        async with self._conn() as conn:
+            rows = await conn.fetch(
+                'SELECT id, title FROM conversations WHERE user_id = $1 ORDER BY created_at DESC, id', user_id
+            )
+        return [{"id": row["id"], "title": row["title"]} for row in rows]
+
+    async def get_conversations_by_username(self, username):
+        # Một round-trip thay cho get_user_id + get_user_conversations
+        async with self._conn() as conn:
+            rows = await conn.fetch('''
+                SELECT c.id, c.title FROM conversations c JOIN users u ON u.id = c.user_id
+                WHERE u.username = $1 ORDER BY c.created_at DESC, c.id
+            ''', username)
+        return [{"id": row["id"], "title": row["title"]} for row in rows]
+
+    async def get_conversation_messages(self, conversation_id):
+        async with self._conn() as conn:
+            rows = await conn.fetch(
+                'SELECT role, content, sources FROM messages WHERE conversation_id = $1 ORDER BY id', conversation_id
+            )
+        return [
+            {"role": row["role"], "content": row["content"],
+             "sources": json.loads(row["sources"]) if row["sources"] else None}
+            for row in rows
+        ]
+
+    async def get_recent_messages(self, conversation_id, limit):
+        async with self._conn() as conn:
+            rows = await conn.fetch(
+                'SELECT role, content FROM messages WHERE conversation_id = $1 ORDER BY id DESC LIMIT $2',
+                conversation_id, limit
+            )
+        return [{"role": row["role"], "content": row["content"]} for row in reversed(rows)]
+
+    async def search_conversations(self, user_id, query, limit=20):
+        terms = text_search.search_terms(query)
+        if not terms:
+            return []
+        match = text_search.tsquery(terms) if self.dialect == "postgres" else text_search.fts5_query(terms)
+        async with self._conn() as conn:
+            rows = await conn.fetch(self._search_sql["search"], user_id, match, limit)
+        return text_search.build_hits(rows, terms)
+
+    async def add_conversation(self, user_id, title):
+        return await self.add_conversation_with_messages(user_id, title, [])
+
+    async def add_conversation_with_messages(self, user_id, title, messages):
+        new_convo_id = str(uuid.uuid4())
+        async with self._conn() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    'INSERT INTO conversations (id, user_id, title) VALUES ($1, $2, $3)', new_convo_id, user_id, title
+                )
+                await conn.execute(self._search_sql["index_title"], new_convo_id, text_search.fold(title))
+                if messages:
+                    await conn.executemany(
+                        'INSERT INTO messages (conversation_id, role, content) VALUES ($1, $2, $3)',
+                        [(new_convo_id, role, content) for role, content in messages]
+                    )
+                    message_ids = await conn.fetch(
+                        'SELECT id FROM messages WHERE conversation_id = $1 ORDER BY id', new_convo_id
+                    )
+                    await conn.executemany(self._search_sql["index_message"], [
+                        (new_convo_id, row["id"], text_search.fold(content))
+                        for row, (_, content) in zip(message_ids, messages)
+                    ])
+        return new_convo_id
+
+    async def add_message(self, conversation_id, role, content, sources=None):
+        sources_json = json.dumps(sources) if sources else None
+        async with self._conn() as conn:
+            async with conn.transaction():
+                message_id = await conn.fetchval(
+                    'INSERT INTO messages (conversation_id, role, content, sources) VALUES ($1, $2, $3, $4) RETURNING id',
+                    conversation_id, role, content, sources_json
+                )
+                await conn.execute(self._search_sql["index_message"], conversation_id, message_id, text_search.fold(content))
+
+    async def delete_conversation(self, conversation_id, user_id):
+        async with self._conn() as conn:
+            async with conn.transaction():
+                # Chỉ xóa tin nhắn khi cuộc trò chuyện đúng là của user này
+                await conn.execute('''
+                    DELETE FROM messages WHERE conversation_id = $1
+                    AND EXISTS (SELECT 1 FROM conversations WHERE id = $1 AND user_id = $2)
+                ''', conversation_id, user_id)
+                deleted = await conn.fetch(
+                    'DELETE FROM conversations WHERE id = $1 AND user_id = $2 RETURNING id', conversation_id, user_id
+                )
+                if deleted:
+                    await conn.execute(self._search_sql["delete_conversation"], conversation_id)
+        return len(deleted) > 0
+
+    async def update_conversation_title(self, conversation_id, user_id, new_title):
+        async with self._conn() as conn:
+            async with conn.transaction():
+                updated = await conn.fetch(
+                    'UPDATE conversations SET title = $1 WHERE id = $2 AND user_id = $3 RETURNING id',
+                    new_title, conversation_id, user_id
+                )
+                if updated:
+                    await conn.execute(self._search_sql["delete_title"], conversation_id)
+                    await conn.execute(self._search_sql["index_title"], conversation_id, text_search.fold(new_title))
+        return len(updated) > 0
+
+    async def add_intent_label(self, text, intent, source):
+        async with self._conn() as conn:
+            await conn.execute(
+                'INSERT INTO intent_labels (text, intent, source) VALUES ($1, $2, $3)', text, intent, source
+            )
+
+    async def get_intent_labels(self, sources, limit=5000):
+        sources = list(sources)
+        if not sources:
+            return []
+        placeholders = ", ".join(f"${i}" for i in range(1, len(sources) + 1))
+        async with self._conn() as conn:
+            rows = await conn.fetch(f'''
+                SELECT text, intent, source FROM intent_labels
+                WHERE source IN ({placeholders})
+                ORDER BY id DESC
+                LIMIT ${len(sources) + 1}
+            ''', *sources, limit)
+        return [{"text": row["text"], "intent": row["intent"], "source": row["source"]} for row in rows]
+
+    async def get_question_sequences(self, limit=1000):
+        async with self._conn() as conn:
+            rows = await conn.fetch('''
+                SELECT m.conversation_id, m.content FROM messages m
+                JOIN (SELECT id FROM conversations ORDER BY created_at DESC LIMIT $1) c ON c.id = m.conversation_id
+                WHERE m.role = 'user'
+                ORDER BY m.conversation_id, m.id
+            ''', limit)
+        sequences = {}
+        for row in rows:
+            sequences.setdefault(row["conversation_id"], []).append(row["content"])
+        return list(sequences.values())
+
+
+class PooledChatStore(ChatStore):
+    """
+    ChatStore đồng bộ bọc AsyncChatStore: pool và event loop riêng chạy trong một thread nền,
+    các thread xử lý request (FastAPI threadpool, generator SSE) gửi coroutine sang và chờ kết quả.
+    Nhờ vậy nhiều replica API có thể dùng chung một database server qua pool kết nối.
+    """
+
+    def __init__(self, pool_factory, dialect: str):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="chat-store-loop", daemon=True)
+        self._thread.start()
+        self._pool = self._run(pool_factory())
+        self._store = AsyncChatStore(self._pool, dialect)
+
+    @classmethod
+    def postgres(cls, database_url: str, pool_size: int = 10):
+        try:
+            import asyncpg
+        except ImportError as e:
+            raise StorageError("CHAT_STORE_BACKEND=postgres cần cài asyncpg") from e
+        return cls(lambda: asyncpg.create_pool(database_url, min_size=1, max_size=pool_size), "postgres")
+
+    @classmethod
+    def sqlite(cls, db_path: str, pool_size: int = 10):
+        return cls(lambda: SQLiteAsyncPool(db_path, pool_size).open(), "sqlite")
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def init_schema(self):
+        return self._run(self._store.init_schema())
+
+    def get_user_id(self, username):
+        return self._run(self._store.get_user_id(username))
+
+    def register_user(self, username, hashed_password):
+        return self._run(self._store.register_user(username, hashed_password))
+
+    def get_user_conversations(self, user_id):
+        return self._run(self._store.get_user_conversations(user_id))
+
+    def get_conversations_by_username(self, username):
+        return self._run(self._store.get_conversations_by_username(username))
+
+    def get_conversation_messages(self, conversation_id):
+        return self._run(self._store.get_conversation_messages(conversation_id))
+
+    def get_recent_messages(self, conversation_id, limit):
+        return self._run(self._store.get_recent_messages(conversation_id, limit))
+
+    def search_conversations(self, user_id, query, limit=20):
+        return self._run(self._store.search_conversations(user_id, query, limit))
+
+    def add_conversation(self, user_id, title):
+        return self._run(self._store.add_conversation(user_id, title))
+
+    def add_conversation_with_messages(self, user_id, title, messages):
+        return self._run(self._store.add_conversation_with_messages(user_id, title, messages))
+
+    def add_message(self, conversation_id, role, content, sources=None):
+        return self._run(self._store.add_message(conversation_id, role, content, sources))
+
+    def delete_conversation(self, conversation_id, user_id):
+        return self._run(self._store.delete_conversation(conversation_id, user_id))
+
+    def update_conversation_title(self, conversation_id, user_id, new_title):
+        return self._run(self._store.update_conversation_title(conversation_id, user_id, new_title))
+
+    def add_intent_label(self, text, intent, source):
+        return self._run(self._store.add_intent_label(text, intent, source))
+
+    def get_intent_labels(self, sources, limit=5000):
+        return self._run(self._store.get_intent_labels(sources, limit))
+
+    def get_question_sequences(self, limit=1000):
+        return self._run(self._store.get_question_sequences(limit))
+
+    def close(self):
+        self._run(self._pool.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
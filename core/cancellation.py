@@ -0,0 +1,36 @@
+# core/cancellation.py
+import threading
+from concurrent.futures import CancelledError
+
+
+class Cancelled(CancelledError):
+    """Request đã bị hủy (ví dụ client đóng kết nối SSE)."""
+
+
+class CancellationToken:
+    """
+    Cờ hủy dùng chung giữa endpoint và các bước xử lý (retrieval, rerank, gọi LLM).
+    Truyền `token.is_cancelled` vào các hàm nhận tham số `should_cancel`.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason: str = "client_disconnected"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise Cancelled(self.reason)
+
+
+def check_cancelled(should_cancel):
+    """Dùng trong các vòng lặp dài: raise Cancelled nếu `should_cancel()` trả về True."""
+    if should_cancel is not None and should_cancel():
+        raise Cancelled()
@@ -1,9 +1,66 @@
 # core/database.py
+import os
 import sqlite3
 import uuid
 import json
 
-DB_NAME = 'chat_history.db'
+from core import text_search
+
+DB_NAME = os.getenv("CHAT_DB_PATH", 'chat_history.db')
+
+# Chỉ mục full-text (FTS5) trên nội dung tin nhắn và tiêu đề, dùng chung cho backend sqlite-pool.
+# `body` là văn bản đã bỏ dấu (text_search.fold); `tags` chứa "u<user_id> c<conversation_id> [title]"
+# để lọc theo user / cuộc trò chuyện ngay trong chỉ mục. Dòng tiêu đề có message_id NULL.
+# Tham số đánh số (?1, ?2...) để core/async_storage.py dùng lại nguyên câu lệnh.
+SEARCH_SCHEMA = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_search USING fts5(
+        body, tags, conversation_id UNINDEXED, message_id UNINDEXED
+    )
+'''
+_TAGS_SQL = "'u' || user_id || ' c' || replace(id, '-', '')"
+SEARCH_SQL = {
+    "exists": "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_search'",
+    # (conversation_id, message_id, body)
+    "index_message": f"INSERT INTO chat_search (body, tags, conversation_id, message_id) "
+                     f"SELECT ?3, {_TAGS_SQL}, id, ?2 FROM conversations WHERE id = ?1",
+    # (conversation_id, body)
+    "index_title": f"INSERT INTO chat_search (body, tags, conversation_id) "
+                   f"SELECT ?2, {_TAGS_SQL} || ' title', id FROM conversations WHERE id = ?1",
+    # (conversation_id,)
+    "delete_title": '''
+        DELETE FROM chat_search WHERE rowid IN (
+            SELECT rowid FROM chat_search WHERE chat_search MATCH 'tags : "c' || replace(?1, '-', '') || '" AND tags : title'
+        )
+    ''',
+    "delete_conversation": '''
+        DELETE FROM chat_search WHERE rowid IN (
+            SELECT rowid FROM chat_search WHERE chat_search MATCH 'tags : "c' || replace(?1, '-', '') || '"'
+        )
+    ''',
+    # (user_id, text_search.fts5_query(terms), limit): xếp hạng BM25 chỉ trên cột body
+    "search": '''
+        SELECT s.conversation_id, s.message_id, c.title, m.role, m.content, s.score FROM (
+            SELECT conversation_id, message_id, -bm25(chat_search, 1.0, 0.0) AS score FROM chat_search
+            WHERE chat_search MATCH 'tags : "u' || ?1 || '" AND body : (' || ?2 || ')'
+            ORDER BY bm25(chat_search, 1.0, 0.0) LIMIT ?3
+        ) s
+        JOIN conversations c ON c.id = s.conversation_id
+        LEFT JOIN messages m ON m.id = s.message_id
+        ORDER BY s.score DESC
+    ''',
+}
+
+# Nhãn ý định dùng để huấn luyện intent classifier, kèm nguồn gốc của nhãn:
+# "llm" (Gemini quyết định) hoặc "human" (người gán nhãn). Không suy nhãn từ câu trả lời của trợ lý.
+INTENT_LABELS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS intent_labels (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        intent TEXT NOT NULL,
+        source TEXT NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+'''
 
 # === BƯỚC 1: TẠO DEPENDENCY QUẢN LÝ KẾT NỐI ===
 def get_db():
@@ -18,14 +75,14 @@ def get_db():
     finally:
         conn.close()
 
-def get_db_connection():
+def get_db_connection(db_path: str | None = None):
     """Tạo và trả về một kết nối đến DB."""
-    conn = sqlite3.connect(DB_NAME)
+    conn = sqlite3.connect(db_path or DB_NAME)
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_db():
-    conn = get_db_connection()
+def init_db(db_path: str | None = None):
+    conn = get_db_connection(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -54,9 +111,29 @@ def init_db():
             FOREIGN KEY (conversation_id) REFERENCES conversations (id)
         );
     ''')
+    cursor.execute(INTENT_LABELS_SCHEMA)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversations_user ON conversations (user_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_intent_labels_source ON intent_labels (source, id)')
+    search_index_exists = cursor.execute(SEARCH_SQL["exists"]).fetchone() is not None
+    cursor.execute(SEARCH_SCHEMA)
     conn.commit()
+    if not search_index_exists:
+        # DB có từ trước khi có chỉ mục tìm kiếm: đánh chỉ mục toàn bộ lịch sử một lần
+        with conn:
+            rebuild_search_index(conn)
     conn.close()
 
+def rebuild_search_index(conn: sqlite3.Connection):
+    conn.execute('DELETE FROM chat_search')
+    conn.executemany(SEARCH_SQL["index_title"], [
+        (row["id"], text_search.fold(row["title"])) for row in conn.execute('SELECT id, title FROM conversations')
+    ])
+    conn.executemany(SEARCH_SQL["index_message"], [
+        (row["conversation_id"], row["id"], text_search.fold(row["content"]))
+        for row in conn.execute('SELECT id, conversation_id, content FROM messages')
+    ])
+
 
 # === BƯỚC 2: SỬA LẠI TẤT CẢ CÁC HÀM ĐỂ NHẬN `conn` LÀM THAM SỐ ===
 # Chúng sẽ không tự mở/đóng kết nối nữa
@@ -74,7 +151,7 @@ def get_user_conversations(conn: sqlite3.Connection, user_id: int) -> list:
 
 def get_conversation_messages(conn: sqlite3.Connection, conversation_id: str) -> list:
     messages = conn.execute(
-        'SELECT role, content, sources FROM messages WHERE conversation_id = ? ORDER BY created_at ASC',
+        'SELECT role, content, sources FROM messages WHERE conversation_id = ? ORDER BY created_at ASC, id ASC',
         (conversation_id,)
     ).fetchall()
     
@@ -87,32 +164,80 @@ def get_conversation_messages(conn: sqlite3.Connection, conversation_id: str) ->
         })
     return results
 
+def get_recent_messages(conn: sqlite3.Connection, conversation_id: str, limit: int) -> list:
+    """`limit` tin nhắn gần nhất của cuộc trò chuyện (role, content), theo thứ tự thời gian."""
+    rows = conn.execute('''
+        SELECT role, content FROM (
+            SELECT id, created_at, role, content FROM messages WHERE conversation_id = ?
+            ORDER BY created_at DESC, id DESC LIMIT ?
+        ) ORDER BY created_at ASC, id ASC
+    ''', (conversation_id, limit)).fetchall()
+    return [{"role": row["role"], "content": row["content"]} for row in rows]
+
+def search_conversations(conn: sqlite3.Connection, user_id: int, query: str, limit: int = 20) -> list:
+    """Tìm trong tin nhắn và tiêu đề của user (không phân biệt dấu), xếp hạng BM25, kèm snippet."""
+    terms = text_search.search_terms(query)
+    if not terms:
+        return []
+    rows = conn.execute(SEARCH_SQL["search"], (user_id, text_search.fts5_query(terms), limit)).fetchall()
+    return text_search.build_hits(rows, terms)
+
 def add_conversation(conn: sqlite3.Connection, user_id: int, title: str) -> str:
     new_convo_id = str(uuid.uuid4())
-    conn.execute(
-        'INSERT INTO conversations (id, user_id, title) VALUES (?, ?, ?)',
-        (new_convo_id, user_id, title)
-    )
-    conn.commit()
+    with conn:
+        conn.execute(
+            'INSERT INTO conversations (id, user_id, title) VALUES (?, ?, ?)',
+            (new_convo_id, user_id, title)
+        )
+        conn.execute(SEARCH_SQL["index_title"], (new_convo_id, text_search.fold(title)))
+    return new_convo_id
+
+def add_conversation_with_messages(conn: sqlite3.Connection, user_id: int, title: str, messages: list[tuple[str, str]]) -> str:
+    """Tạo cuộc trò chuyện và lưu các tin nhắn ban đầu trong cùng một transaction (một lần commit)."""
+    new_convo_id = str(uuid.uuid4())
+    with conn:
+        conn.execute(
+            'INSERT INTO conversations (id, user_id, title) VALUES (?, ?, ?)',
+            (new_convo_id, user_id, title)
+        )
+        conn.executemany(
+            'INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)',
+            [(new_convo_id, role, content) for role, content in messages]
+        )
+        conn.execute(SEARCH_SQL["index_title"], (new_convo_id, text_search.fold(title)))
+        message_ids = [row["id"] for row in conn.execute(
+            'SELECT id FROM messages WHERE conversation_id = ? ORDER BY id', (new_convo_id,)
+        )]
+        conn.executemany(SEARCH_SQL["index_message"], [
+            (new_convo_id, message_id, text_search.fold(content))
+            for message_id, (_, content) in zip(message_ids, messages)
+        ])
     return new_convo_id
 
 def add_message(conn: sqlite3.Connection, conversation_id: str, role: str, content: str, sources: list | None = None):
     sources_json = json.dumps(sources) if sources else None
-    conn.execute(
-        'INSERT INTO messages (conversation_id, role, content, sources) VALUES (?, ?, ?, ?)',
-        (conversation_id, role, content, sources_json)
-    )
-    conn.commit()
+    with conn:
+        cursor = conn.execute(
+            'INSERT INTO messages (conversation_id, role, content, sources) VALUES (?, ?, ?, ?)',
+            (conversation_id, role, content, sources_json)
+        )
+        conn.execute(SEARCH_SQL["index_message"], (conversation_id, cursor.lastrowid, text_search.fold(content)))
 
 def delete_conversation(conn: sqlite3.Connection, conversation_id: str, user_id: int):
-    delete_messages_sql = 'DELETE FROM messages WHERE conversation_id = ?'
+    # Chỉ xóa tin nhắn khi cuộc trò chuyện đúng là của user này
+    delete_messages_sql = '''
+        DELETE FROM messages WHERE conversation_id = ?1
+        AND EXISTS (SELECT 1 FROM conversations WHERE id = ?1 AND user_id = ?2)
+    '''
     delete_conversation_sql = 'DELETE FROM conversations WHERE id = ? AND user_id = ?'
     
     try:
         with conn: # Dùng transaction
             conn.execute("PRAGMA foreign_keys = ON;")
-            conn.execute(delete_messages_sql, (conversation_id,))
+            conn.execute(delete_messages_sql, (conversation_id, user_id))
             cursor = conn.execute(delete_conversation_sql, (conversation_id, user_id))
+            if cursor.rowcount > 0:
+                conn.execute(SEARCH_SQL["delete_conversation"], (conversation_id,))
             return cursor.rowcount > 0
     except sqlite3.Error as e:
         print(f"Lỗi database khi xóa: {e}")
@@ -133,13 +258,46 @@ def update_conversation_title(conn: sqlite3.Connection, conversation_id: str, us
     """
     try:
         # Câu lệnh UPDATE có điều kiện WHERE user_id để đảm bảo an toàn
-        cursor = conn.execute(
-            'UPDATE conversations SET title = ? WHERE id = ? AND user_id = ?',
-            (new_title, conversation_id, user_id)
-        )
-        conn.commit()
+        with conn:
+            cursor = conn.execute(
+                'UPDATE conversations SET title = ? WHERE id = ? AND user_id = ?',
+                (new_title, conversation_id, user_id)
+            )
+            if cursor.rowcount > 0:
+                conn.execute(SEARCH_SQL["delete_title"], (conversation_id,))
+                conn.execute(SEARCH_SQL["index_title"], (conversation_id, text_search.fold(new_title)))
         # cursor.rowcount sẽ > 0 nếu có một dòng được cập nhật thành công
         return cursor.rowcount > 0
     except sqlite3.Error as e:
         print(f"Lỗi database khi cập nhật tiêu đề: {e}")
-        return False
\ No newline at end of file
+        return False
+
+def add_intent_label(conn: sqlite3.Connection, text: str, intent: str, source: str):
+    with conn:
+        conn.execute('INSERT INTO intent_labels (text, intent, source) VALUES (?, ?, ?)', (text, intent, source))
+
+def get_intent_labels(conn: sqlite3.Connection, sources: tuple[str, ...], limit: int = 5000) -> list:
+    """Các nhãn ý định gần nhất thuộc những nguồn cho trước, dùng để huấn luyện intent classifier."""
+    if not sources:
+        return []
+    placeholders = ", ".join("?" * len(sources))
+    rows = conn.execute(f'''
+        SELECT text, intent, source FROM intent_labels
+        WHERE source IN ({placeholders})
+        ORDER BY id DESC
+        LIMIT ?
+    ''', (*sources, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+def get_question_sequences(conn: sqlite3.Connection, limit: int = 1000) -> list[list[str]]:
+    """Chuỗi câu hỏi của user trong từng cuộc trò chuyện (gần nhất trước), dùng để replay khi load test."""
+    rows = conn.execute('''
+        SELECT m.conversation_id, m.content FROM messages m
+        JOIN (SELECT id FROM conversations ORDER BY created_at DESC LIMIT ?) c ON c.id = m.conversation_id
+        WHERE m.role = 'user'
+        ORDER BY m.conversation_id, m.id
+    ''', (limit,)).fetchall()
+    sequences = {}
+    for row in rows:
+        sequences.setdefault(row["conversation_id"], []).append(row["content"])
+    return list(sequences.values())
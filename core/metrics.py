@@ -0,0 +1,31 @@
+# core/metrics.py
+import threading
+from collections import defaultdict
+
+# Bộ đếm đơn giản, dùng chung trong một worker (thread-safe)
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+
+
+def inc(name: str, value: float = 1.0):
+    """Tăng một bộ đếm."""
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name: str, value):
+    """Ghi đè giá trị hiện tại của một gauge."""
+    with _lock:
+        _gauges[name] = value
+
+
+def get_counter(name: str) -> float:
+    with _lock:
+        return _counters.get(name, 0.0)
+
+
+def snapshot() -> dict:
+    """Trả về bản sao của toàn bộ counters và gauges để xuất ra /metrics."""
+    with _lock:
+        return {"counters": dict(_counters), "gauges": dict(_gauges)}
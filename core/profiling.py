@@ -0,0 +1,233 @@
+# core/profiling.py
+import os
+import sys
+import time
+import threading
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+
+from core import metrics
+
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "120"))
+PROFILE_MAX_REQUESTS = int(os.getenv("PROFILE_MAX_REQUESTS", "100"))
+
+# Khi không có phiên profiling, stage()/request() chỉ trả về object dùng chung này
+_NOOP = nullcontext()
+_session = None
+_session_lock = threading.Lock()
+# thread id -> danh sách stage đang mở (chỉ thread sở hữu được sửa, sampler chỉ đọc)
+_thread_stages = {}
+
+
+class ProfilerBusy(Exception):
+    """Đang có một phiên profiling khác chạy trên worker này."""
+
+
+class ProfileSession:
+    """
+    Một phiên profiling giới hạn thời gian:
+      - mode "sample": lấy mẫu stack của mọi thread trong `seconds` giây,
+      - mode "requests": chỉ lấy mẫu các thread đang xử lý N request `/generate_answer` kế tiếp.
+    Mỗi mẫu được gắn đường dẫn stage (vd. `stage:retrieval;stage:rerank`) để tách theo bước pipeline.
+    """
+
+    def __init__(self, mode, seconds, max_requests, interval, trace_memory, exclude_threads=()):
+        self.mode = mode
+        self.seconds = seconds
+        self.max_requests = max_requests
+        self.interval = interval
+        self.trace_memory = trace_memory
+        self.exclude_threads = set(exclude_threads)
+        self.stacks = Counter()
+        self.stage_samples = Counter()
+        self.stage_times = defaultdict(lambda: {"calls": 0, "total_ms": 0.0, "net_alloc_kb": 0.0})
+        self.samples = 0
+        self.claimed_requests = 0
+        self.finished_requests = 0
+        self.started_at = None
+        self.elapsed = 0.0
+        self.allocations = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._requests_done = threading.Event()
+
+    # --- Đánh dấu request / stage (gọi từ các thread xử lý) ---
+    def claim_request(self) -> bool:
+        with self._lock:
+            if self.claimed_requests >= self.max_requests:
+                return False
+            self.claimed_requests += 1
+            return True
+
+    def finish_request(self):
+        with self._lock:
+            self.finished_requests += 1
+            if self.finished_requests >= self.max_requests:
+                self._requests_done.set()
+
+    def record_stage(self, path, elapsed_ms, alloc_bytes):
+        with self._lock:
+            stats = self.stage_times[path]
+            stats["calls"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["net_alloc_kb"] += alloc_bytes / 1024
+
+    # --- Lấy mẫu ---
+    def _sample_loop(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me or thread_id in self.exclude_threads:
+                    continue
+                stages = list(_thread_stages.get(thread_id, ()))
+                if self.mode == "requests" and "request" not in stages:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.reverse()
+                stage_path = ";".join(name for name in stages if name != "request")
+                root = ";".join(f"stage:{name}" for name in stage_path.split(";")) if stage_path \
+                    else f"thread:{names.get(thread_id, thread_id)}"
+                self.stacks[root + ";" + ";".join(stack)] += 1
+                self.stage_samples[stage_path or "(none)"] += 1
+                self.samples += 1
+
+    def run(self):
+        self.started_at = time.time()
+        started = time.perf_counter()
+        if self.trace_memory:
+            tracemalloc.start()
+        sampler = threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True)
+        sampler.start()
+        try:
+            if self.mode == "requests":
+                self._requests_done.wait(timeout=self.seconds)
+            else:
+                time.sleep(self.seconds)
+        finally:
+            self._stop.set()
+            sampler.join()
+            if self.trace_memory:
+                snapshot = tracemalloc.take_snapshot().filter_traces([
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                ])
+                tracemalloc.stop()
+                self.allocations = [
+                    {"site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                     "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+                    for stat in snapshot.statistics("lineno")[:30]
+                ]
+            self.elapsed = time.perf_counter() - started
+
+    # --- Kết quả ---
+    def collapsed(self) -> str:
+        """Định dạng collapsed stack (`frame;frame;... count`), dùng trực tiếp với flamegraph.pl hoặc speedscope."""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+    def to_dict(self) -> dict:
+        return {
+            "mode": self.mode,
+            "started_at": self.started_at,
+            "elapsed_s": round(self.elapsed, 3),
+            "interval_ms": self.interval * 1000,
+            "samples": self.samples,
+            "requests_profiled": self.finished_requests if self.mode == "requests" else None,
+            "stages": {
+                path: {"samples": self.stage_samples.get(path, 0),
+                       "calls": self.stage_times[path]["calls"],
+                       "total_ms": round(self.stage_times[path]["total_ms"], 2),
+                       "net_alloc_kb": round(self.stage_times[path]["net_alloc_kb"], 1) if self.trace_memory else None}
+                for path in sorted(set(self.stage_times) | set(self.stage_samples))
+            },
+            "allocations": self.allocations,
+            "collapsed": self.collapsed(),
+        }
+
+
+class _Marker:
+    """Đẩy tên stage lên stack của thread hiện tại, ghi lại thời gian khi ra khỏi stage."""
+
+    __slots__ = ("session", "name", "thread_id", "started", "alloc_start", "is_request")
+
+    def __init__(self, session, name, is_request=False):
+        self.session = session
+        self.name = name
+        self.is_request = is_request
+
+    def __enter__(self):
+        self.thread_id = threading.get_ident()
+        _thread_stages.setdefault(self.thread_id, []).append(self.name)
+        self.alloc_start = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed_ms = (time.perf_counter() - self.started) * 1000
+        path = None
+        stages = _thread_stages.get(self.thread_id)
+        if stages:
+            # Ở mode "requests" chỉ tính các stage nằm trong một request được chọn
+            if self.session.mode == "sample" or "request" in stages:
+                path = ";".join(name for name in stages if name != "request")
+            stages.pop()
+            if not stages:
+                _thread_stages.pop(self.thread_id, None)
+        if self.is_request:
+            self.session.finish_request()
+        elif path:
+            # Cấp phát ròng khi nhiều request chạy song song chỉ mang tính xấp xỉ
+            alloc = tracemalloc.get_traced_memory()[0] - self.alloc_start if tracemalloc.is_tracing() else 0
+            self.session.record_stage(path, elapsed_ms, alloc)
+        return False
+
+
+def stage(name: str):
+    """Đánh dấu một bước của pipeline. Không làm gì (và gần như không tốn chi phí) khi không profiling."""
+    session = _session
+    if session is None:
+        return _NOOP
+    return _Marker(session, name)
+
+
+def request():
+    """Đánh dấu toàn bộ một request `/generate_answer`, dùng cho mode "requests"."""
+    session = _session
+    if session is None or session.mode != "requests" or not session.claim_request():
+        return _NOOP
+    return _Marker(session, "request", is_request=True)
+
+
+def run_session(mode: str = "sample", seconds: float = 10.0, requests: int = 5,
+                interval_ms: float = 5.0, trace_memory: bool = True) -> ProfileSession:
+    """Chạy một phiên profiling (chặn tới khi kết thúc). Chỉ một phiên tại một thời điểm trên mỗi worker."""
+    global _session
+    if mode not in ("sample", "requests"):
+        raise ValueError("mode phải là 'sample' hoặc 'requests'")
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise ValueError(f"seconds phải trong khoảng (0, {PROFILE_MAX_SECONDS}]")
+    if not 0 < requests <= PROFILE_MAX_REQUESTS:
+        raise ValueError(f"requests phải trong khoảng (0, {PROFILE_MAX_REQUESTS}]")
+    if not 1 <= interval_ms <= 1000:
+        raise ValueError("interval_ms phải trong khoảng [1, 1000]")
+
+    session = ProfileSession(mode, seconds, requests, interval_ms / 1000, trace_memory,
+                             exclude_threads={threading.get_ident()})
+    with _session_lock:
+        if _session is not None:
+            raise ProfilerBusy()
+        _session = session
+    metrics.inc("profile_sessions_total")
+    try:
+        session.run()
+    finally:
+        with _session_lock:
+            _session = None
+    return session
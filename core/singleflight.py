@@ -0,0 +1,79 @@
+# core/singleflight.py
+import threading
+from concurrent.futures import Future, CancelledError, TimeoutError as FutureTimeoutError
+
+from core import metrics
+from core.cancellation import Cancelled
+
+
+class SingleFlight:
+    """
+    Gộp các lời gọi đồng thời có cùng key: chỉ lời gọi đầu tiên (leader) thực sự chạy,
+    các lời gọi còn lại chờ và dùng chung kết quả (hoặc exception) của leader.
+
+    - Exception của leader được ném lại cho mọi waiter.
+    - Nếu chính leader bị hủy (CancelledError), các waiter không bị hủy theo mà một
+      waiter sẽ trở thành leader mới và chạy lại.
+    - Waiter có thể truyền `should_cancel` để thôi chờ (raise Cancelled) mà không
+      ảnh hưởng tới phép tính đang chạy cho những người khác.
+    """
+
+    def __init__(self, name: str, poll_interval: float = 0.05):
+        self.name = name
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    @property
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._in_flight)
+
+    def do(self, key, fn, should_cancel=None):
+        while True:
+            with self._lock:
+                future = self._in_flight.get(key)
+                is_leader = future is None
+                if is_leader:
+                    future = Future()
+                    self._in_flight[key] = future
+
+            if is_leader:
+                return self._run_leader(key, future, fn)
+
+            metrics.inc(f"{self.name}_coalesced_total")
+            try:
+                return self._wait(future, should_cancel)
+            except CancelledError:
+                if should_cancel is not None and should_cancel():
+                    raise Cancelled() from None
+                # Leader bị hủy nhưng waiter này vẫn cần kết quả -> thử lại (có thể làm leader)
+                metrics.inc(f"{self.name}_leader_cancelled_total")
+
+    def _wait(self, future, should_cancel):
+        if should_cancel is None:
+            return future.result()
+        while True:
+            try:
+                return future.result(timeout=self.poll_interval)
+            except FutureTimeoutError:
+                if should_cancel():
+                    metrics.inc(f"{self.name}_waiter_cancelled_total")
+                    raise Cancelled()
+
+    def _run_leader(self, key, future, fn):
+        metrics.inc(f"{self.name}_executed_total")
+        try:
+            result = fn()
+        except BaseException as e:
+            self._release(key)
+            future.set_exception(e if isinstance(e, Exception) else CancelledError())
+            raise
+        self._release(key)
+        future.set_result(result)
+        return result
+
+    def _release(self, key):
+        # Gỡ key trước khi công bố kết quả để waiter chạy lại không gặp lại future cũ
+        with self._lock:
+            self._in_flight.pop(key, None)
@@ -0,0 +1,205 @@
+# core/storage.py
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+from core import database
+
+# sqlite (mặc định, một file local) | sqlite-pool (backend async chạy trên SQLite, không cần server)
+# | postgres (backend async với connection pool, dùng DATABASE_URL)
+CHAT_STORE_BACKEND = os.getenv("CHAT_STORE_BACKEND", "sqlite")
+CHAT_DB_POOL_SIZE = int(os.getenv("CHAT_DB_POOL_SIZE", "10"))
+
+
+class StorageError(Exception):
+    """Lỗi của tầng lưu trữ lịch sử chat, không phụ thuộc backend (sqlite3.Error, asyncpg...)."""
+
+
+class ChatStore(ABC):
+    """
+    Giao diện lưu trữ users / conversations / messages. Code ứng dụng chỉ làm việc với
+    giao diện này, backend cụ thể được chọn qua biến môi trường CHAT_STORE_BACKEND.
+    """
+
+    @abstractmethod
+    def init_schema(self): ...
+
+    @abstractmethod
+    def get_user_id(self, username: str) -> int | None: ...
+
+    @abstractmethod
+    def register_user(self, username: str, hashed_password: str): ...
+
+    @abstractmethod
+    def get_user_conversations(self, user_id: int) -> list[dict]: ...
+
+    def get_conversations_by_username(self, username: str) -> list[dict]:
+        """Danh sách {id, title} của user, mới nhất trước. Backend có thể gộp thành một truy vấn."""
+        user_id = self.get_user_id(username)
+        return self.get_user_conversations(user_id) if user_id else []
+
+    def is_conversation_owner(self, username: str, conversation_id: str) -> bool:
+        """Cuộc trò chuyện có thuộc về user không. Backend có thể gộp thành một truy vấn."""
+        return any(convo["id"] == conversation_id for convo in self.get_conversations_by_username(username))
+
+    @abstractmethod
+    def get_conversation_messages(self, conversation_id: str) -> list[dict]: ...
+
+    @abstractmethod
+    def get_recent_messages(self, conversation_id: str, limit: int) -> list[dict]: ...
+
+    @abstractmethod
+    def search_conversations(self, user_id: int, query: str, limit: int = 20) -> list[dict]:
+        """
+        Tìm kiếm full-text (không phân biệt dấu) trong tin nhắn và tiêu đề các cuộc trò chuyện của user.
+        Trả về [{conversation_id, title, message_id, role, snippet, score}], điểm cao trước;
+        kết quả khớp tiêu đề có message_id/role là None.
+        """
+
+    @abstractmethod
+    def add_conversation(self, user_id: int, title: str) -> str: ...
+
+    @abstractmethod
+    def add_conversation_with_messages(self, user_id: int, title: str, messages: list[tuple[str, str]]) -> str: ...
+
+    @abstractmethod
+    def add_message(self, conversation_id: str, role: str, content: str, sources: list | None = None): ...
+
+    @abstractmethod
+    def delete_conversation(self, conversation_id: str, user_id: int) -> bool: ...
+
+    @abstractmethod
+    def update_conversation_title(self, conversation_id: str, user_id: int, new_title: str) -> bool: ...
+
+    @abstractmethod
+    def add_intent_label(self, text: str, intent: str, source: str):
+        """Lưu một nhãn ý định cho câu hỏi, `source` ghi lại nhãn do đâu mà có ("llm" | "human")."""
+
+    @abstractmethod
+    def get_intent_labels(self, sources: tuple[str, ...], limit: int = 5000) -> list[dict]:
+        """Các nhãn {text, intent, source} gần nhất thuộc `sources`, mới nhất trước."""
+
+    @abstractmethod
+    def get_question_sequences(self, limit: int = 1000) -> list[list[str]]: ...
+
+    def close(self):
+        pass
+
+
+class SQLiteChatStore(ChatStore):
+    """Backend gốc: một file SQLite, mỗi lời gọi mở một kết nối ngắn (các hàm trong core/database.py)."""
+
+    def __init__(self, db_path: str = database.DB_NAME):
+        self.db_path = db_path
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        except sqlite3.Error as e:
+            raise StorageError(str(e)) from e
+        finally:
+            conn.close()
+
+    def init_schema(self):
+        try:
+            database.init_db(self.db_path)
+        except sqlite3.Error as e:
+            raise StorageError(str(e)) from e
+
+    def get_user_id(self, username):
+        with self._connect() as conn:
+            return database.get_user_id(conn, username)
+
+    def register_user(self, username, hashed_password):
+        with self._connect() as conn:
+            database.register_user_in_db(conn, username, hashed_password)
+
+    def get_user_conversations(self, user_id):
+        with self._connect() as conn:
+            return [dict(row) for row in database.get_user_conversations(conn, user_id)]
+
+    def get_conversation_messages(self, conversation_id):
+        with self._connect() as conn:
+            return database.get_conversation_messages(conn, conversation_id)
+
+    def get_recent_messages(self, conversation_id, limit):
+        with self._connect() as conn:
+            return database.get_recent_messages(conn, conversation_id, limit)
+
+    def search_conversations(self, user_id, query, limit=20):
+        with self._connect() as conn:
+            return database.search_conversations(conn, user_id, query, limit)
+
+    def add_conversation(self, user_id, title):
+        with self._connect() as conn:
+            return database.add_conversation(conn, user_id, title)
+
+    def add_conversation_with_messages(self, user_id, title, messages):
+        with self._connect() as conn:
+            return database.add_conversation_with_messages(conn, user_id, title, messages)
+
+    def add_message(self, conversation_id, role, content, sources=None):
+        with self._connect() as conn:
+            database.add_message(conn, conversation_id, role, content, sources)
+
+    def delete_conversation(self, conversation_id, user_id):
+        with self._connect() as conn:
+            return database.delete_conversation(conn, conversation_id, user_id)
+
+    def update_conversation_title(self, conversation_id, user_id, new_title):
+        with self._connect() as conn:
+            return database.update_conversation_title(conn, conversation_id, user_id, new_title)
+
+    def add_intent_label(self, text, intent, source):
+        with self._connect() as conn:
+            database.add_intent_label(conn, text, intent, source)
+
+    def get_intent_labels(self, sources, limit=5000):
+        with self._connect() as conn:
+            return database.get_intent_labels(conn, tuple(sources), limit)
+
+    def get_question_sequences(self, limit=1000):
+        with self._connect() as conn:
+            return database.get_question_sequences(conn, limit)
+
+
+def create_chat_store(backend: str = CHAT_STORE_BACKEND, database_url: str | None = None,
+                      db_path: str | None = None, pool_size: int = CHAT_DB_POOL_SIZE) -> ChatStore:
+    """Khởi tạo backend lưu trữ theo tên (sqlite | sqlite-pool | postgres)."""
+    db_path = db_path or database.DB_NAME
+    if backend == "sqlite":
+        return SQLiteChatStore(db_path)
+
+    from core.async_storage import PooledChatStore
+    if backend == "sqlite-pool":
+        return PooledChatStore.sqlite(db_path, pool_size=pool_size)
+    if backend == "postgres":
+        database_url = database_url or os.getenv("DATABASE_URL")
+        if not database_url:
+            raise ValueError("CHAT_STORE_BACKEND=postgres cần biến môi trường DATABASE_URL")
+        return PooledChatStore.postgres(database_url, pool_size=pool_size)
+    raise ValueError(f"CHAT_STORE_BACKEND không hợp lệ: {backend}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_chat_store() -> ChatStore:
+    """
+    Singleton dùng chung trong worker (đồng thời là dependency của FastAPI). Lần đầu tạo sẽ gọi
+    init_schema() để DB có từ trước được bổ sung các bảng mới (vd. chỉ mục tìm kiếm chat_search) trước khi ghi.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store = create_chat_store()
+                store.init_schema()
+                _store = store
+    return _store
@@ -0,0 +1,106 @@
+# core/text_search.py
+"""
+Phần dùng chung của tìm kiếm full-text trên lịch sử chat, cho mọi backend ChatStore:
+văn bản được chuẩn hóa (chữ thường, bỏ dấu tiếng Việt) trước khi đánh chỉ mục để "dieu 35 luat lao dong"
+khớp "Điều 35 Luật Lao động"; câu tìm kiếm được đổi thành truy vấn FTS5 (SQLite) hoặc tsquery (Postgres);
+snippet được cắt từ văn bản gốc quanh các từ khớp.
+"""
+import os
+import re
+import unicodedata
+
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "160"))
+# Số từ tối đa lấy từ câu tìm kiếm (câu dài chỉ làm truy vấn chậm và khó khớp hơn)
+MAX_SEARCH_TERMS = 8
+HIGHLIGHT = "**"
+
+# Không lấy "_": tokenizer của FTS5/Postgres coi đó là dấu phân cách
+_WORD_RE = re.compile(r"[^\W_]+")
+
+
+def strip_diacritics(text: str) -> str:
+    """Bỏ dấu tiếng Việt, giữ nguyên độ dài từng ký tự ("Điều" -> "Dieu")."""
+    out = []
+    for ch in text:
+        if ch == "đ":
+            out.append("d")
+        elif ch == "Đ":
+            out.append("D")
+        else:
+            base = unicodedata.normalize("NFD", ch)[0]
+            out.append(base)
+    return "".join(out)
+
+
+def fold(text: str) -> str:
+    """Chữ thường, bỏ dấu; giữ nguyên độ dài của văn bản (đã chuẩn hóa NFC) để ánh xạ vị trí khi cắt snippet."""
+    return strip_diacritics(unicodedata.normalize("NFC", text)).lower()
+
+
+def search_terms(query: str) -> list[str]:
+    terms = []
+    for term in _WORD_RE.findall(fold(query)):
+        if term not in terms:
+            terms.append(term)
+    return terms[:MAX_SEARCH_TERMS]
+
+
+def conversation_tag(conversation_id: str) -> str:
+    """Token đại diện cho cuộc trò chuyện trong cột `tags` của chỉ mục FTS5 (phải khớp với SQL trong core/database.py)."""
+    return "c" + conversation_id.replace("-", "")
+
+
+def fts5_query(terms: list[str]) -> str:
+    """Các từ đều phải xuất hiện (AND); từ cuối được khớp theo tiền tố vì người dùng có thể đang gõ dở."""
+    return " ".join(f'"{term}"' for term in terms[:-1]) + f' "{terms[-1]}"*'
+
+
+def tsquery(terms: list[str]) -> str:
+    return " & ".join(terms[:-1] + [f"{terms[-1]}:*"])
+
+
+def make_snippet(text: str, terms: list[str], width: int = SEARCH_SNIPPET_CHARS) -> str:
+    """Đoạn khoảng `width` ký tự quanh lần khớp đầu tiên, các từ khớp được bọc trong `**` (markdown)."""
+    text = unicodedata.normalize("NFC", text)
+    folded = fold(text)
+    if len(folded) != len(text):
+        return text[:width]
+    words = [re.escape(term) + r"(?!\w)" for term in terms[:-1]] + [re.escape(terms[-1]) + r"\w*"]
+    matches = list(re.finditer(r"(?<!\w)(?:" + "|".join(words) + ")", folded))
+
+    start = max(0, matches[0].start() - width // 3) if matches else 0
+    if start > 0:
+        # Bắt đầu ở đầu một từ
+        space = text.find(" ", start, matches[0].start())
+        start = space + 1 if space != -1 else start
+    end = min(len(text), start + width)
+    if end < len(text):
+        space = text.rfind(" ", start, end)
+        end = space if space > start else end
+
+    parts, cursor = [], start
+    for match in matches:
+        if match.start() < cursor or match.end() > end:
+            continue
+        parts.append(text[cursor:match.start()])
+        parts.append(f"{HIGHLIGHT}{text[match.start():match.end()]}{HIGHLIGHT}")
+        cursor = match.end()
+    parts.append(text[cursor:end])
+    snippet = " ".join("".join(parts).split())
+    return ("…" if start > 0 else "") + snippet + ("…" if end < len(text) else "")
+
+
+def build_hits(rows, terms: list[str]) -> list[dict]:
+    """Kết quả tìm kiếm từ các dòng (conversation_id, message_id, title, role, content, score) của backend."""
+    hits = []
+    for row in rows:
+        is_title = row["message_id"] is None
+        hits.append({
+            "conversation_id": row["conversation_id"],
+            "title": row["title"],
+            "message_id": row["message_id"],
+            "role": None if is_title else row["role"],
+            "snippet": make_snippet(row["title"] if is_title else row["content"], terms),
+            "score": round(float(row["score"]), 6),
+        })
+    return hits
@@ -98,6 +98,11 @@ if authentication_status is True:
                     st.session_state.conversation_id = convo_info["id"]
                     needs_sidebar_refresh = True
                     continue
+
+                if "conversation_title" in chunk:
+                    # Tiêu đề thật được sinh ở background, chỉ cần làm mới sidebar
+                    needs_sidebar_refresh = True
+                    continue
             
             # Cập nhật lần cuối không có con trỏ
             placeholder.markdown(full_response_content)
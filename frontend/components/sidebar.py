@@ -1,6 +1,6 @@
 # frontend/components/sidebar.py
 import streamlit as st
-from services.api_client import get_conversations_from_api, delete_conversation_on_api, update_conversation_title_on_api
+from services.api_client import get_conversations_from_api, delete_conversation_on_api, update_conversation_title_on_api, search_conversations_on_api
 from style import inject_custom_css 
 
 def render_sidebar(authenticator, username):
@@ -25,6 +25,20 @@ def render_sidebar(authenticator, username):
 
         st.markdown("---", unsafe_allow_html=True)
         st.markdown("#### Lịch sử trò chuyện")
+
+        # --- Tìm kiếm trong toàn bộ lịch sử (không phân biệt dấu) ---
+        search_query = st.text_input("Tìm kiếm", placeholder="🔍 Tìm trong lịch sử...", label_visibility="collapsed")
+        if search_query.strip():
+            hits = search_conversations_on_api(username, search_query.strip())
+            if not hits:
+                st.caption("Không tìm thấy kết quả.")
+            for i, hit in enumerate(hits):
+                if st.button(hit['title'], key=f"search_{i}_{hit['conversation_id']}", use_container_width=True):
+                    st.session_state.conversation_id = hit['conversation_id']
+                    st.session_state.load_conversation = True
+                    st.rerun()
+                st.caption(hit['snippet'])
+            st.markdown("---", unsafe_allow_html=True)
         
         conversations = get_conversations_from_api(username)
         editing_convo_id = st.session_state.get('editing_convo_id')
@@ -7,19 +7,25 @@ import json
 BASE_API_URL = "http://127.0.0.1:8000"
 
 def get_answer_stream_from_api(chat_history: list[dict], username: str, conversation_id: str | None):
-    history_to_send = [{"role": msg["role"], "content": msg["content"]} for msg in chat_history]
+    payload = {"username": username, "conversation_id": conversation_id, "top_k_rerank": 5}
+    if conversation_id:
+        # Server đã lưu lịch sử của cuộc trò chuyện, chỉ cần gửi tin nhắn mới
+        payload["message"] = chat_history[-1]["content"]
+    else:
+        # Cuộc trò chuyện chưa được lưu: gửi cả các tin nhắn "lơ lửng" để server lưu khi tạo mới
+        payload["chat_history"] = [{"role": msg["role"], "content": msg["content"]} for msg in chat_history]
     
     try:
         response = requests.post(
             f"{BASE_API_URL}/generate_answer",  # Sử dụng BASE_URL
-            json={
-                "chat_history": history_to_send, 
-                "username": username,
-                "conversation_id": conversation_id,
-                "top_k_rerank": 5
-            },
+            json=payload,
             stream=True
         )
+        if response.status_code in (429, 503):
+            # Server từ chối do quá tải (admission control)
+            retry_after = response.headers.get("Retry-After", "vài")
+            yield {"error": f"Hệ thống đang bận, bạn vui lòng thử lại sau {retry_after} giây."}
+            return
         response.raise_for_status()
         for line in response.iter_lines():
             if line and line.decode('utf-8').startswith('data: '):
@@ -39,6 +45,15 @@ def get_conversations_from_api(username: str):
         st.error(f"Lỗi khi tải lịch sử chat: {e}")
         return []
 
+def search_conversations_on_api(username: str, query: str, limit: int = 20):
+    try:
+        response = requests.get(f"{BASE_API_URL}/conversations/{username}/search", params={"q": query, "limit": limit})
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        st.error(f"Lỗi khi tìm kiếm lịch sử chat: {e}")
+        return []
+
 def get_messages_from_api(conversation_id: str):
     try:
         response = requests.get(f"{BASE_API_URL}/messages/{conversation_id}") # Sử dụng BASE_URL
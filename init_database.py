@@ -1,46 +1,9 @@
-import sqlite3
-
-DB_NAME = 'chat_history.db'
-
-def get_db_connection():
-    """Tạo và trả về một kết nối đến DB."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
+from core.storage import get_chat_store
 
 def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            hashed_password TEXT NOT NULL
-        );
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS conversations (
-            id TEXT PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            title TEXT NOT NULL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        );
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            conversation_id TEXT NOT NULL,
-            role TEXT NOT NULL,
-            content TEXT NOT NULL,
-            sources TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (conversation_id) REFERENCES conversations (id)
-        );
-    ''')
-    conn.commit()
-    conn.close()
+    """Tạo các bảng cho backend được chọn qua CHAT_STORE_BACKEND (mặc định: file SQLite `chat_history.db`)."""
+    get_chat_store().init_schema()
 
 if __name__ == "__main__":
     init_db()
-    print("Cơ sở dữ liệu đã được khởi tạo.")
\ No newline at end of file
+    print("Cơ sở dữ liệu đã được khởi tạo.")
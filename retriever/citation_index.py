@@ -0,0 +1,126 @@
+# retriever/citation_index.py
+
+import re
+from collections import defaultdict, namedtuple
+
+from core.text_search import strip_diacritics
+
+# Điểm gán cho chunk khớp trích dẫn: luôn cao hơn mọi điểm cross-encoder và ngưỡng "gác cổng"
+CITATION_SCORE = 100.0
+
+# "Điều 113", "khoản 2 Điều 5", "Điều 5 khoản 2", "khoản 1, Điều 35" (trên câu hỏi đã bỏ dấu, chữ thường)
+_CITATION_RE = re.compile(
+    r"(?:\bkhoan\s+(\d{1,3})\s*,?\s*(?:cua\s+|tai\s+)?)?\bdieu\s+(\d{1,4})\b(?:\s*,?\s*khoan\s+(\d{1,3})\b)?"
+)
+# Tiêu đề điều trong nội dung chunk: "Điều 5. Phạm vi ..." (chữ hoa sau dấu chấm, để loại các câu dẫn chiếu)
+_HEADING_RE = re.compile(r"(?:^|(?<=\s))Điều\s+(\d{1,4})\s*\.\s*(\w)")
+# chunk_id của pipeline ingestion: "{doc_id}_{article_id}_{part}"
+_CHUNK_SUFFIX_RE = re.compile(r"_(\d{1,4})_(\d+)$")
+# Các từ còn lại trong một câu hỏi "tra cứu thuần" sau khi bỏ trích dẫn và tên văn bản
+_LOOKUP_WORDS = frozenset(
+    "quy dinh gi noi dung la cua theo tai ve the nao nhu ra sao hien hanh nam so duoc co "
+    "cho toi biet xem tra cuu trich dan hay neu giai thich y nghia viec".split()
+)
+
+Citation = namedtuple("Citation", ["article", "clause"])
+
+
+def parse_citations(query: str) -> list[Citation]:
+    """Các trích dẫn điều/khoản trong câu hỏi, theo thứ tự xuất hiện và không trùng lặp."""
+    text = strip_diacritics(query.lower())
+    citations = []
+    for clause_before, article, clause_after in _CITATION_RE.findall(text):
+        citation = Citation(article.lstrip("0") or "0", (clause_before or clause_after).lstrip("0") or None)
+        if citation not in citations:
+            citations.append(citation)
+    return citations
+
+
+def is_pure_lookup(text_without_documents: str) -> bool:
+    """
+    Câu hỏi chỉ là tra cứu nội dung điều luật ("Điều 113 Bộ luật Lao động quy định gì") nếu sau khi
+    bỏ trích dẫn và tên văn bản chỉ còn các từ chung chung hoặc số năm.
+    """
+    remainder = _CITATION_RE.sub(" ", text_without_documents)
+    return all(word in _LOOKUP_WORDS or word.isdigit() for word in re.findall(r"\w+", remainder))
+
+
+def _headings(text):
+    for match in _HEADING_RE.finditer(text):
+        if match.group(2).isupper():
+            yield match.start(), match.group(1).lstrip("0") or "0"
+
+
+def _article_of(chunk):
+    """(số điều, thứ tự phần) của một chunk, dựa vào tiêu đề "Điều N." ở đầu chunk hoặc chunk_id."""
+    start, number = next(_headings(chunk['text'].lstrip()), (None, None))
+    suffix = _CHUNK_SUFFIX_RE.search(chunk['chunk_id'])
+    part = int(suffix.group(2)) if suffix else 0
+    if start == 0:
+        return number, part
+    if suffix and suffix.group(1) != "0":
+        return suffix.group(1).lstrip("0"), part
+    return None, part
+
+
+def _index_segment(chunks) -> dict:
+    articles = defaultdict(list)
+    for chunk in chunks:
+        article, part = _article_of(chunk)
+        if article is not None:
+            articles[(chunk['doc_id'], article)].append((part, chunk['chunk_id']))
+        # Chunk dài (văn bản thêm qua API, không chia theo điều) có thể chứa tiêu đề của các điều khác
+        for _, number in _headings(chunk['text']):
+            if number != article:
+                articles[(chunk['doc_id'], number)].append((part, chunk['chunk_id']))
+    return {key: [chunk_id for _, chunk_id in sorted(entries)] for key, entries in articles.items()}
+
+
+class CitationIndex:
+    """
+    Chỉ mục (doc_id, số điều) -> các chunk_id của điều đó, theo thứ tự trong văn bản.
+    Xây theo từng segment của snapshot BM25 và dùng lại chỉ mục của các segment không đổi
+    (cập nhật chỉ tạo thêm delta segment hoặc bitmap xóa dùng chung danh sách chunk).
+    """
+
+    def __init__(self, snapshot, previous: "CitationIndex | None" = None):
+        reusable = previous._segments if previous is not None else {}
+        self._segments = {}
+        for seg in snapshot.segments:
+            key = id(seg.chunks)
+            entry = reusable.get(key)
+            if entry is None or entry[0] is not seg.chunks:
+                entry = (seg.chunks, _index_segment(seg.chunks))
+            self._segments[key] = entry
+        self._live = snapshot.chunks
+
+    def __len__(self):
+        return sum(len(articles) for _, articles in self._segments.values())
+
+    def article_chunks(self, doc_id: str, article: str) -> list:
+        chunk_ids = []
+        for _, articles in self._segments.values():
+            chunk_ids.extend(cid for cid in articles.get((doc_id, article), ()) if cid in self._live)
+        return chunk_ids
+
+    def lookup(self, citations: list[Citation], doc_ids, documents: dict) -> list[tuple]:
+        """
+        Trả về [(chunk_id, Citation)] khớp chính xác. Nếu một điều có trong nhiều văn bản được nhắc tới
+        (vd. "Bộ luật Lao động" không kèm năm) thì lấy văn bản mới nhất. Với trích dẫn khoản,
+        chunk chứa "N. " của khoản đó được đưa lên đầu.
+        """
+        hits, seen = [], set()
+        for citation in citations:
+            candidates = [(doc_id, self.article_chunks(doc_id, citation.article)) for doc_id in doc_ids]
+            candidates = [(doc_id, chunk_ids) for doc_id, chunk_ids in candidates if chunk_ids]
+            if not candidates:
+                continue
+            _, chunk_ids = max(candidates, key=lambda item: (documents[item[0]]["year"] or 0, item[0]))
+            if citation.clause:
+                clause_re = re.compile(rf"(?:^|[\s:;.]){citation.clause}\.\s")
+                chunk_ids = sorted(chunk_ids, key=lambda cid: not clause_re.search(self._live[cid]['text']))
+            for chunk_id in chunk_ids:
+                if chunk_id not in seen:
+                    seen.add(chunk_id)
+                    hits.append((chunk_id, citation))
+        return hits
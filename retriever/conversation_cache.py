@@ -0,0 +1,116 @@
+# retriever/conversation_cache.py
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from core import metrics
+
+# Hết hạn sau một khoảng không hoạt động, và giới hạn số cuộc trò chuyện giữ trong bộ nhớ
+CONVERSATION_CACHE_TTL = float(os.getenv("CONVERSATION_CACHE_TTL", "1800"))
+CONVERSATION_CACHE_MAX_ENTRIES = int(os.getenv("CONVERSATION_CACHE_MAX_ENTRIES", "2000"))
+# Số ứng viên (kèm điểm rerank) giữ lại cho mỗi cuộc trò chuyện
+CONVERSATION_POOL_SIZE = int(os.getenv("CONVERSATION_POOL_SIZE", "40"))
+# Câu hỏi tiếp theo phải đủ gần câu trước (cosine giữa embedding) mới dùng lại pool
+FOLLOW_UP_MIN_SIMILARITY = float(os.getenv("FOLLOW_UP_MIN_SIMILARITY", "0.85"))
+# Ứng viên cũ có điểm cách ngưỡng top-k không quá margin này được coi là "chưa chắc" và rerank lại
+UNCERTAIN_SCORE_MARGIN = float(os.getenv("UNCERTAIN_SCORE_MARGIN", "1.0"))
+
+
+def _unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class ConversationContext:
+    """Pool ứng viên của các lượt trước trong một cuộc trò chuyện (bất biến, thay thế cả object khi cập nhật)."""
+
+    __slots__ = ("query_embedding", "scores", "cutoff", "snapshot_version", "last_used")
+
+    def __init__(self, query_embedding, scores: dict, cutoff: float, snapshot_version: int):
+        self.query_embedding = query_embedding
+        self.scores = scores
+        self.cutoff = cutoff
+        self.snapshot_version = snapshot_version
+        self.last_used = time.monotonic()
+
+    def similarity(self, query_embedding) -> float:
+        return float(np.dot(self.query_embedding, _unit(query_embedding)))
+
+    def split(self, margin: float = UNCERTAIN_SCORE_MARGIN) -> tuple[dict, list]:
+        """Tách pool thành (điểm còn dùng được, các chunk_id cần rerank lại vì nằm sát ngưỡng)."""
+        confident, uncertain = {}, []
+        for chunk_id, score in self.scores.items():
+            if abs(score - self.cutoff) <= margin:
+                uncertain.append(chunk_id)
+            else:
+                confident[chunk_id] = score
+        return confident, uncertain
+
+
+class ConversationCandidateCache:
+    """
+    Cache theo conversation_id giữ pool ứng viên và điểm reranker của các lượt trước,
+    để câu hỏi nối tiếp (thường cùng một văn bản luật) chỉ cần rerank ứng viên mới hoặc
+    nằm sát ngưỡng. Loại bỏ theo thời gian không hoạt động (TTL) và theo LRU khi vượt giới hạn.
+    """
+
+    def __init__(self, ttl: float = CONVERSATION_CACHE_TTL, max_entries: int = CONVERSATION_CACHE_MAX_ENTRIES,
+                 pool_size: int = CONVERSATION_POOL_SIZE, min_similarity: float = FOLLOW_UP_MIN_SIMILARITY):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.pool_size = pool_size
+        self.min_similarity = min_similarity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, conversation_id: str, query_embedding, snapshot_version: int) -> ConversationContext | None:
+        """Trả về context nếu câu hỏi mới là câu nối tiếp của cùng chủ đề trên cùng phiên bản corpus."""
+        with self._lock:
+            self._evict(time.monotonic())
+            context = self._entries.get(conversation_id)
+            if context is not None:
+                self._entries.move_to_end(conversation_id)
+                context.last_used = time.monotonic()
+        if context is None:
+            metrics.inc("conversation_cache_misses_total")
+            return None
+        if context.snapshot_version != snapshot_version or context.similarity(query_embedding) < self.min_similarity:
+            # Corpus đã đổi hoặc người dùng chuyển chủ đề: tìm lại từ đầu
+            metrics.inc("conversation_cache_stale_total")
+            return None
+        metrics.inc("conversation_cache_hits_total")
+        return context
+
+    def put(self, conversation_id: str, query_embedding, scores: dict, top_k: int, snapshot_version: int):
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:self.pool_size]
+        if not ranked:
+            return
+        cutoff = ranked[min(top_k, len(ranked)) - 1][1]
+        context = ConversationContext(_unit(query_embedding), dict(ranked), cutoff, snapshot_version)
+        with self._lock:
+            self._entries[conversation_id] = context
+            self._entries.move_to_end(conversation_id)
+            self._evict(time.monotonic())
+            metrics.set_gauge("conversation_cache_entries", len(self._entries))
+
+    def discard(self, conversation_id: str):
+        with self._lock:
+            self._entries.pop(conversation_id, None)
+            metrics.set_gauge("conversation_cache_entries", len(self._entries))
+
+    def _evict(self, now):
+        # Thứ tự trong OrderedDict là thứ tự dùng gần nhất, nên entry cũ nhất luôn ở đầu
+        while self._entries:
+            conversation_id, context = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and now - context.last_used <= self.ttl:
+                break
+            self._entries.popitem(last=False)
+            metrics.inc("conversation_cache_evictions_total")
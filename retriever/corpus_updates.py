@@ -0,0 +1,101 @@
+# retriever/corpus_updates.py
+"""
+Log các cập nhật corpus tăng dần (corpus_updates.jsonl) ghi bởi RetrievalSystem.upsert_document/delete_document.
+Khi khởi động, log được gộp thẳng vào danh sách chunk/token của artifact gốc trước khi xây chỉ mục
+(không phát lại từng cập nhật qua SegmentedIndex); khi log vượt ngưỡng kích thước, artifact gốc được
+ghi lại cùng các cập nhật và log được xóa để thời gian khởi động không tăng mãi.
+
+Artifact đã gộp được ghi thành một "thế hệ" mới (legal_corpus_chunks.<n>.jsonl + ...tokenized.<n>.json)
+và chỉ có hiệu lực khi manifest corpus_base.json được đổi nguyên tử sang thế hệ đó, nên hai file
+chunk/token luôn khớp nhau dù tiến trình dừng ở bất kỳ bước nào.
+"""
+import json
+import os
+
+from retriever.ingestion import BASE_MANIFEST_FILE, CHUNKS_FILE, TOKENIZED_FILE
+
+UPDATES_FILE = "corpus_updates.jsonl"
+# Log lớn hơn ngưỡng này (byte) thì được gộp vào artifact gốc lúc khởi động; 0 = luôn gộp nếu log không rỗng
+COMPACT_THRESHOLD_BYTES = int(os.getenv("CORPUS_LOG_COMPACT_BYTES", str(4 * 1024 * 1024)))
+
+
+def apply_updates(chunks, tokenized_chunks, log_path):
+    """
+    Trả về (chunks, tokenized_chunks, số cập nhật) sau khi áp dụng log lên corpus gốc.
+    Văn bản được upsert thay thế toàn bộ chunk cũ và đứng sau các văn bản không đổi, giống thứ tự của delta segment.
+    """
+    if not os.path.exists(log_path):
+        return chunks, tokenized_chunks, 0
+    documents = {}
+    for chunk, tokens in zip(chunks, tokenized_chunks):
+        documents.setdefault(chunk['doc_id'], []).append((chunk, tokens))
+    count = 0
+    with open(log_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            entry = json.loads(line)
+            documents.pop(entry['doc_id'], None)
+            if entry['op'] == 'upsert' and entry['chunks']:
+                documents[entry['doc_id']] = list(zip(entry['chunks'], entry['tokens']))
+            count += 1
+    if not count:
+        return chunks, tokenized_chunks, 0
+    pairs = [pair for doc_chunks in documents.values() for pair in doc_chunks]
+    return [chunk for chunk, _ in pairs], [tokens for _, tokens in pairs], count
+
+
+def needs_compaction(log_path, threshold=None) -> bool:
+    threshold = COMPACT_THRESHOLD_BYTES if threshold is None else threshold
+    return os.path.exists(log_path) and os.path.getsize(log_path) > 0 and os.path.getsize(log_path) >= threshold
+
+
+def _read_manifest(processed_data_dir) -> dict:
+    path = os.path.join(processed_data_dir, BASE_MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {"generation": 0, "chunks": CHUNKS_FILE, "tokenized": TOKENIZED_FILE}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def base_paths(processed_data_dir) -> tuple[str, str]:
+    """(file chunk, file token) của corpus gốc hiện hành: thế hệ ghi trong manifest, hoặc output của ingestion."""
+    manifest = _read_manifest(processed_data_dir)
+    return (os.path.join(processed_data_dir, manifest["chunks"]),
+            os.path.join(processed_data_dir, manifest["tokenized"]))
+
+
+def _write_durably(path, write):
+    with open(path, 'w', encoding='utf-8') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def compact(processed_data_dir, chunks, tokenized_chunks, log_path):
+    """
+    Ghi corpus (đã gồm các cập nhật) thành thế hệ mới, đổi manifest sang thế hệ đó bằng một os.replace,
+    rồi mới xóa log và thế hệ cũ. Dừng trước khi đổi manifest thì corpus cũ + log vẫn nguyên vẹn; dừng sau đó
+    thì log còn lại được áp dụng lên thế hệ mới mà không đổi kết quả (mỗi mục ghi đè/xóa trọn một văn bản).
+    """
+    previous = _read_manifest(processed_data_dir)
+    generation = previous["generation"] + 1
+    manifest = {
+        "generation": generation,
+        "chunks": CHUNKS_FILE.replace(".jsonl", f".{generation}.jsonl"),
+        "tokenized": TOKENIZED_FILE.replace(".json", f".{generation}.json"),
+    }
+    _write_durably(os.path.join(processed_data_dir, manifest["chunks"]),
+                   lambda f: f.writelines(json.dumps(chunk, ensure_ascii=False) + "\n" for chunk in chunks))
+    _write_durably(os.path.join(processed_data_dir, manifest["tokenized"]),
+                   lambda f: json.dump(tokenized_chunks, f, ensure_ascii=False))
+
+    manifest_path = os.path.join(processed_data_dir, BASE_MANIFEST_FILE)
+    _write_durably(manifest_path + ".tmp", lambda f: json.dump(manifest, f))
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    os.remove(log_path)
+    # Output gốc của ingestion được giữ lại (embedding/vector index được xây từ đó)
+    if previous["generation"]:
+        for name in (previous["chunks"], previous["tokenized"]):
+            path = os.path.join(processed_data_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
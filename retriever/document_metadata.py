@@ -0,0 +1,230 @@
+# retriever/document_metadata.py
+
+import os
+import re
+import json
+from collections import defaultdict
+
+from core.text_search import strip_diacritics
+
+# Loại văn bản suy ra từ phần ký hiệu của doc_id (vd. "100/2019/nđ-cp" -> nghi_dinh)
+_TYPE_BY_CODE_PREFIX = [
+    ("ttlt", "thong_tu_lien_tich"),
+    ("qh", "luat"),
+    ("nd", "nghi_dinh"),
+    ("tt", "thong_tu"),
+    ("qd", "quyet_dinh"),
+    ("nq", "nghi_quyet"),
+    ("pl", "phap_lenh"),
+    ("ct", "chi_thi"),
+]
+
+# Cách gọi loại văn bản trong câu hỏi (đã bỏ dấu)
+_TYPE_BY_NAME = {
+    "bo luat": "luat",
+    "luat": "luat",
+    "nghi dinh": "nghi_dinh",
+    "thong tu lien tich": "thong_tu_lien_tich",
+    "thong tu": "thong_tu",
+    "quyet dinh": "quyet_dinh",
+    "nghi quyet": "nghi_quyet",
+    "phap lenh": "phap_lenh",
+    "chi thi": "chi_thi",
+}
+
+# Lĩnh vực theo cơ quan ban hành (phần sau dấu "-" trong ký hiệu)
+DOMAIN_BY_ISSUER = {
+    "bldtbxh": "lao_dong", "btc": "tai_chinh", "bca": "an_ninh_trat_tu", "bgtvt": "giao_thong",
+    "byt": "y_te", "bgddt": "giao_duc", "btp": "tu_phap", "bxd": "xay_dung", "bct": "cong_thuong",
+    "bnnptnt": "nong_nghiep", "btnmt": "tai_nguyen_moi_truong", "bqp": "quoc_phong",
+    "bkhdt": "dau_tu", "btttt": "thong_tin_truyen_thong", "nhnn": "ngan_hang", "bnv": "noi_vu",
+}
+
+# Tên gọi quen thuộc của các bộ luật/luật -> (doc_id, lĩnh vực). Chỉ những doc_id có trong corpus
+# mới được dùng; có thể bổ sung bằng file `document_aliases.json` trong thư mục dữ liệu.
+DEFAULT_ALIASES = {
+    "bo luat lao dong": [("45/2019/qh14", "lao_dong"), ("10/2012/qh13", "lao_dong")],
+    "luat lao dong": [("45/2019/qh14", "lao_dong"), ("10/2012/qh13", "lao_dong")],
+    "bo luat dan su": [("91/2015/qh13", "dan_su")],
+    "bo luat hinh su": [("100/2015/qh13", "hinh_su")],
+    "bo luat to tung dan su": [("92/2015/qh13", "dan_su")],
+    "bo luat to tung hinh su": [("101/2015/qh13", "hinh_su")],
+    "luat hon nhan va gia dinh": [("52/2014/qh13", "hon_nhan_gia_dinh")],
+    "luat hon nhan gia dinh": [("52/2014/qh13", "hon_nhan_gia_dinh")],
+    "luat dat dai": [("45/2013/qh13", "dat_dai")],
+    "luat doanh nghiep": [("59/2020/qh14", "doanh_nghiep"), ("68/2014/qh13", "doanh_nghiep")],
+    "luat dau tu": [("61/2020/qh14", "dau_tu")],
+    "luat bao hiem xa hoi": [("58/2014/qh13", "lao_dong")],
+    "luat bao hiem y te": [("25/2008/qh12", "y_te")],
+    "luat giao thong duong bo": [("23/2008/qh12", "giao_thong")],
+    "luat cu tru": [("68/2020/qh14", "an_ninh_trat_tu")],
+    "luat nha o": [("65/2014/qh13", "xay_dung")],
+    "luat giao duc": [("43/2019/qh14", "giao_duc")],
+    "luat thue thu nhap ca nhan": [("04/2007/qh12", "tai_chinh")],
+    "luat xu ly vi pham hanh chinh": [("15/2012/qh13", "hanh_chinh")],
+}
+ALIASES_FILE = "document_aliases.json"
+
+_DOC_ID_RE = re.compile(r"^0*(\d+)/(\d{4})/([a-z0-9]+(?:-[a-z0-9]+)*)$")
+_CODE_IN_QUERY_RE = re.compile(r"\b0*(\d{1,4})/(\d{4})/([a-z0-9]+(?:-[a-z0-9]+)*)\b")
+_TYPE_NUMBER_RE = re.compile(
+    r"\b(" + "|".join(sorted(_TYPE_BY_NAME, key=len, reverse=True)) + r")\s+(?:so\s+)?0*(\d{1,4})(?:/(\d{4}))?\b"
+)
+_YEAR_RE = re.compile(r"\b(?:nam\s+)?((?:19|20)\d{2})\b")
+
+
+def normalize_doc_id(doc_id: str) -> str:
+    return strip_diacritics(doc_id.strip().lower())
+
+
+def parse_doc_id(doc_id: str) -> dict:
+    """Tách số hiệu, năm, loại văn bản và cơ quan ban hành từ doc_id dạng "100/2019/nđ-cp"."""
+    match = _DOC_ID_RE.match(normalize_doc_id(doc_id))
+    if not match:
+        return {"doc_id": doc_id, "number": None, "year": None, "doc_type": "khac", "issuer": None}
+    number, year, code = match.groups()
+    prefix, _, issuer = code.partition("-")
+    doc_type = next((t for p, t in _TYPE_BY_CODE_PREFIX if prefix.startswith(p)), "khac")
+    return {"doc_id": doc_id, "number": number, "year": int(year), "doc_type": doc_type, "issuer": issuer or None}
+
+
+class DocumentFilter:
+    """
+    Bộ lọc theo văn bản: trong cùng một trường là OR, giữa các trường là AND.
+    Ví dụ DocumentFilter(doc_types=["nghi_dinh"], years=[2019, 2020]).
+    """
+
+    FIELDS = ("doc_ids", "doc_types", "years", "domains")
+
+    def __init__(self, doc_ids=None, doc_types=None, years=None, domains=None, detected=False):
+        self.doc_ids = list(doc_ids) if doc_ids else None
+        self.doc_types = list(doc_types) if doc_types else None
+        self.years = [int(y) for y in years] if years else None
+        self.domains = list(domains) if domains else None
+        self.detected = detected
+
+    @classmethod
+    def from_dict(cls, data: dict | None):
+        if not data:
+            return None
+        document_filter = cls(**{field: data.get(field) for field in cls.FIELDS})
+        return document_filter if not document_filter.is_empty() else None
+
+    def is_empty(self) -> bool:
+        return not any(getattr(self, field) for field in self.FIELDS)
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={getattr(self, field)}" for field in self.FIELDS if getattr(self, field))
+        return f"DocumentFilter({fields}{', detected' if self.detected else ''})"
+
+
+class DocumentCatalog:
+    """
+    Chỉ mục metadata của các văn bản trong một snapshot: doc_id -> loại, số hiệu, năm, lĩnh vực,
+    cùng các bảng tra ngược dùng để giải bộ lọc và nhận diện văn bản được nhắc tới trong câu hỏi.
+    """
+
+    def __init__(self, doc_ids, aliases: dict | None = None):
+        self.documents = {}
+        self.by_code = {}
+        self.by_type = defaultdict(set)
+        self.by_year = defaultdict(set)
+        self.by_domain = defaultdict(set)
+        self.by_type_number = defaultdict(set)
+        for doc_id in doc_ids:
+            meta = parse_doc_id(doc_id)
+            meta["domain"] = DOMAIN_BY_ISSUER.get(meta["issuer"] or "")
+            self.documents[doc_id] = meta
+            self.by_code[normalize_doc_id(doc_id)] = doc_id
+            self.by_type[meta["doc_type"]].add(doc_id)
+            if meta["year"] is not None:
+                self.by_year[meta["year"]].add(doc_id)
+                self.by_type_number[(meta["doc_type"], meta["number"])].add(doc_id)
+
+        self.aliases = {}
+        for name, entries in (aliases if aliases is not None else DEFAULT_ALIASES).items():
+            present = set()
+            for doc_id, domain in entries:
+                doc_id = self.by_code.get(normalize_doc_id(doc_id))
+                if doc_id is None:
+                    continue
+                present.add(doc_id)
+                if domain:
+                    self.documents[doc_id]["domain"] = self.documents[doc_id]["domain"] or domain
+            if present:
+                self.aliases[strip_diacritics(name.lower())] = present
+        for doc_id, meta in self.documents.items():
+            if meta["domain"]:
+                self.by_domain[meta["domain"]].add(doc_id)
+        self._alias_re = re.compile(
+            r"\b(" + "|".join(re.escape(name) for name in sorted(self.aliases, key=len, reverse=True)) + r")\b"
+        ) if self.aliases else None
+
+    @staticmethod
+    def load_aliases(processed_data_dir) -> dict:
+        """DEFAULT_ALIASES cộng với alias tùy chỉnh {tên: [[doc_id, lĩnh vực], ...]} nếu có file."""
+        aliases = dict(DEFAULT_ALIASES)
+        path = os.path.join(processed_data_dir, ALIASES_FILE)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for name, entries in json.load(f).items():
+                    aliases[name] = [tuple(entry) for entry in entries]
+        return aliases
+
+    def __len__(self):
+        return len(self.documents)
+
+    def resolve(self, document_filter: DocumentFilter) -> set:
+        """Tập doc_id thỏa bộ lọc."""
+        result = None
+        for values, lookup in (
+            (document_filter.doc_ids, lambda v: {self.by_code[normalize_doc_id(v)]} if normalize_doc_id(v) in self.by_code else set()),
+            (document_filter.doc_types, lambda v: self.by_type.get(v, set())),
+            (document_filter.years, lambda v: self.by_year.get(v, set())),
+            (document_filter.domains, lambda v: self.by_domain.get(v, set())),
+        ):
+            if not values:
+                continue
+            matched = set().union(*(lookup(value) for value in values))
+            result = matched if result is None else result & matched
+        return result if result is not None else set(self.documents)
+
+    def find_documents(self, query: str) -> set | None:
+        """
+        Nhận diện văn bản được nhắc tới trong câu hỏi: ký hiệu đầy đủ ("100/2019/NĐ-CP"),
+        loại + số hiệu ("Nghị định 100", "Thông tư 58/2020") hoặc tên gọi ("Bộ luật Lao động 2019").
+        Trả về None nếu không nhận ra văn bản nào có trong corpus.
+        """
+        text = strip_diacritics(query.lower())
+        found = set()
+        for number, year, code in _CODE_IN_QUERY_RE.findall(text):
+            doc_id = self.by_code.get(f"{number}/{year}/{code}") or self.by_code.get(f"{number.zfill(2)}/{year}/{code}")
+            if doc_id:
+                found.add(doc_id)
+        for name, number, year in _TYPE_NUMBER_RE.findall(text):
+            candidates = self.by_type_number.get((_TYPE_BY_NAME[name], number), set())
+            if year:
+                candidates = {doc_id for doc_id in candidates if self.documents[doc_id]["year"] == int(year)}
+            found |= candidates
+        if self._alias_re is not None:
+            for match in self._alias_re.finditer(text):
+                candidates = self.aliases[match.group(1)]
+                # "Bộ luật Lao động 2019" / "Luật Doanh nghiệp năm 2014": chọn đúng phiên bản nếu có năm
+                year = _YEAR_RE.match(text, match.end() + 1) if match.end() < len(text) else None
+                if year:
+                    versioned = {doc_id for doc_id in candidates if self.documents[doc_id]["year"] == int(year.group(1))}
+                    candidates = versioned or candidates
+                found |= candidates
+        return found or None
+
+    def strip_mentions(self, query: str) -> str:
+        """Câu hỏi (đã bỏ dấu, chữ thường) sau khi bỏ các đoạn nhắc tới văn bản."""
+        text = strip_diacritics(query.lower())
+        for pattern in (_CODE_IN_QUERY_RE, _TYPE_NUMBER_RE, self._alias_re):
+            if pattern is not None:
+                text = pattern.sub(" ", text)
+        return text
+
+    def detect_filter(self, query: str) -> DocumentFilter | None:
+        doc_ids = self.find_documents(query)
+        return DocumentFilter(doc_ids=sorted(doc_ids), detected=True) if doc_ids else None
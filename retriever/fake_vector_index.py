@@ -0,0 +1,120 @@
+# retriever/fake_vector_index.py
+
+import os
+import json
+import time
+import random
+import threading
+
+import numpy as np
+
+from retriever.ingestion import CHUNKS_FILE, EMBEDDINGS_FILE, EMBEDDING_IDS_FILE
+
+
+class FakeVectorIndex:
+    """
+    Vector store giả lập chạy local, cùng giao diện query/upsert/delete như Pinecone Index.
+    Có thể bơm thêm độ trễ, độ trễ đuôi (slow request) và lỗi để kiểm tra timeout, hedging
+    và circuit breaker. Nếu có ma trận embedding từ pipeline ingest thì tìm kiếm thật bằng
+    tích vô hướng, nếu không thì trả về các chunk ngẫu nhiên (ổn định theo vector truy vấn).
+
+    Cấu hình qua biến môi trường khi chạy API với VECTOR_BACKEND=fake:
+      FAKE_VECTOR_LATENCY_MS, FAKE_VECTOR_SLOW_RATE, FAKE_VECTOR_SLOW_MS, FAKE_VECTOR_ERROR_RATE
+    """
+
+    def __init__(self, ids, embeddings=None, latency_ms=20.0, slow_rate=0.0, slow_ms=2000.0,
+                 error_rate=0.0, seed=None, doc_ids=None):
+        self.ids = list(ids)
+        self.embeddings = embeddings
+        self.doc_ids = dict(doc_ids or {})  # chunk_id -> doc_id (metadata dùng cho filter)
+        self.latency_ms = latency_ms
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._deleted = set()
+        self.calls = 0
+
+    @classmethod
+    def from_env(cls, processed_data_dir):
+        ids, embeddings, doc_ids = [], None, {}
+        ids_path = os.path.join(processed_data_dir, EMBEDDING_IDS_FILE)
+        embeddings_path = os.path.join(processed_data_dir, EMBEDDINGS_FILE)
+        with open(os.path.join(processed_data_dir, CHUNKS_FILE), 'r', encoding='utf-8') as f:
+            for line in f:
+                chunk = json.loads(line)
+                doc_ids[chunk['chunk_id']] = chunk['doc_id']
+        if os.path.exists(ids_path) and os.path.exists(embeddings_path):
+            with open(ids_path, 'r', encoding='utf-8') as f:
+                ids = [line.strip() for line in f if line.strip()]
+            embeddings = np.load(embeddings_path, mmap_mode='r')
+        else:
+            ids = list(doc_ids)
+        return cls(
+            ids, embeddings, doc_ids=doc_ids,
+            latency_ms=float(os.getenv("FAKE_VECTOR_LATENCY_MS", "20")),
+            slow_rate=float(os.getenv("FAKE_VECTOR_SLOW_RATE", "0")),
+            slow_ms=float(os.getenv("FAKE_VECTOR_SLOW_MS", "2000")),
+            error_rate=float(os.getenv("FAKE_VECTOR_ERROR_RATE", "0")),
+        )
+
+    def _inject_faults(self):
+        with self._lock:
+            self.calls += 1
+            roll_error = self._rng.random()
+            roll_slow = self._rng.random()
+            jitter = self._rng.lognormvariate(0, 0.3)
+        delay = self.latency_ms * jitter
+        if roll_slow < self.slow_rate:
+            delay = self.slow_ms
+        time.sleep(delay / 1000)
+        if roll_error < self.error_rate:
+            raise ConnectionError("fake vector index: injected error")
+
+    def _matches_filter(self, chunk_id, filter):
+        """Hỗ trợ tập con cú pháp filter của Pinecone trên trường doc_id: giá trị, $eq, $in."""
+        if not filter or "doc_id" not in filter:
+            return True
+        condition = filter["doc_id"]
+        doc_id = self.doc_ids.get(chunk_id)
+        if isinstance(condition, dict):
+            if "$in" in condition:
+                return doc_id in condition["$in"]
+            return doc_id == condition.get("$eq")
+        return doc_id == condition
+
+    def query(self, vector, top_k, filter=None, **kwargs):
+        self._inject_faults()
+        if filter and "doc_id" in filter and isinstance(filter["doc_id"], dict) and "$in" in filter["doc_id"]:
+            filter = {"doc_id": {"$in": set(filter["doc_id"]["$in"])}}
+        if self.embeddings is not None and len(self.ids):
+            scores = np.asarray(self.embeddings) @ np.asarray(vector, dtype=np.float32)
+            ranked = (i for i in np.argsort(-scores) if i < len(self.ids) and self.ids[i] not in self._deleted
+                      and self._matches_filter(self.ids[i], filter))
+            matches = [{"id": self.ids[i], "score": float(scores[i])} for _, i in zip(range(top_k), ranked)]
+        else:
+            live_ids = [cid for cid in self.ids if cid not in self._deleted and self._matches_filter(cid, filter)]
+            rng = random.Random(hash(tuple(round(v, 4) for v in vector[:8])))
+            chosen = rng.sample(live_ids, min(top_k, len(live_ids)))
+            matches = [{"id": cid, "score": 1.0 - rank / max(1, top_k)} for rank, cid in enumerate(chosen)]
+        return {"matches": matches}
+
+    def upsert(self, vectors, **kwargs):
+        self._inject_faults()
+        with self._lock:
+            known = set(self.ids)
+            for v in vectors:
+                self._deleted.discard(v["id"])
+                if v.get("metadata", {}).get("doc_id"):
+                    self.doc_ids[v["id"]] = v["metadata"]["doc_id"]
+                if v["id"] not in known:
+                    self.ids.append(v["id"])
+        # Ma trận embedding (nếu có) là bản chỉ đọc; vector mới chỉ được thêm vào danh sách id
+        return {"upserted_count": len(vectors)}
+
+    def delete(self, ids, **kwargs):
+        self._inject_faults()
+        with self._lock:
+            self._deleted.update(ids)
+        return {}
@@ -0,0 +1,364 @@
+# retriever/inference_pool.py
+"""
+Chạy embedding model và reranker trong một pool process riêng để tận dụng nhiều core CPU:
+mỗi process được gắn (affinity) vào một nhóm core và có số thread torch riêng, nên các request
+đồng thời không còn xếp hàng trên GIL và một intra-op pool duy nhất của process API.
+
+Văn bản đầu vào và kết quả (điểm rerank, embedding) đi qua các buffer shared memory của từng
+worker; Pipe chỉ mang các lệnh nhỏ. Một batch rerank lớn được chia thành nhiều phần chạy song song.
+
+Bật bằng biến môi trường INFERENCE_WORKERS (mặc định 0 = chạy model ngay trong process API).
+"""
+
+import os
+import time
+import queue
+import atexit
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import numpy as np
+
+from core import metrics
+from core.cancellation import check_cancelled
+
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "0"))
+# Số thread torch mỗi worker; mặc định chia đều các core được phép dùng
+INFERENCE_THREADS_PER_WORKER = int(os.getenv("INFERENCE_THREADS_PER_WORKER", "0"))
+# Không chia batch rerank thành các phần nhỏ hơn số cặp này (chi phí điều phối lớn hơn lợi ích)
+RERANK_MIN_SHARD = int(os.getenv("RERANK_MIN_SHARD", "4"))
+ENCODE_MIN_SHARD = 16
+WORKER_STARTUP_TIMEOUT = 300
+# Một lệnh encode/rerank chạy quá thời gian này thì coi worker bị treo: kill, khởi động lại và báo lỗi
+INFERENCE_CALL_TIMEOUT = float(os.getenv("INFERENCE_CALL_TIMEOUT", "120"))
+_INITIAL_INPUT_BYTES = 1 << 20
+_INITIAL_OUTPUT_BYTES = 1 << 20
+_POLL_INTERVAL = 0.05
+
+
+class InferenceError(RuntimeError):
+    """Worker inference lỗi hoặc bị dừng bất thường."""
+
+
+# --- Trong process worker ---
+def _attach(cache: dict, role: str, name: str):
+    """Gắn vào buffer shared memory do process cha tạo (đổi buffer khi cha cấp phát lại buffer lớn hơn)."""
+    current = cache.get(role)
+    if current is not None and current.name == name:
+        return current
+    if current is not None:
+        current.close()
+    # Worker dùng chung resource tracker với process cha (spawn), cha chịu trách nhiệm unlink
+    shm = shared_memory.SharedMemory(name=name)
+    cache[role] = shm
+    return shm
+
+
+def _unpack_texts(buf, count: int) -> list[str]:
+    offsets = np.ndarray((count + 1,), dtype=np.int64, buffer=buf)
+    base = 8 * (count + 1)
+    data = bytes(buf[base:base + int(offsets[-1])])
+    texts = [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(count)]
+    del offsets
+    return texts
+
+
+def load_models(embedding_model_path, reranker_model_path, threads):
+    """Load model trong worker, trả về (encode(texts), rerank(pairs), số chiều embedding)."""
+    # Phải đặt trước khi import torch để OpenMP/MKL không tự mở thread theo số core của máy
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["MKL_NUM_THREADS"] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+    from sentence_transformers import SentenceTransformer, CrossEncoder
+
+    embedding_model = SentenceTransformer(embedding_model_path, device='cpu') if embedding_model_path else None
+    reranker_model = CrossEncoder(reranker_model_path, device='cpu') if reranker_model_path else None
+    dim = embedding_model.get_sentence_embedding_dimension() if embedding_model is not None else 0
+
+    def encode(texts):
+        with torch.inference_mode():
+            return embedding_model.encode(texts, batch_size=64, show_progress_bar=False)
+
+    def rerank(pairs):
+        with torch.inference_mode():
+            return reranker_model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)
+
+    return encode, rerank, dim
+
+
+def _worker_main(conn, model_loader, embedding_model_path, reranker_model_path, cores, threads):
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    encode, rerank, dim = model_loader(embedding_model_path, reranker_model_path, threads)
+    conn.send(("ready", dim))
+
+    buffers = {}
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            op, input_name, output_name, count = message
+            try:
+                started = time.perf_counter()
+                texts = _unpack_texts(_attach(buffers, "input", input_name).buf, count)
+                output = _attach(buffers, "output", output_name)
+                if op == "rerank":
+                    result = rerank(list(zip(texts[0::2], texts[1::2])))
+                else:
+                    result = encode(texts)
+                result = np.asarray(result, dtype=np.float32)
+                view = np.ndarray(result.shape, dtype=np.float32, buffer=output.buf)
+                view[...] = result
+                del view
+                conn.send(("ok", time.perf_counter() - started))
+            except Exception as e:
+                conn.send(("error", f"{type(e).__name__}: {e}"))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        for shm in buffers.values():
+            shm.close()
+
+
+# --- Trong process API ---
+class _SharedBuffer:
+    """Buffer shared memory do process cha sở hữu, cấp phát lại (gấp đôi) khi không đủ chỗ."""
+
+    def __init__(self, size: int):
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def ensure(self, size: int):
+        if size <= self.shm.size:
+            return
+        self.release()
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 2 * self.shm.size))
+
+    def release(self):
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class _Worker:
+    def __init__(self, ctx, index, model_loader, embedding_model_path, reranker_model_path, cores, threads,
+                 call_timeout=INFERENCE_CALL_TIMEOUT):
+        self.ctx = ctx
+        self.index = index
+        self.args = (model_loader, embedding_model_path, reranker_model_path, cores, threads)
+        self.cores = cores
+        self.threads = threads
+        self.call_timeout = call_timeout
+        self.input = _SharedBuffer(_INITIAL_INPUT_BYTES)
+        self.output = _SharedBuffer(_INITIAL_OUTPUT_BYTES)
+        self.dim = 0
+        # False khi worker chết/treo mà chưa khởi động lại được; lần dùng tới sẽ thử khởi động lại
+        self.healthy = False
+        self.start()
+
+    def start(self):
+        self.conn, child_conn = self.ctx.Pipe()
+        self.process = self.ctx.Process(target=_worker_main, args=(child_conn, *self.args),
+                                        name=f"inference-worker-{self.index}", daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def wait_ready(self, timeout=WORKER_STARTUP_TIMEOUT):
+        try:
+            if not self.conn.poll(timeout):
+                raise InferenceError(f"inference worker {self.index} không khởi động kịp trong {timeout}s")
+            status, self.dim = self.conn.recv()
+        except (EOFError, OSError) as e:
+            raise InferenceError(f"inference worker {self.index} dừng khi đang khởi động "
+                                 f"(exit code {self.process.exitcode})") from e
+        self.healthy = True
+
+    def restart(self):
+        metrics.inc("inference_worker_restarts_total")
+        self.healthy = False
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+        self.start()
+        self.wait_ready()
+
+    def _receive(self):
+        """Chờ kết quả của lệnh vừa gửi; raise EOFError nếu worker đã thoát, TimeoutError nếu bị treo."""
+        deadline = time.monotonic() + self.call_timeout
+        while not self.conn.poll(_POLL_INTERVAL):
+            if not self.process.is_alive():
+                raise EOFError(f"exit code {self.process.exitcode}")
+            if time.monotonic() > deadline:
+                metrics.inc("inference_worker_timeouts_total")
+                raise TimeoutError(f"không trả kết quả sau {self.call_timeout}s")
+        return self.conn.recv()
+
+    def run(self, op: str, texts: list[str], shape: tuple) -> np.ndarray:
+        if not self.healthy:
+            self.restart()
+        encoded = [text.encode("utf-8") for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(data) for data in encoded], out=offsets[1:])
+        header = 8 * len(offsets)
+        self.input.ensure(header + int(offsets[-1]))
+        self.output.ensure(4 * int(np.prod(shape)))
+        self.input.shm.buf[:header] = offsets.tobytes()
+        self.input.shm.buf[header:header + int(offsets[-1])] = b"".join(encoded)
+
+        try:
+            self.conn.send((op, self.input.name, self.output.name, len(texts)))
+            status, detail = self._receive()
+        except (EOFError, OSError) as e:
+            # Gồm cả TimeoutError: worker bị kill và khởi động lại, request này báo lỗi
+            self.restart()
+            raise InferenceError(f"inference worker {self.index} dừng bất thường: {e}") from e
+        if status != "ok":
+            raise InferenceError(detail)
+        metrics.inc(f"inference_{op}_seconds_total", detail)
+        view = np.ndarray(shape, dtype=np.float32, buffer=self.output.shm.buf)
+        result = view.copy()
+        del view
+        return result
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+        self.input.release()
+        self.output.release()
+
+
+def _core_slices(workers: int, threads_per_worker: int) -> list:
+    """Chia các core process được phép dùng thành từng nhóm liền nhau; không pin nếu không đủ core."""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    if workers * threads_per_worker > len(cores):
+        return [None] * workers
+    return [cores[i * threads_per_worker:(i + 1) * threads_per_worker] for i in range(workers)]
+
+
+class InferencePool:
+    """
+    Pool process chạy embedding model và reranker trên CPU.
+    `rerank(pairs)` và `encode(texts)` an toàn khi gọi từ nhiều thread: mỗi phần của batch
+    chờ một worker rảnh, nên nhiều request đồng thời chia sẻ toàn bộ các worker.
+    """
+
+    def __init__(self, embedding_model_path, reranker_model_path, workers: int = INFERENCE_WORKERS,
+                 threads_per_worker: int = INFERENCE_THREADS_PER_WORKER, rerank_min_shard: int = RERANK_MIN_SHARD,
+                 call_timeout: float = INFERENCE_CALL_TIMEOUT, model_loader=load_models):
+        if workers < 1:
+            raise ValueError("workers phải >= 1")
+        if threads_per_worker < 1:
+            available = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+            threads_per_worker = max(1, available // workers)
+        self.rerank_min_shard = max(1, rerank_min_shard)
+        # "spawn": fork một process đã load torch (và có thread nền) không an toàn
+        ctx = multiprocessing.get_context("spawn")
+        self._workers = [
+            _Worker(ctx, i, model_loader, embedding_model_path, reranker_model_path, cores, threads_per_worker,
+                    call_timeout)
+            for i, cores in enumerate(_core_slices(workers, threads_per_worker))
+        ]
+        try:
+            for worker in self._workers:
+                worker.wait_ready()
+        except InferenceError:
+            for worker in self._workers:
+                worker.close()
+            raise
+        self.embedding_dim = self._workers[0].dim
+        self._idle = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+        self._dispatcher = ThreadPoolExecutor(max_workers=workers * 4, thread_name_prefix="inference-dispatch")
+        self._closed = False
+        self._close_lock = threading.Lock()
+        metrics.set_gauge("inference_workers", workers)
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self._workers)
+
+    def describe(self) -> list[dict]:
+        return [{"pid": w.process.pid, "cores": w.cores, "threads": w.threads} for w in self._workers]
+
+    def _run(self, op, texts, shape):
+        started = time.perf_counter()
+        worker = self._idle.get()
+        metrics.inc("inference_queue_wait_seconds_total", time.perf_counter() - started)
+        try:
+            return worker.run(op, texts, shape)
+        finally:
+            self._idle.put(worker)
+
+    def _map(self, op, shards, should_cancel):
+        futures = [self._dispatcher.submit(self._run, op, texts, shape) for texts, shape in shards]
+        results = []
+        try:
+            for future in futures:
+                while True:
+                    check_cancelled(should_cancel)
+                    try:
+                        results.append(future.result(timeout=_POLL_INTERVAL if should_cancel else None))
+                        break
+                    except FutureTimeoutError:
+                        continue
+        except BaseException:
+            # Các phần chưa được gửi tới worker thì bỏ luôn
+            for future in futures:
+                future.cancel()
+            raise
+        return results
+
+    @staticmethod
+    def _split(count: int, parts: int) -> list[tuple[int, int]]:
+        bounds = np.linspace(0, count, parts + 1).astype(int)
+        return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    def rerank(self, pairs, should_cancel=None) -> np.ndarray:
+        """Điểm cross-encoder cho các cặp (câu hỏi, văn bản); batch lớn được chia cho nhiều worker."""
+        if not len(pairs):
+            return np.zeros(0, dtype=np.float32)
+        parts = min(len(self._workers), max(1, len(pairs) // self.rerank_min_shard))
+        shards = [
+            ([text for pair in pairs[start:end] for text in pair], (end - start,))
+            for start, end in self._split(len(pairs), parts)
+        ]
+        metrics.inc("inference_rerank_pairs_total", len(pairs))
+        return np.concatenate(self._map("rerank", shards, should_cancel))
+
+    def encode(self, texts, should_cancel=None) -> np.ndarray:
+        """Embedding (float32, shape (n, dim)) cho danh sách văn bản."""
+        if not len(texts):
+            return np.zeros((0, self.embedding_dim), dtype=np.float32)
+        parts = min(len(self._workers), max(1, len(texts) // ENCODE_MIN_SHARD))
+        shards = [(list(texts[start:end]), (end - start, self.embedding_dim))
+                  for start, end in self._split(len(texts), parts)]
+        return np.concatenate(self._map("encode", shards, should_cancel))
+
+    def close(self):
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._dispatcher.shutdown(wait=False, cancel_futures=True)
+        for worker in self._workers:
+            worker.close()
@@ -0,0 +1,356 @@
+# retriever/ingestion.py
+"""
+Pipeline ingest corpus luật dạng streaming, tạo ra toàn bộ artifact cho RetrievalSystem:
+  - legal_corpus_chunks.jsonl            (chunk store)
+  - legal_corpus_chunks_tokenized.json   (token cho BM25)
+  - legal_corpus_embeddings.npy + legal_corpus_embedding_ids.txt (ma trận embedding)
+  - (tùy chọn) upsert vector lên Pinecone
+
+Cách chạy:
+    python -m retriever.ingestion --input data/raw/legal_corpus.json --workers 8 --upsert-pinecone
+Chạy lại cùng lệnh sẽ tiếp tục từ checkpoint cuối cùng.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from collections import deque, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+CHUNKS_FILE = "legal_corpus_chunks.jsonl"
+TOKENIZED_FILE = "legal_corpus_chunks_tokenized.json"
+TOKENIZED_PARTIAL_FILE = "legal_corpus_chunks_tokenized.jsonl"
+EMBEDDINGS_FILE = "legal_corpus_embeddings.npy"
+EMBEDDING_IDS_FILE = "legal_corpus_embedding_ids.txt"
+EMBEDDING_PARTS_DIR = "embedding_parts"
+CHECKPOINT_FILE = "ingest_checkpoint.json"
+# Manifest trỏ tới corpus gốc đã gộp các cập nhật qua API (xem retriever/corpus_updates.py)
+BASE_MANIFEST_FILE = "corpus_base.json"
+
+
+# --- Đọc dữ liệu thô dạng streaming ---
+def _iter_json_array(path, buffer_size=1 << 20):
+    """Đọc lần lượt từng phần tử của một mảng JSON lớn mà không load cả file vào RAM."""
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ""
+        started = False
+        eof = False
+        while True:
+            buffer = buffer.lstrip(" \t\r\n,")
+            if not started:
+                if not buffer and not eof:
+                    chunk = f.read(buffer_size)
+                    eof = not chunk
+                    buffer += chunk
+                    continue
+                if not buffer.startswith("["):
+                    raise ValueError(f"{path} không phải là một mảng JSON")
+                buffer = buffer[1:]
+                started = True
+                continue
+            if buffer.startswith("]"):
+                return
+            try:
+                obj, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(buffer_size)
+                eof = not chunk
+                buffer += chunk
+                continue
+            yield obj
+            buffer = buffer[end:]
+
+
+def iter_raw_documents(path):
+    """Hỗ trợ .jsonl (mỗi dòng một văn bản) và .json (mảng văn bản, ví dụ legal_corpus.json của Zalo)."""
+    if path.endswith(".jsonl"):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        yield from _iter_json_array(path)
+
+
+# --- Chia chunk ---
+def chunk_document(document, max_words=256, overlap_words=32):
+    """
+    Chia một văn bản thành các chunk. Văn bản dạng Zalo có `law_id` và `articles`;
+    văn bản đơn giản có `doc_id` và `text`.
+    """
+    doc_id = document.get("doc_id") or document.get("law_id")
+    if "articles" in document:
+        sections = [
+            (str(article.get("article_id")), "\n".join(filter(None, [article.get("title"), article.get("text")])))
+            for article in document["articles"]
+        ]
+    else:
+        sections = [("0", document.get("text", ""))]
+
+    chunks = []
+    step = max(1, max_words - overlap_words)
+    for section_id, text in sections:
+        words = text.split()
+        if not words:
+            continue
+        for part, start in enumerate(range(0, max(1, len(words) - overlap_words), step)):
+            chunks.append({
+                "chunk_id": f"{doc_id}_{section_id}_{part}",
+                "doc_id": doc_id,
+                "text": " ".join(words[start:start + max_words]),
+            })
+    return chunks
+
+
+def _tokenize_batch(texts):
+    """Chạy trong process con: tokenize bằng pyvi, trả về token và thời gian xử lý."""
+    from pyvi import ViTokenizer
+    start = time.perf_counter()
+    tokens = [ViTokenizer.tokenize(text).split() for text in texts]
+    return tokens, time.perf_counter() - start
+
+
+def load_encoder(embedding_model_path):
+    """Load model embedding, trả về encode(texts) -> ma trận (n, dim)."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = SentenceTransformer(embedding_model_path, device=device)
+    return lambda texts: model.encode(texts, batch_size=64, show_progress_bar=False)
+
+
+# --- Checkpoint ---
+class Checkpoint:
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, CHECKPOINT_FILE)
+        self.state = {"docs_done": 0, "chunks_done": 0, "next_part": 0,
+                      "chunks_offset": 0, "tokens_offset": 0, "finalized": False}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.state.update(json.load(f))
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+
+class StageStats:
+    """Đo thời gian và số phần tử xử lý ở từng stage để báo cáo throughput."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.items = defaultdict(int)
+
+    def add(self, stage, seconds, items):
+        self.seconds[stage] += seconds
+        self.items[stage] += items
+
+    def report(self, wall_seconds):
+        lines = [f"{'stage':<10}{'items':>10}{'busy (s)':>12}{'items/s':>12}"]
+        for stage in self.seconds:
+            rate = self.items[stage] / self.seconds[stage] if self.seconds[stage] else float('inf')
+            lines.append(f"{stage:<10}{self.items[stage]:>10}{self.seconds[stage]:>12.1f}{rate:>12.1f}")
+        lines.append(f"wall time: {wall_seconds:.1f}s")
+        return "\n".join(lines)
+
+
+class IngestionPipeline:
+    def __init__(self, input_path, output_dir, embedding_model_path, workers=None, batch_size=256,
+                 max_words=256, overlap_words=32, upsert_pinecone=False, index_name=None,
+                 encoder_loader=load_encoder, tokenize_fn=_tokenize_batch):
+        # tokenize_fn chạy trong process con nên phải là hàm cấp module (pickle được)
+        self.input_path = input_path
+        self.output_dir = output_dir
+        self.embedding_model_path = embedding_model_path
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.batch_size = batch_size
+        self.max_words = max_words
+        self.overlap_words = overlap_words
+        self.upsert_pinecone = upsert_pinecone
+        self.index_name = index_name
+        self.encoder_loader = encoder_loader
+        self.tokenize_fn = tokenize_fn
+        self.stats = StageStats()
+        os.makedirs(os.path.join(output_dir, EMBEDDING_PARTS_DIR), exist_ok=True)
+        self.checkpoint = Checkpoint(output_dir)
+
+    def _path(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def _iter_batches(self):
+        """Gom các văn bản (chưa xử lý) thành các batch khoảng batch_size chunk."""
+        batch, docs_in_batch = [], 0
+        read_start = time.perf_counter()
+        for doc_no, document in enumerate(iter_raw_documents(self.input_path)):
+            if doc_no < self.checkpoint.state["docs_done"]:
+                continue
+            chunk_start = time.perf_counter()
+            chunks = chunk_document(document, self.max_words, self.overlap_words)
+            self.stats.add("chunk", time.perf_counter() - chunk_start, len(chunks))
+            batch.extend(chunks)
+            docs_in_batch += 1
+            if len(batch) >= self.batch_size:
+                self.stats.add("read", time.perf_counter() - read_start, docs_in_batch)
+                yield batch, docs_in_batch
+                batch, docs_in_batch = [], 0
+                read_start = time.perf_counter()
+        if batch or docs_in_batch:
+            self.stats.add("read", time.perf_counter() - read_start, docs_in_batch)
+            yield batch, docs_in_batch
+
+    def _truncate_partial_outputs(self):
+        """Bỏ phần ghi dở của lần chạy trước (sau checkpoint cuối)."""
+        state = self.checkpoint.state
+        for name, offset_key in [(CHUNKS_FILE, "chunks_offset"), (TOKENIZED_PARTIAL_FILE, "tokens_offset")]:
+            path = self._path(name)
+            if os.path.exists(path):
+                with open(path, 'r+b') as f:
+                    f.truncate(state[offset_key])
+        parts_dir = self._path(EMBEDDING_PARTS_DIR)
+        for name in os.listdir(parts_dir):
+            if name.endswith(".npy") and int(name.split("-")[1].split(".")[0]) >= state["next_part"]:
+                os.remove(os.path.join(parts_dir, name))
+
+    def run(self):
+        if self.checkpoint.state["finalized"]:
+            print("Ingestion đã hoàn tất trước đó. Xóa ingest_checkpoint.json để chạy lại từ đầu.")
+            return
+
+        encode = self.encoder_loader(self.embedding_model_path)
+        index = None
+        if self.upsert_pinecone:
+            from pinecone import Pinecone
+            index = Pinecone(api_key=os.getenv("PINECONE_API_KEY")).Index(self.index_name)
+
+        self._truncate_partial_outputs()
+        wall_start = time.perf_counter()
+        print(f"Ingest {self.input_path} với {self.workers} process tokenize, "
+              f"tiếp tục từ văn bản #{self.checkpoint.state['docs_done']}")
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool, \
+                open(self._path(CHUNKS_FILE), 'a', encoding='utf-8') as chunks_out, \
+                open(self._path(TOKENIZED_PARTIAL_FILE), 'a', encoding='utf-8') as tokens_out:
+            # Giới hạn số batch đang xử lý để bộ nhớ không tăng theo kích thước corpus
+            in_flight = deque()
+            max_in_flight = self.workers * 2
+            for batch, docs_in_batch in self._iter_batches():
+                in_flight.append((batch, docs_in_batch, pool.submit(self.tokenize_fn, [c["text"] for c in batch])))
+                if len(in_flight) >= max_in_flight:
+                    self._finish_batch(*in_flight.popleft(), encode, index, chunks_out, tokens_out)
+            while in_flight:
+                self._finish_batch(*in_flight.popleft(), encode, index, chunks_out, tokens_out)
+
+        self._finalize()
+        print(self.stats.report(time.perf_counter() - wall_start))
+
+    def _finish_batch(self, batch, docs_in_batch, future, encode, index, chunks_out, tokens_out):
+        tokens, tokenize_seconds = future.result()
+        self.stats.add("tokenize", tokenize_seconds, len(batch))
+
+        embed_start = time.perf_counter()
+        embeddings = encode([c["text"] for c in batch]) if batch else np.zeros((0, 0), dtype=np.float32)
+        self.stats.add("embed", time.perf_counter() - embed_start, len(batch))
+
+        write_start = time.perf_counter()
+        state = self.checkpoint.state
+        part_path = os.path.join(self._path(EMBEDDING_PARTS_DIR), f"part-{state['next_part']:05d}.npy")
+        np.save(part_path, np.asarray(embeddings, dtype=np.float32))
+        for chunk, chunk_tokens in zip(batch, tokens):
+            chunks_out.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+            tokens_out.write(json.dumps(chunk_tokens, ensure_ascii=False) + "\n")
+        chunks_out.flush()
+        tokens_out.flush()
+        self.stats.add("write", time.perf_counter() - write_start, len(batch))
+
+        if index is not None and batch:
+            upsert_start = time.perf_counter()
+            vectors = [{"id": c["chunk_id"], "values": e.tolist(), "metadata": {"doc_id": c["doc_id"]}}
+                       for c, e in zip(batch, embeddings)]
+            for start in range(0, len(vectors), 100):
+                index.upsert(vectors=vectors[start:start + 100])
+            self.stats.add("upsert", time.perf_counter() - upsert_start, len(batch))
+
+        state["docs_done"] += docs_in_batch
+        state["chunks_done"] += len(batch)
+        state["next_part"] += 1
+        state["chunks_offset"] = chunks_out.tell()
+        state["tokens_offset"] = tokens_out.tell()
+        self.checkpoint.save()
+        print(f"  {state['docs_done']} văn bản, {state['chunks_done']} chunk")
+
+    def _finalize(self):
+        """Ghép các phần thành định dạng mà RetrievalSystem đọc, vẫn theo kiểu streaming."""
+        start = time.perf_counter()
+        # Token: jsonl -> một mảng JSON
+        with open(self._path(TOKENIZED_PARTIAL_FILE), 'r', encoding='utf-8') as src, \
+                open(self._path(TOKENIZED_FILE), 'w', encoding='utf-8') as dst:
+            dst.write("[")
+            for i, line in enumerate(src):
+                if i:
+                    dst.write(",\n")
+                dst.write(line.rstrip("\n"))
+            dst.write("]")
+
+        # Embedding: ghép các part vào một file .npy bằng memmap
+        parts_dir = self._path(EMBEDDING_PARTS_DIR)
+        parts = sorted(name for name in os.listdir(parts_dir) if name.endswith(".npy"))
+        shapes = [np.load(os.path.join(parts_dir, name), mmap_mode='r').shape for name in parts]
+        total_rows = sum(shape[0] for shape in shapes)
+        dim = next((shape[1] for shape in shapes if shape[0]), 0)
+        matrix = np.lib.format.open_memmap(self._path(EMBEDDINGS_FILE), mode='w+', dtype=np.float32, shape=(total_rows, dim))
+        row = 0
+        for name, shape in zip(parts, shapes):
+            if shape[0]:
+                matrix[row:row + shape[0]] = np.load(os.path.join(parts_dir, name), mmap_mode='r')
+                row += shape[0]
+        matrix.flush()
+        del matrix
+
+        with open(self._path(CHUNKS_FILE), 'r', encoding='utf-8') as src, \
+                open(self._path(EMBEDDING_IDS_FILE), 'w', encoding='utf-8') as dst:
+            for line in src:
+                dst.write(json.loads(line)["chunk_id"] + "\n")
+
+        # Corpus mới thay cho thế hệ đã gộp trước đó (nếu có)
+        manifest_path = self._path(BASE_MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        self.checkpoint.state["finalized"] = True
+        self.checkpoint.save()
+        self.stats.add("finalize", time.perf_counter() - start, total_rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest corpus luật thành các artifact cho retrieval.")
+    parser.add_argument("--input", required=True, help="File văn bản thô (.json hoặc .jsonl)")
+    parser.add_argument("--output-dir", default="data/processed_data_chunks")
+    parser.add_argument("--embedding-model", default="models/finetuned-e5-base")
+    parser.add_argument("--workers", type=int, default=None, help="Số process tokenize (mặc định: số core - 1)")
+    parser.add_argument("--batch-size", type=int, default=256, help="Số chunk mỗi batch")
+    parser.add_argument("--max-words", type=int, default=256)
+    parser.add_argument("--overlap-words", type=int, default=32)
+    parser.add_argument("--upsert-pinecone", action="store_true")
+    parser.add_argument("--index-name", default="zalo-legal-retrieval-chunked-v2")
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    IngestionPipeline(
+        input_path=args.input, output_dir=args.output_dir, embedding_model_path=args.embedding_model,
+        workers=args.workers, batch_size=args.batch_size, max_words=args.max_words,
+        overlap_words=args.overlap_words, upsert_pinecone=args.upsert_pinecone, index_name=args.index_name,
+    ).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+# retriever/query_normalizer.py
+
+import re
+import math
+import unicodedata
+from collections import defaultdict, Counter
+
+from core.text_search import strip_diacritics
+
+# Tách câu thành: từ (chữ/số), khoảng trắng, và dấu câu
+_TOKEN_RE = re.compile(r"\w+|\s+|[^\w\s]+", re.UNICODE)
+_BOUNDARY = "<s>"
+
+
+def _edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Khoảng cách Damerau-Levenshtein (OSA), dừng sớm khi vượt max_distance."""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if prev2 is not None and i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > max_distance:
+            return max_distance + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+def _deletes(word: str, max_distance: int) -> set:
+    result = set()
+    frontier = {word}
+    for _ in range(max_distance):
+        next_frontier = set()
+        for w in frontier:
+            for i in range(len(w)):
+                next_frontier.add(w[:i] + w[i + 1:])
+        result |= next_frontier
+        frontier = next_frontier
+    return result
+
+
+def _syllables(text: str) -> list:
+    return [s for s in re.split(r"[\W_]+", text.lower()) if s and s.isalpha()]
+
+
+class QueryNormalizer:
+    """
+    Sửa chính tả và khôi phục dấu tiếng Việt cho câu hỏi mà không cần gọi LLM.
+    - Chỉ mục xóa ký tự kiểu SymSpell trên dạng không dấu của các âm tiết.
+    - Mô hình bigram âm tiết + Viterbi để chọn phương án có dấu phù hợp ngữ cảnh.
+    Cả hai đều được xây từ corpus đã tokenize mà RetrievalSystem load sẵn.
+    """
+
+    def __init__(self, max_edit_distance=1, max_candidates=8, edit_penalty=1e-4, interpolation=0.8):
+        self.max_edit_distance = max_edit_distance
+        self.max_candidates = max_candidates
+        self.edit_log_penalty = math.log(edit_penalty)
+        self.interpolation = interpolation
+        self.unigrams = Counter()
+        self.bigrams = Counter()
+        self.total = 0
+        self._variants = {}       # dạng không dấu -> [âm tiết có dấu, ...] theo tần suất giảm dần
+        self._delete_index = {}   # dạng đã xóa ký tự -> {dạng không dấu}
+
+    @classmethod
+    def from_tokenized_corpus(cls, tokenized_chunks, **kwargs):
+        """tokenized_chunks: list các chunk, mỗi chunk là list token của pyvi ("người_lao_động")."""
+        normalizer = cls(**kwargs)
+        for tokens in tokenized_chunks:
+            normalizer._count(_syllables(" ".join(tokens)))
+        normalizer._build_index()
+        return normalizer
+
+    def add_texts(self, texts, weight: int = 1):
+        """Bổ sung văn bản (vd: câu hỏi hội thoại) vào mô hình ngôn ngữ rồi xây lại chỉ mục."""
+        for text in texts:
+            self._count(_syllables(text), weight)
+        self._build_index()
+
+    def _count(self, syllables, weight=1):
+        prev = _BOUNDARY
+        for syl in syllables:
+            self.unigrams[syl] += weight
+            self.bigrams[(prev, syl)] += weight
+            prev = syl
+        self.unigrams[_BOUNDARY] += weight
+        self.total += weight * (len(syllables) + 1)
+
+    def _build_index(self):
+        variants = defaultdict(list)
+        for syl in self.unigrams:
+            if syl != _BOUNDARY:
+                variants[strip_diacritics(syl)].append(syl)
+        self._variants = {
+            key: sorted(values, key=lambda s: -self.unigrams[s]) for key, values in variants.items()
+        }
+        delete_index = defaultdict(set)
+        for key in self._variants:
+            delete_index[key].add(key)
+            for deleted in _deletes(key, self.max_edit_distance):
+                delete_index[deleted].add(key)
+        self._delete_index = dict(delete_index)
+
+    def _candidates(self, syllable: str) -> list:
+        """Trả về [(âm tiết ứng viên, log-penalty)], rỗng nếu không tìm được."""
+        if syllable in self.unigrams:
+            # Người dùng đã gõ đúng một âm tiết có trong từ điển
+            if syllable != strip_diacritics(syllable):
+                return [(syllable, 0.0)]
+        key = strip_diacritics(syllable)
+        if key in self._variants:
+            return [(v, 0.0) for v in self._variants[key][:self.max_candidates]]
+
+        # Lỗi gõ phím: tra chỉ mục xóa ký tự rồi kiểm tra lại khoảng cách thật
+        found = set()
+        for deleted in _deletes(key, self.max_edit_distance) | {key}:
+            found |= self._delete_index.get(deleted, set())
+        scored = []
+        for candidate_key in found:
+            distance = _edit_distance(key, candidate_key, self.max_edit_distance)
+            if distance <= self.max_edit_distance:
+                for v in self._variants[candidate_key][:self.max_candidates]:
+                    scored.append((v, distance * self.edit_log_penalty))
+        # Ít sửa hơn trước, cùng số lần sửa thì âm tiết phổ biến hơn trước (để không bị cắt bởi max_candidates)
+        scored.sort(key=lambda item: (-item[1], -self.unigrams[item[0]]))
+        return scored[:self.max_candidates]
+
+    def _log_prob(self, prev: str, syl: str) -> float:
+        unigram = (self.unigrams[syl] + 0.1) / (self.total + 0.1 * len(self.unigrams))
+        prev_count = self.unigrams[prev]
+        bigram = self.bigrams[(prev, syl)] / prev_count if prev_count else 0.0
+        return math.log(self.interpolation * bigram + (1 - self.interpolation) * unigram)
+
+    def _decode(self, lattice: list) -> list:
+        """Viterbi trên lưới ứng viên của một đoạn âm tiết liên tiếp."""
+        beams = {_BOUNDARY: (0.0, [])}
+        for candidates in lattice:
+            new_beams = {}
+            for syl, penalty in candidates:
+                best = None
+                for prev, (score, path) in beams.items():
+                    total = score + self._log_prob(prev, syl) + penalty
+                    if best is None or total > best[0]:
+                        best = (total, path + [syl])
+                new_beams[syl] = best
+            beams = new_beams
+        return max(beams.values(), key=lambda item: item[0])[1]
+
+    @staticmethod
+    def _restore_case(original: str, corrected: str) -> str:
+        if original.isupper() and len(original) > 1:
+            return corrected.upper()
+        if original[:1].isupper():
+            return corrected[:1].upper() + corrected[1:]
+        return corrected
+
+    def normalize(self, query: str) -> tuple[str, bool]:
+        """
+        Trả về (câu đã chuẩn hóa, confident). confident=False khi có âm tiết không
+        nhận diện được trong từ điển -> nên để LLM xử lý.
+        """
+        if not self._variants:
+            return query, False
+        pieces = _TOKEN_RE.findall(unicodedata.normalize("NFC", query))
+        output = list(pieces)
+        confident = True
+
+        # Gom các âm tiết chữ liên tiếp (chỉ ngăn cách bởi khoảng trắng) thành một đoạn để giải mã
+        segment = []  # [(vị trí trong pieces, âm tiết viết thường, candidates)]
+
+        def flush():
+            if segment:
+                decoded = self._decode([cands for _, _, cands in segment])
+                for (pos, _, _), syl in zip(segment, decoded):
+                    output[pos] = self._restore_case(pieces[pos], syl)
+                segment.clear()
+
+        for pos, piece in enumerate(pieces):
+            if piece.isspace():
+                continue
+            if piece.isalpha():
+                lower = piece.lower()
+                if lower not in self.unigrams and lower != strip_diacritics(lower):
+                    # Âm tiết đã có dấu nhưng không có trong corpus (tên riêng, thuật ngữ hiếm): giữ nguyên
+                    # chứ không thay bằng một biến thể của corpus, và để LLM xử lý
+                    segment.append((pos, lower, [(lower, 0.0)]))
+                    confident = False
+                    continue
+                candidates = self._candidates(lower)
+                if candidates:
+                    segment.append((pos, lower, candidates))
+                    continue
+                confident = False
+            flush()
+        flush()
+        return "".join(output), confident
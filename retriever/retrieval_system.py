@@ -2,68 +2,280 @@
 
 import os
 import json
+import threading
+from contextlib import nullcontext
 import torch
-import numpy as np
 from sentence_transformers import SentenceTransformer, CrossEncoder
-from rank_bm25 import BM25Okapi
 from pinecone import Pinecone
 from pyvi import ViTokenizer
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from dotenv import load_dotenv
 
+from retriever.query_normalizer import QueryNormalizer
+from retriever import corpus_updates
+from retriever.segment_index import SegmentedIndex
+from retriever.vector_client import ResilientVectorSearch, VectorSearchUnavailable
+from retriever.fake_vector_index import FakeVectorIndex
+from retriever.conversation_cache import ConversationCandidateCache
+from retriever.document_metadata import DocumentCatalog, DocumentFilter
+from retriever.inference_pool import INFERENCE_WORKERS, InferencePool
+from retriever.citation_index import CITATION_SCORE, CitationIndex, is_pure_lookup, parse_citations
+from core import metrics, profiling
+from core.singleflight import SingleFlight
+from core.cancellation import check_cancelled
+
 load_dotenv() # Tải các biến môi trường từ file .env
 
+# Khi request có thể bị hủy, rerank theo từng mini-batch để dừng được giữa chừng
+CANCELLABLE_RERANK_BATCH = 8
+# Câu hỏi nối tiếp chỉ cần tìm kiếm hẹp hơn vì đã có pool ứng viên của các lượt trước
+FOLLOW_UP_SEARCH_K = 30
+# Lọc theo văn bản: số doc_id tối đa đẩy xuống filter `$in` của Pinecone (nhiều hơn thì lọc sau khi truy vấn)
+VECTOR_FILTER_MAX_DOCS = 1000
+# Khi đã lọc theo văn bản, ứng viên tập trung hơn nên chỉ cần rerank ít cặp hơn
+FILTERED_TOP_K_RETRIEVAL = 10
+
+def _no_inference_slot(should_cancel=None):
+    return nullcontext()
+
 class RetrievalSystem:
     def __init__(self, processed_data_dir, embedding_model_path, reranker_model_path):
         print("Initializing Retrieval System...")
+        # Giới hạn số request chạy model (encode/rerank) cùng lúc: should_cancel -> context manager.
+        # API gắn admission.inference_slot vào đây; chỉ bao quanh lời gọi model thật, không gồm cache hit hay mạng
+        self.inference_slot = _no_inference_slot
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         
-        # 1. Tải models
-        print("Loading models...")
-        self.embedding_model = SentenceTransformer(embedding_model_path, device=self.device)
-        self.reranker_model = CrossEncoder(reranker_model_path, device=self.device)
+        # 1. Tải models: trên CPU có thể chạy trong pool process riêng (INFERENCE_WORKERS > 0)
+        self.inference_pool = None
+        if INFERENCE_WORKERS > 0 and self.device == 'cpu':
+            print(f"Starting inference pool with {INFERENCE_WORKERS} worker processes...")
+            self.inference_pool = InferencePool(embedding_model_path, reranker_model_path, workers=INFERENCE_WORKERS)
+            self.embedding_model = self.reranker_model = None
+        else:
+            print("Loading models...")
+            self.embedding_model = SentenceTransformer(embedding_model_path, device=self.device)
+            self.reranker_model = CrossEncoder(reranker_model_path, device=self.device)
         
-        # 2. Kết nối Pinecone
-        print("Connecting to Pinecone...")
-        pinecone_api_key = os.getenv("PINECONE_API_KEY")
+        # 2. Kết nối Pinecone (hoặc vector store giả lập khi VECTOR_BACKEND=fake)
         self.index_name = "zalo-legal-retrieval-chunked-v2" # Hoặc lấy từ config
-        pc = Pinecone(api_key=pinecone_api_key)
-        self.index = pc.Index(self.index_name)
+        if os.getenv("VECTOR_BACKEND", "pinecone") == "fake":
+            print("Using local fake vector index...")
+            self.index = FakeVectorIndex.from_env(processed_data_dir)
+        else:
+            print("Connecting to Pinecone...")
+            pinecone_api_key = os.getenv("PINECONE_API_KEY")
+            pc = Pinecone(api_key=pinecone_api_key)
+            self.index = pc.Index(self.index_name)
+        # Timeout, hedging và circuit breaker cho mọi truy vấn vector
+        self.vector_client = ResilientVectorSearch(self.index)
         
-        # 3. Tải và xây dựng BM25
+        # 3. Tải và xây dựng BM25 (dạng segment để cập nhật tăng dần)
         print("Loading data and building BM25 index...")
-        chunks_path = os.path.join(processed_data_dir, "legal_corpus_chunks.jsonl")
-        tokenized_chunks_path = os.path.join(processed_data_dir, "legal_corpus_chunks_tokenized.json")
+        chunks_path, tokenized_chunks_path = corpus_updates.base_paths(processed_data_dir)
+        self.updates_log_path = os.path.join(processed_data_dir, corpus_updates.UPDATES_FILE)
         
-        self.corpus_chunks = []
+        corpus_chunks = []
         with open(chunks_path, 'r', encoding='utf-8') as f:
             for line in f:
-                self.corpus_chunks.append(json.loads(line))
+                corpus_chunks.append(json.loads(line))
         
         with open(tokenized_chunks_path, 'r', encoding='utf-8') as f:
             tokenized_chunks = json.load(f)
-            
-        self.bm25 = BM25Okapi(tokenized_chunks)
-        self.chunk_ids_bm25 = [chunk['chunk_id'] for chunk in self.corpus_chunks]
-        
-        # 4. Tạo các map để truy cập nhanh
-        self.chunk_id_to_text = {chunk['chunk_id']: chunk['text'] for chunk in self.corpus_chunks}
-        self.chunk_id_to_doc_id = {chunk['chunk_id']: chunk['doc_id'] for chunk in self.corpus_chunks}
+
+        # Gộp các cập nhật corpus đã ghi log từ những lần chạy trước vào corpus gốc trước khi xây chỉ mục
+        corpus_chunks, tokenized_chunks, update_count = corpus_updates.apply_updates(
+            corpus_chunks, tokenized_chunks, self.updates_log_path)
+        if update_count:
+            print(f"Applied {update_count} logged corpus updates.")
+        if corpus_updates.needs_compaction(self.updates_log_path):
+            print("Compacting corpus updates log into base artifacts...")
+            corpus_updates.compact(processed_data_dir, corpus_chunks, tokenized_chunks, self.updates_log_path)
+
+        self.segment_index = SegmentedIndex(corpus_chunks, tokenized_chunks)
+
+        # Bộ chuẩn hóa câu hỏi (sửa chính tả, khôi phục dấu) xây từ chính corpus đã tokenize
+        print("Building query normalizer...")
+        self.query_normalizer = QueryNormalizer.from_tokenized_corpus(tokenized_chunks)
+        del corpus_chunks, tokenized_chunks
+
+        # 4. Khóa cho các cập nhật corpus lúc đang chạy
+        self._update_lock = threading.Lock()
+
+        # 5. Cache embedding của câu hỏi để bộ phân loại ý định và vector search dùng chung
+        self._embedding_cache = OrderedDict()
+        self._embedding_cache_lock = threading.Lock()
+        self._embedding_cache_size = 1024
+
+        # 6. Gộp các truy vấn giống nhau đang chạy đồng thời (single-flight)
+        self._retrieval_flight = SingleFlight("retrieval")
+
+        # 7. Pool ứng viên + điểm rerank theo từng cuộc trò chuyện cho các câu hỏi nối tiếp
+        self.conversation_cache = ConversationCandidateCache()
+
+        # 8. Metadata theo văn bản (loại, số hiệu, năm, lĩnh vực) để lọc phạm vi tìm kiếm,
+        #    và chỉ mục trích dẫn (văn bản, số điều) -> chunk cho các câu hỏi "Điều X Luật Y"
+        self._document_aliases = DocumentCatalog.load_aliases(processed_data_dir)
+        self._document_indexes = None
+        self._document_indexes_lock = threading.Lock()
+        print("Building document catalog and citation index...")
+        self._document_indexes_for(self.segment_index.snapshot)
         
         print("Retrieval System initialized successfully!")
 
-    def _vector_search(self, query, k):
-        query_embedding = self.embedding_model.encode(query).tolist()
-        results = self.index.query(vector=query_embedding, top_k=k)
+    def normalize_query(self, query):
+        """Trả về (câu đã sửa chính tả/khôi phục dấu, confident)."""
+        return self.query_normalizer.normalize(query)
+
+    def encode_query(self, query, should_cancel=None):
+        """Encode câu hỏi bằng model e5, có cache LRU để không encode lại cùng một câu."""
+        with self._embedding_cache_lock:
+            if query in self._embedding_cache:
+                self._embedding_cache.move_to_end(query)
+                return self._embedding_cache[query]
+
+        with self.inference_slot(should_cancel), profiling.stage("encode"):
+            if self.inference_pool is not None:
+                embedding = self.inference_pool.encode([query])[0]
+            else:
+                embedding = self.embedding_model.encode(query)
+
+        with self._embedding_cache_lock:
+            self._embedding_cache[query] = embedding
+            if len(self._embedding_cache) > self._embedding_cache_size:
+                self._embedding_cache.popitem(last=False)
+        return embedding
+
+    def encode_batch(self, texts, batch_size=64):
+        if self.inference_pool is not None:
+            return self.inference_pool.encode(texts)
+        return self.embedding_model.encode(texts, batch_size=batch_size, show_progress_bar=False)
+
+    # --- Cập nhật corpus tăng dần (không cần restart) ---
+    def _append_updates_log(self, entry):
+        with open(self.updates_log_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def upsert_document(self, doc_id: str, chunks: list[dict]) -> dict:
+        """
+        Thêm mới hoặc thay thế một văn bản theo doc_id: upsert vector lên Pinecone,
+        ghi các chunk vào một delta segment BM25 rồi swap snapshot mới.
+        """
+        records = [
+            {"chunk_id": chunk.get("chunk_id") or f"{doc_id}_{i}", "doc_id": doc_id, "text": chunk["text"]}
+            for i, chunk in enumerate(chunks)
+        ]
+        tokenized = [ViTokenizer.tokenize(record['text']).split() for record in records]
+        with self._update_lock:
+            stale_ids = set(self.segment_index.chunk_ids_of(doc_id)) - {r['chunk_id'] for r in records}
+            embeddings = self.encode_batch([record['text'] for record in records]) if records else []
+            vectors = [
+                {"id": record['chunk_id'], "values": embedding.tolist(), "metadata": {"doc_id": doc_id}}
+                for record, embedding in zip(records, embeddings)
+            ]
+            for start in range(0, len(vectors), 100):
+                self.index.upsert(vectors=vectors[start:start + 100])
+            if stale_ids:
+                self.index.delete(ids=list(stale_ids))
+
+            self.segment_index.upsert(doc_id, records, tokenized)
+            self._append_updates_log({"op": "upsert", "doc_id": doc_id, "chunks": records, "tokens": tokenized})
+        return {"doc_id": doc_id, "chunks": len(records), "removed_chunks": len(stale_ids),
+                "index_version": self.segment_index.snapshot.version}
+
+    def delete_document(self, doc_id: str) -> dict:
+        """Xóa mọi chunk của doc_id khỏi BM25 và Pinecone."""
+        with self._update_lock:
+            removed = self.segment_index.delete(doc_id)
+            if removed:
+                self.index.delete(ids=removed)
+                self._append_updates_log({"op": "delete", "doc_id": doc_id})
+        return {"doc_id": doc_id, "removed_chunks": len(removed),
+                "index_version": self.segment_index.snapshot.version}
+
+    def _document_indexes_for(self, snapshot):
+        """(catalog, citation index) của một snapshot, xây lại khi corpus đổi phiên bản."""
+        with self._document_indexes_lock:
+            current = self._document_indexes
+            if current is None or current[0] != snapshot.version:
+                previous_citations = current[2] if current is not None else None
+                current = (snapshot.version, DocumentCatalog(snapshot.doc_ids, self._document_aliases),
+                           CitationIndex(snapshot, previous_citations))
+                self._document_indexes = current
+            return current[1], current[2]
+
+    def document_catalog(self, snapshot=None) -> DocumentCatalog:
+        """Catalog metadata văn bản của snapshot hiện tại."""
+        return self._document_indexes_for(snapshot or self.segment_index.snapshot)[0]
+
+    def _citation_hits(self, query, snapshot, doc_ids):
+        """
+        Tra trực tiếp các điều luật được trích dẫn ("Điều 113 Bộ luật Lao động", "khoản 2 Điều 5 Nghị định 100").
+        Trả về (chunks khớp chính xác, câu hỏi có phải chỉ là tra cứu nội dung điều luật hay không).
+        """
+        citations = parse_citations(query)
+        if not citations:
+            return [], False
+        catalog, citation_index = self._document_indexes_for(snapshot)
+        mentioned = catalog.find_documents(query)
+        if not mentioned:
+            return [], False
+        if doc_ids is not None:
+            mentioned &= doc_ids
+        hits = citation_index.lookup(citations, sorted(mentioned), catalog.documents)
+        chunks = []
+        for chunk_id, citation in hits:
+            chunk = snapshot.chunks[chunk_id]
+            reference = f"Điều {citation.article}" if not citation.clause else f"Khoản {citation.clause} Điều {citation.article}"
+            chunks.append({"chunk_id": chunk_id, "doc_id": chunk['doc_id'], "text": chunk['text'],
+                           "score": CITATION_SCORE, "citation": reference})
+        return chunks, bool(chunks) and is_pure_lookup(catalog.strip_mentions(query))
+
+    def _resolve_filter(self, query, filters, snapshot):
+        """
+        Trả về tập doc_id cần giới hạn, hoặc None nếu tìm trên toàn corpus.
+        Bộ lọc tường minh từ API được ưu tiên; nếu không có thì nhận diện văn bản được nhắc tới trong câu hỏi.
+        """
+        catalog = self.document_catalog(snapshot)
+        document_filter = DocumentFilter.from_dict(filters)
+        if document_filter is None:
+            document_filter = catalog.detect_filter(query)
+            if document_filter is None:
+                return None
+            metrics.inc("retrieval_filter_detected_total")
+        doc_ids = catalog.resolve(document_filter)
+        metrics.inc("retrieval_filtered_total")
+        return frozenset(doc_ids)
+
+    def _vector_search(self, query, k, doc_ids=None, should_cancel=None):
+        query_embedding = self.encode_query(query, should_cancel).tolist()
+        kwargs = {}
+        if doc_ids is not None and len(doc_ids) <= VECTOR_FILTER_MAX_DOCS:
+            kwargs["filter"] = {"doc_id": {"$in": sorted(doc_ids)}}
+        with profiling.stage("vector_search"):
+            results = self.vector_client.query(vector=query_embedding, top_k=k, **kwargs)
         return [match['id'] for match in results['matches']]
 
-    def _hybrid_search(self, query, k_semantic=100, k_lexical=100, rrf_k=60):
-        semantic_ids = self._vector_search(query, k=k_semantic)
+    def _hybrid_search(self, query, snapshot, k_semantic=100, k_lexical=100, rrf_k=60, should_cancel=None, doc_ids=None):
+        # Khi vector store không ổn định (timeout, lỗi, breaker mở) thì chỉ dùng BM25
+        semantic_ids = []
+        check_cancelled(should_cancel)
+        if self.vector_client.available:
+            try:
+                semantic_ids = self._vector_search(query, k=k_semantic, doc_ids=doc_ids, should_cancel=should_cancel)
+            except VectorSearchUnavailable as e:
+                print(f"Vector search unavailable, falling back to BM25 only: {e}")
+        if not semantic_ids:
+            metrics.inc("retrieval_lexical_only_total")
+        # Bỏ các id mà Pinecone còn trả về nhưng đã bị xóa khỏi snapshot hiện tại
+        semantic_ids = [cid for cid in semantic_ids if cid in snapshot.chunks]
+        if doc_ids is not None:
+            semantic_ids = [cid for cid in semantic_ids if snapshot.chunks[cid]['doc_id'] in doc_ids]
         
-        tokenized_query = ViTokenizer.tokenize(query).split()
-        bm25_scores = self.bm25.get_scores(tokenized_query)
-        top_n_indices = np.argsort(bm25_scores)[::-1][:k_lexical]
-        lexical_ids = [self.chunk_ids_bm25[i] for i in top_n_indices]
+        check_cancelled(should_cancel)
+        with profiling.stage("bm25"):
+            tokenized_query = ViTokenizer.tokenize(query).split()
+            lexical_ids = [chunk_id for chunk_id, _ in snapshot.top_k(tokenized_query, k_lexical, doc_ids=doc_ids)]
 
         rrf_scores = defaultdict(float)
         for rank, chunk_id in enumerate(semantic_ids):
@@ -74,29 +286,129 @@ class RetrievalSystem:
         sorted_rrf = sorted(rrf_scores.items(), key=lambda item: item[1], reverse=True)
         return [chunk_id for chunk_id, score in sorted_rrf]
 
-    def retrieve_chunks(self, query: str, top_k_retrieval: int = 20, top_k_rerank: int = 5):
+    @staticmethod
+    def _flight_key(query):
+        return " ".join(query.lower().split())
+
+    def retrieve_chunks(self, query: str, top_k_retrieval: int = 20, top_k_rerank: int = 5, should_cancel=None,
+                        conversation_id: str | None = None, filters: dict | None = None):
         """
         Thực hiện toàn bộ pipeline retrieve và rerank để lấy ra các chunks liên quan nhất.
+        Các lời gọi đồng thời với cùng câu hỏi (đã chuẩn hóa) và tham số chỉ chạy một lần
+        và dùng chung kết quả. `should_cancel` cho phép người chờ thôi chờ sớm.
+        Khi có `conversation_id`, câu hỏi nối tiếp cùng chủ đề dùng lại pool ứng viên của lượt trước.
+        Điều luật được trích dẫn chính xác được tra thẳng từ chỉ mục trích dẫn: câu hỏi chỉ tra cứu nội dung
+        điều luật bỏ qua hybrid search và rerank, các câu hỏi khác được ghim các chunk đó lên đầu.
+        `filters` ({doc_ids, doc_types, years, domains}) giới hạn phạm vi văn bản; nếu không truyền,
+        văn bản được nhắc tới trong câu hỏi ("Nghị định 100", "Bộ luật Lao động") sẽ được dùng làm bộ lọc.
         """
-        retrieved_chunk_ids = self._hybrid_search(query)[:top_k_retrieval]
+        snapshot = self.segment_index.snapshot
+        doc_ids = self._resolve_filter(query, filters, snapshot)
+        if doc_ids is not None:
+            if not doc_ids:
+                return []
+            top_k_retrieval = min(top_k_retrieval, FILTERED_TOP_K_RETRIEVAL)
+
+        pinned, is_lookup = self._citation_hits(query, snapshot, doc_ids)
+        if pinned:
+            metrics.inc("citation_hits_total")
+            if is_lookup or len(pinned) >= top_k_rerank:
+                metrics.inc("citation_direct_total")
+                return pinned[:top_k_rerank]
+
+        context = None
+        if conversation_id is not None:
+            query_embedding = self.encode_query(query, should_cancel)
+            context = self.conversation_cache.get(conversation_id, query_embedding, snapshot.version)
+
+        if context is not None:
+            results, scores = self._retrieve_follow_up(query, context, snapshot, top_k_retrieval, top_k_rerank,
+                                                       should_cancel, doc_ids)
+        else:
+            key = (self._flight_key(query), top_k_retrieval, top_k_rerank, snapshot.version, doc_ids)
+            results, scores = self._retrieval_flight.do(
+                key, lambda: self._retrieve_chunks(query, snapshot, top_k_retrieval, top_k_rerank, should_cancel, doc_ids),
+                should_cancel=should_cancel,
+            )
+            metrics.set_gauge("retrieval_in_flight", self._retrieval_flight.in_flight)
+
+        if conversation_id is not None:
+            self.conversation_cache.put(conversation_id, query_embedding, scores, top_k_rerank, snapshot.version)
+        if pinned:
+            pinned_ids = {chunk['chunk_id'] for chunk in pinned}
+            results = pinned + [chunk for chunk in results if chunk['chunk_id'] not in pinned_ids]
+            results = results[:top_k_rerank]
+        # Trả về bản sao để các request không sửa chung một danh sách
+        return [dict(chunk) for chunk in results]
+
+    def _rerank(self, query, texts, should_cancel=None):
+        """Chấm điểm các cặp (câu hỏi, chunk) bằng cross-encoder."""
+        with self.inference_slot(should_cancel), profiling.stage("rerank"):
+            return self._rerank_pairs([[query, text] for text in texts], should_cancel)
+
+    def _rerank_pairs(self, pairs, should_cancel=None):
+        if self.inference_pool is not None:
+            # Batch được chia cho các worker; hủy được giữa các phần đang chờ
+            return self.inference_pool.rerank(pairs, should_cancel)
+        if should_cancel is None:
+            return self.reranker_model.predict(pairs, show_progress_bar=False, batch_size=128)
+        scores = []
+        for start in range(0, len(pairs), CANCELLABLE_RERANK_BATCH):
+            check_cancelled(should_cancel)
+            batch = pairs[start:start + CANCELLABLE_RERANK_BATCH]
+            scores.extend(self.reranker_model.predict(batch, show_progress_bar=False, batch_size=len(batch)))
+        return scores
+
+    def _retrieve_chunks(self, query, snapshot, top_k_retrieval, top_k_rerank, should_cancel=None, doc_ids=None):
+        """Trả về (top chunks sau rerank, điểm rerank của toàn bộ ứng viên)."""
+        # Giữ một snapshot cố định cho cả truy vấn, kể cả khi có cập nhật corpus song song
+        retrieved_chunk_ids = self._hybrid_search(query, snapshot, should_cancel=should_cancel,
+                                                  doc_ids=doc_ids)[:top_k_retrieval]
         
-        retrieved_chunk_texts = [self.chunk_id_to_text.get(cid, "") for cid in retrieved_chunk_ids]
-        pairs = [[query, text] for text in retrieved_chunk_texts]
+        retrieved_chunk_texts = [snapshot.chunks[cid]['text'] for cid in retrieved_chunk_ids]
         
-        if not pairs:
-            return []
+        if not retrieved_chunk_texts:
+            return [], {}
             
-        scores = self.reranker_model.predict(pairs, show_progress_bar=False, batch_size=128)
-        reranked_chunks = sorted(zip(retrieved_chunk_ids, scores), key=lambda x: x[1], reverse=True)
-        
+        scores = self._rerank(query, retrieved_chunk_texts, should_cancel)
+        metrics.inc("rerank_pairs_total", len(retrieved_chunk_texts))
+        scores = {chunk_id: float(score) for chunk_id, score in zip(retrieved_chunk_ids, scores)}
+        return self._top_chunks(scores, snapshot, top_k_rerank), scores
+
+    def _retrieve_follow_up(self, query, context, snapshot, top_k_retrieval, top_k_rerank, should_cancel=None,
+                            doc_ids=None):
+        """
+        Câu hỏi nối tiếp: tìm kiếm hẹp hơn, gộp với pool của các lượt trước và chỉ rerank
+        các ứng viên mới hoặc có điểm cũ nằm sát ngưỡng top-k.
+        """
+        search_ids = self._hybrid_search(query, snapshot, k_semantic=FOLLOW_UP_SEARCH_K, k_lexical=FOLLOW_UP_SEARCH_K,
+                                         should_cancel=should_cancel, doc_ids=doc_ids)[:top_k_retrieval]
+        scores, uncertain = context.split()
+        if doc_ids is not None:
+            # Pool cũ có thể chứa chunk ngoài phạm vi văn bản đang lọc
+            scores = {cid: score for cid, score in scores.items() if snapshot.chunks[cid]['doc_id'] in doc_ids}
+            uncertain = [cid for cid in uncertain if snapshot.chunks[cid]['doc_id'] in doc_ids]
+        to_score = [cid for cid in search_ids if cid not in context.scores] + uncertain
+        if to_score:
+            new_scores = self._rerank(query, [snapshot.chunks[cid]['text'] for cid in to_score], should_cancel)
+            scores.update((chunk_id, float(score)) for chunk_id, score in zip(to_score, new_scores))
+        metrics.inc("rerank_pairs_total", len(to_score))
+        # Các ứng viên của lượt tìm kiếm này được dùng lại điểm cũ thay vì rerank
+        rescored = set(to_score)
+        metrics.inc("rerank_pairs_saved_total", sum(1 for cid in search_ids if cid not in rescored))
+        return self._top_chunks(scores, snapshot, top_k_rerank), scores
+
+    @staticmethod
+    def _top_chunks(scores, snapshot, top_k_rerank):
         # Lấy top k chunks cuối cùng sau khi rerank
         final_chunks = []
-        for chunk_id, score in reranked_chunks[:top_k_rerank]:
+        for chunk_id, score in sorted(scores.items(), key=lambda x: x[1], reverse=True)[:top_k_rerank]:
+            chunk = snapshot.chunks[chunk_id]
             final_chunks.append({
                 "chunk_id": chunk_id,
-                "doc_id": self.chunk_id_to_doc_id.get(chunk_id),
-                "text": self.chunk_id_to_text.get(chunk_id),
-                "score": float(score)
+                "doc_id": chunk['doc_id'],
+                "text": chunk['text'],
+                "score": score
             })
             
-        return final_chunks
\ No newline at end of file
+        return final_chunks
@@ -0,0 +1,413 @@
+# retriever/segment_index.py
+
+import copy
+import threading
+import numpy as np
+from collections import Counter, defaultdict
+from collections.abc import Mapping, Set
+
+from core import metrics
+
+# Tham số giống rank_bm25.BM25Okapi để điểm số không đổi so với trước
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+# Segment gốc có quá tỉ lệ này chunk đã bị xóa thì được gộp lại cùng các delta segment
+BASE_COMPACT_RATIO = 0.2
+
+
+class Vocabulary:
+    """term -> id dùng chung cho mọi segment và snapshot. Chỉ thêm, không xóa, nên id của term không đổi."""
+
+    def __init__(self):
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, term):
+        return self.ids.get(term)
+
+    def add(self, terms) -> np.ndarray:
+        ids = self.ids
+        return np.asarray([ids.setdefault(term, len(ids)) for term in terms], dtype=np.int64)
+
+
+def _doc_terms(postings, num_docs, vocab: Vocabulary):
+    """
+    Id (Vocabulary) các term duy nhất của từng chunk dạng CSR (mảng phẳng + offsets), suy ra từ postings
+    bằng numpy thay vì giữ một mảng nhỏ cho mỗi chunk.
+    """
+    if not postings:
+        return np.zeros(0, dtype=np.int64), np.zeros(num_docs + 1, dtype=np.int64)
+    term_ids = vocab.add(postings)
+    doc_idx = np.concatenate([idx for idx, _ in postings.values()])
+    flat = np.repeat(term_ids, [len(idx) for idx, _ in postings.values()])
+    flat = flat[np.argsort(doc_idx, kind="stable")]
+    offsets = np.zeros(num_docs + 1, dtype=np.int64)
+    np.cumsum(np.bincount(doc_idx, minlength=num_docs), out=offsets[1:])
+    return flat, offsets
+
+
+class Segment:
+    """
+    Một segment bất biến của chỉ mục BM25: postings riêng (term -> chỉ số doc, tf)
+    và bitmap xóa. Xóa tài liệu tạo ra một Segment mới dùng chung postings và các bảng tra
+    chunk_id/doc_id; chỉ bitmap và tập doc_id đã xóa là riêng.
+    """
+
+    def __init__(self, chunks, postings, doc_lens, vocab: Vocabulary):
+        self.chunks = chunks                      # list[dict]: chunk_id, doc_id, text, ...
+        self.postings = postings                  # term -> (np.int32 idx, np.float32 tf)
+        self.doc_lens = doc_lens                  # np.float32 (n,)
+        # term_ids[term_offsets[i]:term_offsets[i + 1]]: id các term duy nhất của chunk i (để cập nhật df)
+        self.term_ids, self.term_offsets = _doc_terms(postings, len(chunks), vocab)
+        self.deleted = np.zeros(len(chunks), dtype=bool)
+        self.deleted_docs = frozenset()
+        self.live_count = len(chunks)
+        self.live_total_len = float(doc_lens.sum())
+        self.chunk_pos = {chunk['chunk_id']: i for i, chunk in enumerate(chunks)}
+        self.doc_index = defaultdict(list)
+        for i, chunk in enumerate(chunks):
+            self.doc_index[chunk['doc_id']].append(i)
+
+    @classmethod
+    def build(cls, chunks, tokenized_chunks, vocab: Vocabulary):
+        term_docs = defaultdict(list)
+        term_tfs = defaultdict(list)
+        for i, tokens in enumerate(tokenized_chunks):
+            for term, tf in Counter(tokens).items():
+                term_docs[term].append(i)
+                term_tfs[term].append(tf)
+        postings = {
+            term: (np.asarray(term_docs[term], dtype=np.int32), np.asarray(term_tfs[term], dtype=np.float32))
+            for term in term_docs
+        }
+        doc_lens = np.asarray([len(tokens) for tokens in tokenized_chunks], dtype=np.float32)
+        return cls(list(chunks), postings, doc_lens, vocab)
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def live_indices(self, doc_id):
+        """Chỉ số các chunk còn sống của doc_id trong segment."""
+        if doc_id in self.deleted_docs:
+            return ()
+        return self.doc_index.get(doc_id, ())
+
+    def live_chunk(self, chunk_id):
+        i = self.chunk_pos.get(chunk_id)
+        if i is None or self.deleted[i]:
+            return None
+        return self.chunks[i]
+
+    def with_deletions(self, doc_id):
+        """Trả về segment mới đã đánh dấu xóa mọi chunk của doc_id (postings và bảng tra dùng chung)."""
+        local_indices = self.live_indices(doc_id)
+        if not local_indices:
+            return self
+        seg = copy.copy(self)
+        seg.deleted = self.deleted.copy()
+        seg.deleted[local_indices] = True
+        seg.deleted_docs = self.deleted_docs | {doc_id}
+        seg.live_count = self.live_count - len(local_indices)
+        seg.live_total_len = self.live_total_len - float(self.doc_lens[local_indices].sum())
+        return seg
+
+    def removed_term_ids(self, doc_id) -> np.ndarray:
+        """Id các term (mỗi chunk một lần) của những chunk còn sống thuộc doc_id, để trừ khỏi df."""
+        parts = [self.term_ids[self.term_offsets[i]:self.term_offsets[i + 1]] for i in self.live_indices(doc_id)]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    @staticmethod
+    def merge(segments, vocab: Vocabulary):
+        """Gộp nhiều segment thành một, bỏ hẳn các chunk đã bị xóa."""
+        chunks, doc_lens = [], []
+        remaps = []
+        offset = 0
+        for seg in segments:
+            live = ~seg.deleted
+            remap = np.full(len(seg), -1, dtype=np.int64)
+            remap[live] = np.arange(offset, offset + int(live.sum()))
+            remaps.append(remap)
+            offset += int(live.sum())
+            chunks.extend(seg.chunks[i] for i in np.flatnonzero(live))
+            doc_lens.append(seg.doc_lens[live])
+
+        merged_postings = {}
+        all_terms = set()
+        for seg in segments:
+            all_terms.update(seg.postings)
+        for term in all_terms:
+            idx_parts, tf_parts = [], []
+            for seg, remap in zip(segments, remaps):
+                entry = seg.postings.get(term)
+                if entry is None:
+                    continue
+                new_idx = remap[entry[0]]
+                keep = new_idx >= 0
+                idx_parts.append(new_idx[keep])
+                tf_parts.append(entry[1][keep])
+            idx = np.concatenate(idx_parts).astype(np.int32)
+            if len(idx):
+                merged_postings[term] = (idx, np.concatenate(tf_parts))
+        lens = np.concatenate(doc_lens) if doc_lens else np.zeros(0, dtype=np.float32)
+        return Segment(chunks, merged_postings, lens.astype(np.float32), vocab)
+
+
+class LiveChunks(Mapping):
+    """chunk_id -> chunk của các chunk còn sống, tra qua từng segment thay vì dựng lại dict toàn corpus."""
+
+    def __init__(self, segments, size):
+        self._segments = segments[::-1]  # segment mới nhất được ưu tiên
+        self._size = size
+
+    def __getitem__(self, chunk_id):
+        for seg in self._segments:
+            chunk = seg.live_chunk(chunk_id)
+            if chunk is not None:
+                return chunk
+        raise KeyError(chunk_id)
+
+    def __contains__(self, chunk_id):
+        return any(seg.live_chunk(chunk_id) is not None for seg in self._segments)
+
+    def __iter__(self):
+        for seg in reversed(self._segments):
+            for i in np.flatnonzero(~seg.deleted):
+                yield seg.chunks[i]['chunk_id']
+
+    def __len__(self):
+        return self._size
+
+
+class LiveDocIds(Set):
+    """Tập doc_id còn ít nhất một chunk sống."""
+
+    def __init__(self, segments):
+        self._segments = segments
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return frozenset(iterable)
+
+    def __contains__(self, doc_id):
+        return any(seg.live_indices(doc_id) for seg in self._segments)
+
+    def __iter__(self):
+        seen = set()
+        for seg in self._segments:
+            for doc_id in seg.doc_index:
+                if doc_id not in seen and seg.live_indices(doc_id):
+                    seen.add(doc_id)
+                    yield doc_id
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class IndexSnapshot:
+    """
+    Một phiên bản bất biến của toàn bộ chỉ mục (danh sách segment + thống kê toàn cục).
+    Mỗi truy vấn giữ một snapshot từ đầu đến cuối nên không bị ảnh hưởng bởi cập nhật song song.
+    df toàn cục được SegmentedIndex cập nhật theo delta; IDF chỉ được tính khi có truy vấn.
+    """
+
+    def __init__(self, segments, vocab: Vocabulary, df: np.ndarray, version=0):
+        self.segments = tuple(segments)
+        self.version = version
+        self.num_docs = sum(seg.live_count for seg in self.segments)
+        total_len = sum(seg.live_total_len for seg in self.segments)
+        self.avgdl = total_len / self.num_docs if self.num_docs else 0.0
+        self.chunks = LiveChunks(self.segments, self.num_docs)
+        self.doc_ids = LiveDocIds(self.segments)
+        self._vocab = vocab
+        self._df = df  # không được sửa sau khi tạo snapshot
+        self._average_idf = None
+
+    def get_chunk(self, chunk_id):
+        return self.chunks.get(chunk_id)
+
+    def _raw_idf(self, counts):
+        return np.log(self.num_docs - counts + 0.5) - np.log(counts + 0.5)
+
+    def idf(self, term) -> float:
+        """IDF giống BM25Okapi: idf âm được thay bằng epsilon * idf trung bình (trên các term còn xuất hiện)."""
+        term_id = self._vocab.get(term)
+        if term_id is None or term_id >= len(self._df) or self._df[term_id] <= 0:
+            return 0.0
+        value = float(self._raw_idf(float(self._df[term_id])))
+        if value >= 0:
+            return value
+        if self._average_idf is None:
+            counts = self._df[self._df > 0].astype(np.float64)
+            self._average_idf = float(self._raw_idf(counts).mean())
+        return BM25_EPSILON * self._average_idf
+
+    def top_k(self, tokenized_query, k, doc_ids=None):
+        """
+        Trả về [(chunk_id, điểm BM25)] của k chunk tốt nhất. Nếu có `doc_ids`, postings được
+        lọc bằng bitmap các chunk thuộc những văn bản đó nên chỉ chấm điểm trong phạm vi này
+        (IDF và avgdl vẫn tính trên toàn corpus để điểm số nhất quán).
+        """
+        if not self.num_docs:
+            return []
+        idfs = {term: self.idf(term) for term in set(tokenized_query)}
+        candidate_ids, candidate_scores = [], []
+        for seg in self.segments:
+            allowed = None
+            if doc_ids is not None:
+                local = [i for doc_id in doc_ids for i in seg.live_indices(doc_id)]
+                if not local:
+                    continue
+                allowed = np.zeros(len(seg), dtype=bool)
+                allowed[local] = True
+            scores = np.zeros(len(seg), dtype=np.float32)
+            touched = False
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * seg.doc_lens / self.avgdl)
+            for term in tokenized_query:
+                entry = seg.postings.get(term)
+                idf = idfs[term]
+                if entry is None or not idf:
+                    continue
+                idx, tf = entry
+                if allowed is not None:
+                    keep = allowed[idx]
+                    idx, tf = idx[keep], tf[keep]
+                scores[idx] += idf * (tf * (BM25_K1 + 1) / (tf + norm[idx]))
+                touched = True
+            if not touched:
+                continue
+            hits = np.flatnonzero((scores != 0) & ~seg.deleted)
+            candidate_ids.extend(seg.chunks[i]['chunk_id'] for i in hits)
+            candidate_scores.append(scores[hits])
+        metrics.inc("bm25_candidates_total", len(candidate_ids))
+        if not candidate_ids:
+            return []
+        all_scores = np.concatenate(candidate_scores)
+        if len(all_scores) > k:
+            top = np.argpartition(-all_scores, k)[:k]
+        else:
+            top = np.arange(len(all_scores))
+        top = top[np.argsort(-all_scores[top])]
+        return [(candidate_ids[i], float(all_scores[i])) for i in top]
+
+
+class SegmentedIndex:
+    """
+    Chỉ mục BM25 cập nhật tăng dần: tài liệu mới/sửa đổi được ghi vào các delta segment nhỏ,
+    tài liệu bị xóa được đánh dấu trong bitmap. Một thread nền gộp các delta segment và
+    mỗi thay đổi được "swap" nguyên tử bằng cách thay snapshot. Chi phí một cập nhật tỉ lệ với
+    kích thước văn bản thay đổi (cộng một lần sao chép mảng df), không phải với kích thước corpus.
+    """
+
+    def __init__(self, chunks, tokenized_chunks, max_delta_segments=4, base_compact_ratio=BASE_COMPACT_RATIO):
+        self.max_delta_segments = max_delta_segments
+        self.base_compact_ratio = base_compact_ratio
+        self._write_lock = threading.Lock()
+        self._vocab = Vocabulary()
+        base = Segment.build(chunks, tokenized_chunks, self._vocab)
+        df = np.bincount(base.term_ids, minlength=len(self._vocab)).astype(np.int64)
+        self._snapshot = IndexSnapshot([base], self._vocab, df)
+        self._merge_requested = threading.Event()
+        self._merger = threading.Thread(target=self._merge_loop, name="segment-merger", daemon=True)
+        self._merger.start()
+        self._publish_metrics()
+
+    @property
+    def snapshot(self) -> IndexSnapshot:
+        return self._snapshot
+
+    def _swap(self, segments, df=None):
+        current = self._snapshot
+        self._snapshot = IndexSnapshot(segments, self._vocab, current._df if df is None else df,
+                                       version=current.version + 1)
+        self._publish_metrics()
+
+    def _publish_metrics(self):
+        snap = self._snapshot
+        metrics.set_gauge("index_version", snap.version)
+        metrics.set_gauge("index_segments", len(snap.segments))
+        metrics.set_gauge("index_live_chunks", snap.num_docs)
+
+    def _df_without(self, df, doc_id, segments):
+        removed = [seg.removed_term_ids(doc_id) for seg in segments]
+        removed = np.concatenate(removed) if removed else np.zeros(0, dtype=np.int64)
+        if len(removed):
+            np.subtract.at(df, removed, 1)
+        return df
+
+    def upsert(self, doc_id, chunks, tokenized_chunks):
+        """Thay thế toàn bộ chunk của doc_id bằng các chunk mới (một delta segment)."""
+        with self._write_lock:
+            current = self._snapshot.segments
+            segments = [seg.with_deletions(doc_id) for seg in current]
+            added = None
+            if chunks:
+                delta = Segment.build(chunks, tokenized_chunks, self._vocab)
+                segments.append(delta)
+                added = delta.term_ids
+            df = np.zeros(len(self._vocab), dtype=np.int64)
+            df[:len(self._snapshot._df)] = self._snapshot._df
+            self._df_without(df, doc_id, current)
+            if added is not None:
+                np.add.at(df, added, 1)
+            self._swap(segments, df)
+        self._maybe_request_merge()
+
+    def delete(self, doc_id) -> list:
+        """Xóa mọi chunk của doc_id, trả về danh sách chunk_id đã xóa."""
+        with self._write_lock:
+            current = self._snapshot.segments
+            removed = [seg.chunks[i]['chunk_id'] for seg in current for i in seg.live_indices(doc_id)]
+            if removed:
+                df = self._df_without(self._snapshot._df.copy(), doc_id, current)
+                self._swap([seg.with_deletions(doc_id) for seg in current], df)
+        self._maybe_request_merge()
+        return removed
+
+    def chunk_ids_of(self, doc_id) -> list:
+        return [
+            seg.chunks[i]['chunk_id']
+            for seg in self._snapshot.segments for i in seg.live_indices(doc_id)
+        ]
+
+    def _base_needs_compaction(self, segments) -> bool:
+        base = segments[0]
+        return len(base) > 0 and 1 - base.live_count / len(base) > self.base_compact_ratio
+
+    def _maybe_request_merge(self):
+        segments = self._snapshot.segments
+        if len(segments) - 1 > self.max_delta_segments or self._base_needs_compaction(segments):
+            self._merge_requested.set()
+
+    def _merge_loop(self):
+        while True:
+            self._merge_requested.wait()
+            self._merge_requested.clear()
+            try:
+                self.merge_deltas()
+            except Exception as e:
+                print(f"Lỗi khi gộp segment: {e}")
+
+    def merge_deltas(self):
+        """
+        Gộp mọi delta segment (trừ segment gốc lớn nhất) thành một, ngoài write lock.
+        Khi segment gốc có nhiều chunk đã xóa thì gộp cả segment gốc để thu hồi bộ nhớ.
+        """
+        segments = self._snapshot.segments
+        compact_base = self._base_needs_compaction(segments)
+        if len(segments) <= 2 and not compact_base:
+            return
+        keep = 0 if compact_base else 1
+        merged = Segment.merge(segments[keep:], self._vocab)
+        with self._write_lock:
+            current = self._snapshot.segments
+            # Chỉ swap nếu không có cập nhật nào chạm vào các segment vừa gộp trong lúc gộp
+            if len(current) >= len(segments) and all(a is b for a, b in zip(current, segments)):
+                new_segments = list(current[:keep]) + ([merged] if len(merged) or not keep else []) \
+                    + list(current[len(segments):])
+                self._swap(new_segments)
+                metrics.inc("index_merges_total")
+            else:
+                self._merge_requested.set()
@@ -0,0 +1,146 @@
+# retriever/vector_client.py
+
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from core import metrics
+
+VECTOR_SEARCH_TIMEOUT = float(os.getenv("VECTOR_SEARCH_TIMEOUT", "1.5"))
+VECTOR_HEDGE_MIN_DELAY = float(os.getenv("VECTOR_HEDGE_MIN_DELAY", "0.05"))
+
+
+class VectorSearchUnavailable(Exception):
+    """Vector store quá hạn, lỗi, hoặc circuit breaker đang mở."""
+
+
+class CircuitBreaker:
+    """
+    closed -> open sau `failure_threshold` lỗi liên tiếp; sau `reset_timeout` giây chuyển
+    sang half_open và cho một request thử, thành công thì đóng lại.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        metrics.set_gauge("vector_backend_state", self.state)
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            metrics.set_gauge("vector_backend_state", state)
+            if state == "open":
+                metrics.inc("vector_breaker_opened_total")
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._set_state("half_open")
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def is_open(self) -> bool:
+        """Đang mở và chưa tới lúc thử lại. Không chiếm lượt probe của half_open như allow_request()."""
+        with self._lock:
+            return self.state == "open" and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            self._set_state("closed")
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self.state == "half_open" or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state("open")
+
+
+class ResilientVectorSearch:
+    """
+    Bọc `index.query` với deadline cho mỗi lần gọi, gửi thêm một request trùng (hedge) khi
+    request đầu chậm hơn p95 gần đây, và circuit breaker để retrieval chuyển sang chỉ dùng BM25
+    khi vector store không ổn định.
+    """
+
+    def __init__(self, index, timeout=VECTOR_SEARCH_TIMEOUT, hedge_min_delay=VECTOR_HEDGE_MIN_DELAY,
+                 latency_window=200, max_workers=32, breaker=None):
+        self.index = index
+        self.timeout = timeout
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = breaker or CircuitBreaker()
+        self._latencies = deque(maxlen=latency_window)
+        self._latency_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="vector-search")
+
+    @property
+    def available(self) -> bool:
+        # Hết reset_timeout thì coi là available để query() được gọi và chuyển breaker sang half_open
+        return not self.breaker.is_open()
+
+    def _hedge_delay(self) -> float:
+        with self._latency_lock:
+            if len(self._latencies) < 20:
+                return self.timeout / 2
+            p95 = float(np.percentile(self._latencies, 95))
+        metrics.set_gauge("vector_search_p95_ms", round(p95 * 1000, 1))
+        # Luôn chừa ít nhất nửa deadline cho request hedge
+        return min(max(self.hedge_min_delay, p95), self.timeout / 2)
+
+    def _timed_query(self, kwargs):
+        start = time.perf_counter()
+        result = self.index.query(**kwargs)
+        with self._latency_lock:
+            self._latencies.append(time.perf_counter() - start)
+        return result
+
+    def query(self, **kwargs):
+        """Giống `index.query(**kwargs)`, raise VectorSearchUnavailable khi không có kết quả kịp hạn."""
+        if not self.breaker.allow_request():
+            metrics.inc("vector_search_short_circuited_total")
+            raise VectorSearchUnavailable("circuit breaker open")
+
+        deadline = time.monotonic() + self.timeout
+        futures = [self._executor.submit(self._timed_query, kwargs)]
+        done, _ = wait(futures, timeout=self._hedge_delay())
+        if not done:
+            metrics.inc("vector_search_hedged_total")
+            futures.append(self._executor.submit(self._timed_query, kwargs))
+
+        last_error = None
+        pending = set(futures)
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if len(futures) > 1 and future is futures[1]:
+                        metrics.inc("vector_search_hedge_wins_total")
+                    self.breaker.record_success()
+                    return future.result()
+                last_error = future.exception()
+
+        if last_error is not None and not pending:
+            metrics.inc("vector_search_errors_total")
+        else:
+            metrics.inc("vector_search_timeouts_total")
+        self.breaker.record_failure()
+        raise VectorSearchUnavailable(str(last_error) if last_error else f"timeout after {self.timeout}s")
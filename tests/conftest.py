@@ -0,0 +1,48 @@
+# tests/conftest.py
+import sqlite3
+
+import pytest
+
+# Schema của chat_history.db trước khi có các backend lưu trữ và chỉ mục tìm kiếm
+LEGACY_SCHEMA = """
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        hashed_password TEXT NOT NULL
+    );
+    CREATE TABLE conversations (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    );
+    CREATE TABLE messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        sources TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+    );
+"""
+LEGACY_CONVERSATION_ID = "3f2b6c1e-0000-4000-8000-000000000001"
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    """File SQLite tạo bằng schema cũ, đã có một user và một cuộc trò chuyện."""
+    path = str(tmp_path / "chat_history.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.execute("INSERT INTO users (username, hashed_password) VALUES ('alice', 'hash')")
+    conn.execute("INSERT INTO conversations (id, user_id, title) VALUES (?, 1, 'Thừa kế đất đai')",
+                 (LEGACY_CONVERSATION_ID,))
+    conn.executemany("INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)", [
+        (LEGACY_CONVERSATION_ID, "user", "Con riêng có được hưởng thừa kế không?"),
+        (LEGACY_CONVERSATION_ID, "assistant", "Theo Điều 651 Bộ luật Dân sự, con riêng thuộc hàng thừa kế thứ nhất."),
+    ])
+    conn.commit()
+    conn.close()
+    return path
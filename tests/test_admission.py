@@ -0,0 +1,77 @@
+# tests/test_admission.py
+import types
+
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+from api.admission import AdmissionController, CoDel, Overloaded, Rejected
+
+
+def test_codel_enters_dropping_only_after_a_standing_queue():
+    codel = CoDel(target=0.1, interval=1.0)
+    codel.observe(0.5, now=0.0)
+    codel.observe(0.5, now=0.5)
+    assert not codel.dropping  # burst ngắn hơn interval
+    codel.observe(0.5, now=1.0)
+    assert codel.dropping
+    assert codel.should_shed(queue_empty=False, now=1.0)
+    assert not codel.should_shed(queue_empty=False, now=1.1)
+    # Nhịp từ chối tăng dần: interval / sqrt(count)
+    assert codel.should_shed(queue_empty=False, now=1.0 + 1 / 2 ** 0.5)
+
+
+def test_codel_exits_dropping_when_delay_drops_or_queue_drains():
+    codel = CoDel(target=0.1, interval=1.0)
+    for now in (0.0, 1.0):
+        codel.observe(0.5, now=now)
+    assert codel.dropping
+    codel.observe(0.01, now=1.5)
+    assert not codel.dropping and not codel.should_shed(queue_empty=False, now=2.0)
+
+    for now in (3.0, 4.0):
+        codel.observe(0.5, now=now)
+    assert codel.dropping
+    assert not codel.should_shed(queue_empty=True, now=4.0)
+    assert not codel.dropping
+
+
+def test_admit_limits_per_user_and_releases_on_stream_end():
+    controller = AdmissionController(enabled=True, max_in_flight=10, max_per_user=1)
+    ticket = controller.admit("alice")
+    with pytest.raises(Rejected) as e:
+        controller.admit("alice")
+    assert e.value.status == 429 and e.value.retry_after >= 1
+    assert list(controller.track(ticket, iter(["a", "b"]))) == ["a", "b"]
+    assert controller.admit("alice") is not None
+
+
+def test_inference_slot_sheds_after_max_wait():
+    controller = AdmissionController(enabled=True, inference_concurrency=1, inference_max_wait=0.05)
+    with controller.inference_slot():
+        with pytest.raises(Overloaded):
+            with controller.inference_slot():
+                pass
+    with controller.inference_slot():
+        pass
+
+
+def test_retrieval_takes_inference_slot_only_for_model_calls():
+    pytest.importorskip("torch")
+    pytest.importorskip("pyvi")
+    import threading
+    from collections import OrderedDict
+    from contextlib import nullcontext
+
+    from retriever.retrieval_system import RetrievalSystem
+
+    slots = []
+    system = object.__new__(RetrievalSystem)
+    system.inference_slot = lambda should_cancel=None: slots.append(should_cancel) or nullcontext()
+    system.inference_pool = None
+    system.embedding_model = types.SimpleNamespace(encode=lambda query: [0.0])
+    system._embedding_cache, system._embedding_cache_lock, system._embedding_cache_size = OrderedDict(), threading.Lock(), 8
+
+    system.encode_query("câu hỏi")
+    system.encode_query("câu hỏi")
+    assert len(slots) == 1
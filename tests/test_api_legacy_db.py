@@ -0,0 +1,52 @@
+# tests/test_api_legacy_db.py
+"""API chạy trên chat_history.db tạo trước khi có chỉ mục tìm kiếm: các endpoint ghi không được lỗi."""
+import sys
+import types
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+
+from fastapi.testclient import TestClient
+
+from core import storage
+from core.storage import SQLiteChatStore
+from tests.conftest import LEGACY_CONVERSATION_ID
+
+
+@pytest.fixture
+def client(legacy_db, monkeypatch):
+    # Không nạp model thật: thay api.dependencies bằng bản tối giản trước khi import api.main
+    dependencies = types.ModuleType("api.dependencies")
+    dependencies.get_retriever = lambda: types.SimpleNamespace(conversation_cache=types.SimpleNamespace(discard=lambda _: None))
+    dependencies.get_intent_classifier = lambda: None
+    dependencies.require_admin = lambda: None
+    monkeypatch.setitem(sys.modules, "api.dependencies", dependencies)
+    pytest.importorskip("api.main")
+    monkeypatch.setattr(storage, "_store", None)
+    monkeypatch.setattr(storage, "create_chat_store", lambda: SQLiteChatStore(legacy_db))
+    from api.main import app
+    with TestClient(app) as client:
+        yield client
+
+
+def test_writes_and_search_on_legacy_database(client):
+    response = client.post("/conversations/update_title", json={
+        "username": "alice", "conversation_id": LEGACY_CONVERSATION_ID, "new_title": "Chia di sản thừa kế",
+    })
+    assert response.status_code == 200
+
+    response = client.get("/conversations/alice/search", params={"q": "dieu 651"})
+    assert response.status_code == 200
+    assert [hit["conversation_id"] for hit in response.json()] == [LEGACY_CONVERSATION_ID]
+
+    response = client.get("/conversations/alice/search", params={"q": "chia di san"})
+    assert response.json()[0]["snippet"] == "**Chia** **di** **sản** thừa kế"
+
+
+def test_generate_answer_rejects_other_users_conversation(client):
+    response = client.post("/generate_answer", json={
+        "username": "mallory", "conversation_id": LEGACY_CONVERSATION_ID, "message": "Điều 651 nói gì?",
+    })
+    assert response.status_code == 403
@@ -0,0 +1,68 @@
+# tests/test_chat_store.py
+import pytest
+
+from core import storage
+from core.storage import SQLiteChatStore, create_chat_store
+from tests.conftest import LEGACY_CONVERSATION_ID
+
+
+@pytest.fixture(params=["sqlite", "sqlite-pool"])
+def store(request, tmp_path):
+    store = create_chat_store(request.param, db_path=str(tmp_path / "chat.db"), pool_size=2)
+    store.init_schema()
+    yield store
+    store.close()
+
+
+def test_search_index_follows_writes(store):
+    store.register_user("alice", "h")
+    store.register_user("bob", "h")
+    alice, bob = store.get_user_id("alice"), store.get_user_id("bob")
+    convo = store.add_conversation_with_messages(alice, "Nợ lương", [("user", "Công ty nợ lương 2 tháng")])
+    store.add_message(convo, "assistant", "Bạn có quyền đơn phương chấm dứt hợp đồng.")
+
+    assert {h["message_id"] is None for h in store.search_conversations(alice, "no luong")} == {True, False}
+    assert [h["role"] for h in store.search_conversations(alice, "don phuong")] == ["assistant"]
+    assert store.search_conversations(bob, "no luong") == []
+
+    assert store.update_conversation_title(convo, alice, "Tiền lương chậm trả")
+    titles = [h["snippet"] for h in store.search_conversations(alice, "cham tra") if h["message_id"] is None]
+    assert titles == ["Tiền lương **chậm** **trả**"]
+    assert not [h for h in store.search_conversations(alice, "no luong") if h["message_id"] is None]
+
+    assert store.delete_conversation(convo, alice)
+    assert store.search_conversations(alice, "luong") == []
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "sqlite-pool"])
+def test_init_schema_backfills_legacy_database(legacy_db, backend):
+    store = create_chat_store(backend, db_path=legacy_db, pool_size=2)
+    try:
+        store.init_schema()
+        hits = store.search_conversations(1, "dieu 651")
+        assert [(h["conversation_id"], h["role"]) for h in hits] == [(LEGACY_CONVERSATION_ID, "assistant")]
+        assert [h["message_id"] for h in store.search_conversations(1, "dat dai")] == [None]
+        # Chạy lại (mỗi lần khởi động) không nhân đôi chỉ mục
+        store.init_schema()
+        assert len(store.search_conversations(1, "thua ke")) == 3
+    finally:
+        store.close()
+
+
+def test_get_chat_store_upgrades_legacy_database_before_writes(legacy_db, monkeypatch):
+    monkeypatch.setattr(storage, "_store", None)
+    monkeypatch.setattr(storage, "create_chat_store", lambda: SQLiteChatStore(legacy_db))
+    store = storage.get_chat_store()
+    store.add_message(LEGACY_CONVERSATION_ID, "user", "Thủ tục khai nhận di sản?")
+    assert store.update_conversation_title(LEGACY_CONVERSATION_ID, 1, "Khai nhận di sản")
+    assert len(store.search_conversations(1, "di san")) == 2
+
+
+def test_conversation_ownership(store):
+    store.register_user("alice", "h")
+    store.register_user("bob", "h")
+    convo = store.add_conversation(store.get_user_id("alice"), "Nợ lương")
+    assert store.is_conversation_owner("alice", convo)
+    assert not store.is_conversation_owner("bob", convo)
+    assert not store.is_conversation_owner("mallory", convo)
+    assert not store.is_conversation_owner("alice", "00000000-0000-4000-8000-000000000000")
@@ -0,0 +1,49 @@
+# tests/test_citation_index.py
+from retriever.citation_index import Citation, CitationIndex, is_pure_lookup, parse_citations
+from retriever.document_metadata import DocumentCatalog
+from retriever.segment_index import SegmentedIndex
+
+LAO_DONG_2019, LAO_DONG_2012 = "45/2019/qh14", "10/2012/qh13"
+
+
+def _chunk(chunk_id, doc_id, text):
+    return {"chunk_id": chunk_id, "doc_id": doc_id, "text": text}
+
+
+def test_parse_citations_handles_clause_positions_and_duplicates():
+    assert parse_citations("Khoản 2 Điều 35 và điều 113, khoản 1; lại hỏi Điều 035") == [
+        Citation("35", "2"), Citation("113", "1"), Citation("35", None),
+    ]
+    assert parse_citations("khoan 3 cua dieu 8 luat dat dai") == [Citation("8", "3")]
+    assert parse_citations("Bộ luật Lao động có bao nhiêu điều?") == []
+
+
+def test_pure_lookup_only_when_nothing_but_generic_words_remain():
+    catalog = DocumentCatalog([LAO_DONG_2019, LAO_DONG_2012])
+    assert is_pure_lookup(catalog.strip_mentions("Điều 113 Bộ luật Lao động quy định gì"))
+    assert not is_pure_lookup(catalog.strip_mentions("Điều 113 Bộ luật Lao động áp dụng cho người nước ngoài không"))
+
+
+def test_lookup_prefers_newest_document_and_clause_chunk():
+    chunks = [
+        _chunk(f"{LAO_DONG_2019}_113_0", LAO_DONG_2019, "Điều 113. Nghỉ hằng năm\n1. Người lao động làm việc đủ 12 tháng"),
+        _chunk(f"{LAO_DONG_2019}_113_1", LAO_DONG_2019, "2. Trường hợp người lao động làm việc chưa đủ 12 tháng"),
+        _chunk(f"{LAO_DONG_2012}_113_0", LAO_DONG_2012, "Điều 113. Chế độ thai sản cũ"),
+        # Văn bản thêm qua API không chia theo điều: tiêu đề nằm giữa chunk
+        _chunk(f"{LAO_DONG_2019}_0_0", LAO_DONG_2019, "Chương XI ... Điều 114. Nghỉ hằng năm tăng thêm theo thâm niên"),
+    ]
+    index = SegmentedIndex(chunks, [c["text"].split() for c in chunks], base_compact_ratio=1.0)
+    catalog = DocumentCatalog([LAO_DONG_2019, LAO_DONG_2012])
+    citations = CitationIndex(index.snapshot)
+
+    hits = citations.lookup([Citation("113", "2")], sorted(catalog.find_documents("Bộ luật Lao động")), catalog.documents)
+    assert [chunk_id for chunk_id, _ in hits] == [f"{LAO_DONG_2019}_113_1", f"{LAO_DONG_2019}_113_0"]
+    assert citations.article_chunks(LAO_DONG_2019, "114") == [f"{LAO_DONG_2019}_0_0"]
+
+    # Chunk bị xóa không còn được trả về; chỉ mục của segment gốc được dùng lại
+    index.delete(LAO_DONG_2019)
+    updated = CitationIndex(index.snapshot, previous=citations)
+    base = index.snapshot.segments[0].chunks
+    assert updated._segments[id(base)][1] is citations._segments[id(base)][1]
+    hits = updated.lookup([Citation("113", None)], sorted(catalog.find_documents("Bộ luật Lao động")), catalog.documents)
+    assert [chunk_id for chunk_id, _ in hits] == [f"{LAO_DONG_2012}_113_0"]
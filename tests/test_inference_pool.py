@@ -0,0 +1,64 @@
+# tests/test_inference_pool.py
+import os
+import time
+
+import numpy as np
+import pytest
+
+from retriever.inference_pool import InferenceError, InferencePool
+
+
+def stub_models(embedding_model_path, reranker_model_path, threads):
+    """Model giả chạy trong worker: embedding = (độ dài, pid), điểm rerank = độ dài văn bản."""
+    if embedding_model_path == "fail":
+        raise RuntimeError("không load được model")
+
+    def encode(texts):
+        if "__exit__" in texts:
+            os._exit(1)
+        if "__hang__" in texts:
+            time.sleep(60)
+        return [[len(text), os.getpid()] for text in texts]
+
+    def rerank(pairs):
+        return [len(document) for _, document in pairs]
+
+    return encode, rerank, 2
+
+
+@pytest.fixture
+def pool():
+    pool = InferencePool("stub", "stub", workers=2, threads_per_worker=1, rerank_min_shard=4,
+                         call_timeout=2, model_loader=stub_models)
+    yield pool
+    pool.close()
+
+
+def test_shards_are_spread_over_workers_and_concatenated_in_order(pool):
+    pairs = [("q", "x" * i) for i in range(40)]
+    assert pool.rerank(pairs).tolist() == list(range(40))
+
+    texts = ["y" * i for i in range(64)]
+    embeddings = pool.encode(texts)
+    assert embeddings[:, 0].tolist() == list(range(64))
+    assert len(set(embeddings[:, 1].tolist())) == 2  # mỗi nửa chạy trên một worker
+    assert InferencePool._split(10, 3) == [(0, 3), (3, 6), (6, 10)]
+
+
+def test_shared_buffers_grow_for_large_batches(pool):
+    texts = ["ư" * 300_000, "a" * 700_000, "b"]  # > 1 MB dữ liệu đầu vào
+    assert pool.encode(texts)[:, 0].tolist() == [300_000, 700_000, 1]
+    assert pool.encode(["c", "dd"])[:, 0].tolist() == [1, 2]
+
+
+@pytest.mark.parametrize("poison", ["__exit__", "__hang__"])
+def test_dead_or_hung_worker_raises_and_is_restarted(pool, poison):
+    with pytest.raises(InferenceError):
+        pool.encode([poison])
+    assert pool.encode(["abc"] * 32)[:, 0].tolist() == [3] * 32
+    assert all(worker.healthy and worker.process.is_alive() for worker in pool._workers)
+
+
+def test_worker_dying_at_startup_raises_inference_error():
+    with pytest.raises(InferenceError):
+        InferencePool("fail", "stub", workers=1, threads_per_worker=1, model_loader=stub_models)
@@ -0,0 +1,101 @@
+# tests/test_ingestion.py
+import json
+import os
+
+import numpy as np
+import pytest
+
+from retriever import ingestion
+from retriever.ingestion import IngestionPipeline, _iter_json_array, chunk_document
+
+OUTPUT_FILES = [ingestion.CHUNKS_FILE, ingestion.TOKENIZED_FILE, ingestion.EMBEDDINGS_FILE, ingestion.EMBEDDING_IDS_FILE]
+
+
+def split_tokens(texts):
+    """Thay cho pyvi trong process con (phải ở cấp module để pickle được)."""
+    return [text.split() for text in texts], 0.0
+
+
+def fake_encode(texts):
+    return np.array([[len(text), text.count(" "), sum(map(ord, text)) % 97] for text in texts], dtype=np.float32)
+
+
+def test_iter_json_array_streams_across_buffer_boundaries(tmp_path):
+    documents = [
+        {"doc_id": "01/2015/qh13", "text": "Điều 1. Phạm vi điều chỉnh, gồm [a], {b}"},
+        {"doc_id": "x", "text": "\"trích dẫn\" ]\n, ["},
+        {"doc_id": "y", "articles": [{"article_id": 1, "text": "Người lao động"}]},
+    ]
+    path = tmp_path / "corpus.json"
+    path.write_text(" \n[\n" + ",\n  ".join(json.dumps(d, ensure_ascii=False) for d in documents) + "\n]\n",
+                    encoding="utf-8")
+    for buffer_size in (1, 7, 1 << 20):
+        assert list(_iter_json_array(str(path), buffer_size=buffer_size)) == documents
+
+    path.write_text('{"doc_id": "x"}', encoding="utf-8")
+    with pytest.raises(ValueError):
+        list(_iter_json_array(str(path), buffer_size=4))
+    path.write_text('[{"doc_id": "x"}, {"doc_id"', encoding="utf-8")
+    with pytest.raises(json.JSONDecodeError):
+        list(_iter_json_array(str(path), buffer_size=4))
+
+
+def test_chunk_document_overlaps_consecutive_chunks():
+    words = [f"w{i}" for i in range(10)]
+    chunks = chunk_document({"doc_id": "d", "text": " ".join(words)}, max_words=4, overlap_words=1)
+    assert [c["chunk_id"] for c in chunks] == ["d_0_0", "d_0_1", "d_0_2"]
+    assert [c["text"].split() for c in chunks] == [words[0:4], words[3:7], words[6:10]]
+
+    # Văn bản ngắn hơn phần overlap vẫn ra đúng một chunk; article rỗng bị bỏ qua
+    document = {"law_id": "luat", "articles": [{"article_id": 5, "title": "Điều 5", "text": "ngắn"},
+                                               {"article_id": 6, "text": ""}]}
+    assert chunk_document(document, max_words=4, overlap_words=2) == [
+        {"chunk_id": "luat_5_0", "doc_id": "luat", "text": "Điều 5 ngắn"}
+    ]
+
+
+def _write_corpus(path, n_docs=6):
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(n_docs):
+            text = " ".join(f"từ{i}_{j}" for j in range(5 + 3 * i))
+            f.write(json.dumps({"doc_id": f"doc{i}", "text": text}, ensure_ascii=False) + "\n")
+
+
+def _pipeline(input_path, output_dir, encoder_loader=lambda path: fake_encode):
+    return IngestionPipeline(str(input_path), str(output_dir), "unused", workers=1, batch_size=4,
+                             max_words=6, overlap_words=2, encoder_loader=encoder_loader, tokenize_fn=split_tokens)
+
+
+def test_resume_after_crash_produces_identical_outputs(tmp_path):
+    corpus = tmp_path / "corpus.jsonl"
+    _write_corpus(corpus)
+    _pipeline(corpus, tmp_path / "clean").run()
+
+    calls = []
+
+    def crash_after_first_batch(path):
+        def encode(texts):
+            calls.append(len(texts))
+            if len(calls) > 1:
+                raise RuntimeError("process bị kill")
+            return fake_encode(texts)
+        return encode
+
+    resumed_dir = tmp_path / "resumed"
+    with pytest.raises(RuntimeError):
+        _pipeline(corpus, resumed_dir, crash_after_first_batch).run()
+    state = json.loads((resumed_dir / ingestion.CHECKPOINT_FILE).read_text())
+    assert state["next_part"] == 1 and not state["finalized"]
+
+    # Phần ghi dở sau checkpoint cuối phải bị bỏ khi chạy lại
+    with open(resumed_dir / ingestion.CHUNKS_FILE, "a", encoding="utf-8") as f:
+        f.write('{"chunk_id": "ghi dở')
+    with open(resumed_dir / ingestion.TOKENIZED_PARTIAL_FILE, "a", encoding="utf-8") as f:
+        f.write('["ghi", "dở"]\n')
+    np.save(resumed_dir / ingestion.EMBEDDING_PARTS_DIR / "part-00001.npy", np.ones((2, 3), dtype=np.float32))
+
+    _pipeline(corpus, resumed_dir).run()
+    for name in OUTPUT_FILES:
+        assert (resumed_dir / name).read_bytes() == (tmp_path / "clean" / name).read_bytes(), name
+    assert len(os.listdir(resumed_dir / ingestion.EMBEDDING_PARTS_DIR)) == \
+        len(os.listdir(tmp_path / "clean" / ingestion.EMBEDDING_PARTS_DIR))
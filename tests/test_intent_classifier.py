@@ -0,0 +1,91 @@
+# tests/test_intent_classifier.py
+import numpy as np
+import pytest
+
+from api.intent_classifier import SEED_EXAMPLES, IntentClassifier, build_intent_classifier
+from core import metrics
+from core.storage import SQLiteChatStore
+
+# Encoder giả: mỗi từ khóa là một trục, câu không có từ khóa nào nằm trên trục "khác"
+AXES = ["luật", "chào", "tạm biệt", "giúp", "khác"]
+
+
+def fake_encode(texts):
+    vectors = []
+    for text in texts:
+        lower = text.lower()
+        vector = [float(key in lower) for key in AXES[:-1]]
+        vectors.append(vector + [0.0 if any(vector) else 1.0])
+    return np.array(vectors, dtype=np.float32)
+
+
+TEXTS = ["Điều luật nào", "luật lao động", "luật đất đai", "chào bạn", "xin chào", "chào buổi sáng",
+         "tạm biệt nhé", "tạm biệt"]
+LABELS = ["Legal Question"] * 3 + ["Greeting"] * 3 + ["Farewell"] * 2
+
+
+def test_fit_builds_unit_centroids_and_reports_cv_accuracy():
+    classifier = IntentClassifier(fake_encode).fit(TEXTS, LABELS, n_folds=2)
+    assert classifier.is_ready
+    assert classifier.labels == ["Farewell", "Greeting", "Legal Question"]
+    np.testing.assert_allclose(np.linalg.norm(classifier.centroids, axis=1), 1.0, rtol=1e-6)
+    assert classifier.cv_accuracy == 1.0
+    assert metrics.snapshot()["gauges"]["intent_classifier_training_examples"] == len(TEXTS)
+
+
+def test_predict_confidence_against_threshold():
+    classifier = IntentClassifier(fake_encode, confidence_threshold=0.85).fit(TEXTS, LABELS)
+    label, confidence = classifier.predict(fake_encode(["luật thừa kế"])[0])
+    assert label == "Legal Question" and confidence >= classifier.confidence_threshold
+
+    # Nằm giữa hai centroid: không đủ tin cậy, phải nhường cho Gemini
+    label, confidence = classifier.predict(fake_encode(["chào, hỏi về luật"])[0])
+    assert label in {"Legal Question", "Greeting"}
+    assert confidence == pytest.approx(0.5, abs=1e-3)
+    assert confidence < classifier.confidence_threshold
+
+
+def test_build_trains_only_on_seed_llm_and_human_labels(tmp_path):
+    store = SQLiteChatStore(str(tmp_path / "chat.db"))
+    store.init_schema()
+    store.add_intent_label("gemini quyết định", "Legal Question", "llm")
+    store.add_intent_label("người gán nhãn", "Greeting", "human")
+    store.add_intent_label("bộ phân loại tự đoán", "Greeting", "local")
+    store.add_intent_label("nhãn lạ", "Spam", "llm")
+    # Câu trả lời của trợ lý không còn được dùng để suy nhãn
+    store.register_user("alice", "h")
+    store.add_conversation_with_messages(store.get_user_id("alice"), "t", [("user", "câu hỏi cũ"), ("assistant", "Tạm biệt!")])
+
+    seen = []
+    classifier = build_intent_classifier(lambda texts: seen.extend(texts) or fake_encode(texts), store)
+    seeds = [text for examples in SEED_EXAMPLES.values() for text in examples]
+    assert seen == seeds + ["người gán nhãn", "gemini quyết định"]
+    assert classifier.is_ready
+
+
+class _Retriever:
+    def normalize_query(self, query):
+        return query, True
+
+    def encode_query(self, query, should_cancel=None):
+        return fake_encode([query])[0]
+
+
+def test_analyze_input_skips_gemini_only_above_threshold(monkeypatch):
+    pytest.importorskip("torch")
+    from api import services
+
+    gemini_calls, recorded = [], []
+    monkeypatch.setattr(services, "get_structured_input_analysis", lambda query, should_cancel=None: gemini_calls.append(query) or {
+        "corrected_query": query, "intent": "Greeting", "is_rag_required": False, "intent_source": "llm"})
+    monkeypatch.setattr(services, "_record_intent_label", lambda text, intent: recorded.append((text, intent)))
+    classifier = IntentClassifier(fake_encode, confidence_threshold=0.85).fit(TEXTS, LABELS)
+
+    analysis = services.analyze_input("luật thừa kế", _Retriever(), classifier)
+    assert (analysis["intent"], analysis["intent_source"]) == ("Legal Question", "local")
+    assert gemini_calls == [] and recorded == []
+
+    analysis = services.analyze_input("chào, hỏi về luật", _Retriever(), classifier)
+    assert (analysis["intent"], analysis["intent_source"]) == ("Greeting", "llm")
+    assert gemini_calls == ["chào, hỏi về luật"]
+    assert recorded == [("chào, hỏi về luật", "Greeting")]
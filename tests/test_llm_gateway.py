@@ -0,0 +1,90 @@
+# tests/test_llm_gateway.py
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+from api.fake_llm import FakeResourceExhausted
+from api.llm_gateway import DEFAULT_MODEL, FairSemaphore, LLMGateway
+from core.cancellation import Cancelled
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def _queue_waiter(semaphore, order, name, **kwargs):
+    """Xếp một waiter vào hàng đợi và chờ tới khi nó thực sự đứng trong hàng."""
+    depth = semaphore.queue_depth
+
+    def run():
+        try:
+            if semaphore.acquire(**kwargs):
+                order.append(name)
+                semaphore.release()
+            else:
+                order.append(f"{name}:timeout")
+        except Cancelled:
+            order.append(f"{name}:cancelled")
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    _wait_for(lambda: semaphore.queue_depth > depth)
+    return thread
+
+
+def test_fair_semaphore_serves_waiters_in_arrival_order():
+    semaphore, order = FairSemaphore(1), []
+    assert semaphore.acquire()
+    threads = [_queue_waiter(semaphore, order, i) for i in range(5)]
+    semaphore.release()
+    for thread in threads:
+        thread.join(5)
+    assert order == [0, 1, 2, 3, 4]
+
+
+def test_waiter_leaving_on_timeout_or_cancel_hands_the_slot_on():
+    semaphore, order = FairSemaphore(1), []
+    cancelled = threading.Event()
+    assert semaphore.acquire()
+    threads = [
+        _queue_waiter(semaphore, order, "timeout", timeout=0.05),
+        _queue_waiter(semaphore, order, "cancel", should_cancel=cancelled.is_set),
+        _queue_waiter(semaphore, order, "next"),
+    ]
+    _wait_for(lambda: "timeout:timeout" in order)
+    cancelled.set()
+    _wait_for(lambda: "cancel:cancelled" in order)
+    semaphore.release()
+    for thread in threads:
+        thread.join(5)
+    assert order == ["timeout:timeout", "cancel:cancelled", "next"]
+    assert semaphore.queue_depth == 0 and semaphore.active == 0
+
+
+def test_rate_limited_call_is_retried_then_raised(monkeypatch):
+    monkeypatch.setenv("FAKE_LLM_LATENCY_MS", "0")
+    monkeypatch.setenv("FAKE_LLM_429_RATE", "1")
+    gateway = LLMGateway(backend="fake", max_retries=2, base_delay=0)
+    with pytest.raises(FakeResourceExhausted):
+        gateway.generate("Tiêu đề:", coalesce=False)
+    assert gateway._models[DEFAULT_MODEL].calls == 3
+
+
+def test_identical_concurrent_prompts_make_one_upstream_call(monkeypatch):
+    monkeypatch.setenv("FAKE_LLM_LATENCY_MS", "200")
+    monkeypatch.setenv("FAKE_LLM_429_RATE", "0")
+    gateway = LLMGateway(backend="fake")
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(gateway.generate("Tiêu đề:"))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert results == ["Hỏi đáp pháp luật"] * 4
+    assert gateway._models[DEFAULT_MODEL].calls == 1
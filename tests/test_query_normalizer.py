@@ -0,0 +1,52 @@
+# tests/test_query_normalizer.py
+from retriever.query_normalizer import QueryNormalizer, _edit_distance
+
+CORPUS = [
+    ["người_lao_động", "được", "nghỉ", "hằng_năm"],
+    ["người_sử_dụng_lao_động", "phải", "trả", "lương", "đúng", "hạn"],
+    ["lương", "tối_thiểu", "vùng"],
+    ["luật", "lao_động", "quy_định", "về", "thời_giờ", "làm_việc"],
+] + [["chất_lượng", "hàng_hóa", "chất_lượng", "sản_phẩm", "số_lượng"]] * 3
+
+
+def _normalizer():
+    return QueryNormalizer.from_tokenized_corpus(CORPUS)
+
+
+def test_edit_distance_counts_transpositions_and_stops_early():
+    assert _edit_distance("dogn", "dong", 1) == 1
+    assert _edit_distance("abc", "xyz", 1) == 2
+
+
+def test_restores_diacritics_and_case():
+    normalizer = _normalizer()
+    assert normalizer.normalize("nguoi lao dong duoc nghi hang nam") == ("người lao động được nghỉ hằng năm", True)
+    assert normalizer.normalize("LUAT lao dong, quy dinh?") == ("LUẬT lao động, quy định?", True)
+
+
+def test_bigram_context_picks_the_right_variant():
+    normalizer = _normalizer()
+    # "lượng" phổ biến hơn trong corpus nhưng "trả lương" mới đúng ngữ cảnh
+    assert normalizer.normalize("tra luong dung han")[0] == "trả lương đúng hạn"
+    assert normalizer.normalize("chat luong hang hoa")[0] == "chất lượng hàng hóa"
+
+
+def test_fixes_typos_and_flags_unknown_words():
+    normalizer = _normalizer()
+    assert normalizer.normalize("nguoi lao dogn") == ("người lao động", True)
+    assert normalizer.normalize("xyzq lương") == ("xyzq lương", False)
+    assert QueryNormalizer().normalize("luong") == ("luong", False)
+
+
+def test_frequent_candidate_survives_truncation():
+    normalizer = QueryNormalizer.from_tokenized_corpus([["luật"]] * 100 + [["lạt"]] + [["thuế"]] * 100 + [["thuê"]] * 50,
+                                                       max_candidates=1)
+    assert [c for c, _ in normalizer._candidates("lhat")] == ["luật"]
+    normalizer.max_candidates = 8
+    assert [c for c, _ in normalizer._candidates("thuw")][:2] == ["thuế", "thuê"]
+
+
+def test_keeps_diacritized_syllable_missing_from_corpus():
+    normalizer = QueryNormalizer.from_tokenized_corpus([["người_lao_động", "được", "nghỉ", "hằng_năm"]])
+    assert normalizer.normalize("nghỉ hàng năm") == ("nghỉ hàng năm", False)
+    assert normalizer.normalize("nghi hang nam") == ("nghỉ hằng năm", True)
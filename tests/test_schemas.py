@@ -0,0 +1,17 @@
+# tests/test_schemas.py
+import pytest
+
+pytest.importorskip("pydantic")
+
+from pydantic import ValidationError
+
+from api.schemas import MAX_MESSAGE_CHARS, QueryRequest
+
+
+def test_message_and_history_content_are_length_limited():
+    too_long = "a" * (MAX_MESSAGE_CHARS + 1)
+    with pytest.raises(ValidationError):
+        QueryRequest(username="alice", message=too_long)
+    with pytest.raises(ValidationError):
+        QueryRequest(username="alice", chat_history=[{"role": "user", "content": too_long}])
+    assert QueryRequest(username="alice", chat_history=[{"role": "user", "content": "a" * MAX_MESSAGE_CHARS}])
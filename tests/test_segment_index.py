@@ -0,0 +1,147 @@
+# tests/test_segment_index.py
+import json
+import os
+import random
+
+import pytest
+from rank_bm25 import BM25Okapi
+
+from retriever import corpus_updates
+from retriever.segment_index import SegmentedIndex
+
+VOCAB = ["lao_động", "hợp_đồng", "tiền_lương", "thừa_kế", "đất_đai", "bồi_thường", "kỷ_luật",
+         "nghỉ_phép", "bảo_hiểm", "xã_hội", "thuế", "di_chúc", "người", "quyền", "nghĩa_vụ"]
+
+
+def _document(rng, doc_id, n_chunks):
+    chunks, tokens = [], []
+    for i in range(n_chunks):
+        chunks.append({"chunk_id": f"{doc_id}_{i}", "doc_id": doc_id, "text": f"{doc_id} {i}"})
+        tokens.append(rng.choices(VOCAB[:rng.randint(3, len(VOCAB))], k=rng.randint(3, 20)))
+    return chunks, tokens
+
+
+def _assert_matches_bm25okapi(index, corpus, queries):
+    """corpus: doc_id -> (chunks, tokens) còn sống; điểm top_k phải bằng BM25Okapi xây lại từ đầu."""
+    chunks = [c for doc_chunks, _ in corpus.values() for c in doc_chunks]
+    tokens = [t for _, doc_tokens in corpus.values() for t in doc_tokens]
+    bm25 = BM25Okapi(tokens)
+    snapshot = index.snapshot
+    assert snapshot.num_docs == len(chunks)
+    assert set(snapshot.chunks) == {c["chunk_id"] for c in chunks}
+    assert set(snapshot.doc_ids) == set(corpus)
+    for query in queries:
+        expected = {c["chunk_id"]: s for c, s in zip(chunks, bm25.get_scores(query)) if s != 0}
+        got = dict(snapshot.top_k(query, k=len(chunks)))
+        assert got.keys() == expected.keys()
+        for chunk_id, score in got.items():
+            assert score == pytest.approx(expected[chunk_id], rel=1e-4, abs=1e-5)
+
+
+def test_segmented_bm25_matches_rebuilt_index_after_updates():
+    rng = random.Random(7)
+    corpus = {f"doc{d}": _document(rng, f"doc{d}", rng.randint(1, 6)) for d in range(40)}
+    index = SegmentedIndex([c for cs, _ in corpus.values() for c in cs],
+                           [t for _, ts in corpus.values() for t in ts], max_delta_segments=100)
+    queries = [rng.sample(VOCAB, 2) for _ in range(10)] + [["thuế", "thuế", "không_có"]]
+    _assert_matches_bm25okapi(index, corpus, queries)
+
+    for step in range(30):
+        doc_id = f"doc{rng.randint(0, 50)}"
+        if rng.random() < 0.3:
+            removed = index.delete(doc_id)
+            assert len(removed) == len(corpus.pop(doc_id, ([], []))[0])
+        else:
+            corpus.pop(doc_id, None)
+            corpus[doc_id] = _document(rng, doc_id, rng.randint(1, 6))
+            index.upsert(doc_id, *corpus[doc_id])
+        if step % 10 == 9:
+            _assert_matches_bm25okapi(index, corpus, queries)
+
+    index.merge_deltas()
+    assert len(index.snapshot.segments) <= 2
+    _assert_matches_bm25okapi(index, corpus, queries)
+
+
+def test_updates_share_unchanged_segment_tables():
+    rng = random.Random(1)
+    corpus = {f"doc{d}": _document(rng, f"doc{d}", 3) for d in range(5)}
+    index = SegmentedIndex([c for cs, _ in corpus.values() for c in cs],
+                           [t for _, ts in corpus.values() for t in ts], base_compact_ratio=1.0)
+    base = index.snapshot.segments[0]
+    index.delete("doc1")
+    index.upsert("doc9", *_document(rng, "doc9", 2))
+    new_base = index.snapshot.segments[0]
+    assert new_base is not base
+    assert new_base.chunks is base.chunks and new_base.chunk_pos is base.chunk_pos
+    assert new_base.postings is base.postings
+    assert "doc1_0" not in index.snapshot.chunks and "doc1" not in index.snapshot.doc_ids
+    assert index.snapshot.chunks["doc9_1"]["doc_id"] == "doc9"
+    assert index.chunk_ids_of("doc9") == ["doc9_0", "doc9_1"]
+
+
+def test_filtered_top_k_scores_only_selected_documents():
+    rng = random.Random(3)
+    corpus = {f"doc{d}": _document(rng, f"doc{d}", 4) for d in range(10)}
+    index = SegmentedIndex([c for cs, _ in corpus.values() for c in cs],
+                           [t for _, ts in corpus.values() for t in ts])
+    unfiltered = dict(index.snapshot.top_k(["lao_động", "thuế"], k=100))
+    filtered = index.snapshot.top_k(["lao_động", "thuế"], k=100, doc_ids={"doc2", "doc5"})
+    assert filtered and all(cid.split("_")[0] in {"doc2", "doc5"} for cid, _ in filtered)
+    assert all(score == pytest.approx(unfiltered[cid]) for cid, score in filtered)
+
+
+def test_updates_log_is_applied_and_compacted(tmp_path):
+    base = {"a": ([{"chunk_id": "a_0", "doc_id": "a", "text": "x"}], [["x"]]),
+            "b": ([{"chunk_id": "b_0", "doc_id": "b", "text": "y"}], [["y"]])}
+    chunks = [c for cs, _ in base.values() for c in cs]
+    tokens = [t for _, ts in base.values() for t in ts]
+    log_path = tmp_path / corpus_updates.UPDATES_FILE
+    entries = [
+        {"op": "upsert", "doc_id": "a", "chunks": [{"chunk_id": "a_0", "doc_id": "a", "text": "z"}], "tokens": [["z"]]},
+        {"op": "delete", "doc_id": "b"},
+        {"op": "upsert", "doc_id": "c", "chunks": [{"chunk_id": "c_0", "doc_id": "c", "text": "w"}], "tokens": [["w"]]},
+    ]
+    log_path.write_text("".join(json.dumps(e) + "\n" for e in entries), encoding="utf-8")
+
+    new_chunks, new_tokens, count = corpus_updates.apply_updates(chunks, tokens, str(log_path))
+    assert count == 3
+    assert [c["chunk_id"] for c in new_chunks] == ["a_0", "c_0"] and new_tokens == [["z"], ["w"]]
+
+    assert not corpus_updates.needs_compaction(str(log_path), threshold=1 << 20)
+    assert corpus_updates.needs_compaction(str(log_path), threshold=0)
+    corpus_updates.compact(str(tmp_path), new_chunks, new_tokens, str(log_path))
+    assert not log_path.exists()
+    assert _load_base(tmp_path) == (new_chunks, new_tokens)
+    assert corpus_updates.apply_updates(new_chunks, new_tokens, str(log_path)) == (new_chunks, new_tokens, 0)
+
+    # Thế hệ tiếp theo thay thế (và dọn) thế hệ trước
+    first_generation = corpus_updates.base_paths(str(tmp_path))
+    log_path.write_text(json.dumps({"op": "delete", "doc_id": "c"}) + "\n", encoding="utf-8")
+    corpus_updates.compact(str(tmp_path), new_chunks[:1], new_tokens[:1], str(log_path))
+    assert _load_base(tmp_path) == (new_chunks[:1], new_tokens[:1])
+    assert not any(os.path.exists(path) for path in first_generation)
+
+
+def test_interrupted_compaction_keeps_base_and_log_consistent(tmp_path, monkeypatch):
+    log_path = tmp_path / corpus_updates.UPDATES_FILE
+    log_path.write_text(json.dumps({"op": "delete", "doc_id": "a"}) + "\n", encoding="utf-8")
+
+    def crash(*args):
+        raise OSError("crash")
+
+    # Dừng ngay trước khi đổi manifest: corpus gốc vẫn là output của ingestion và log còn nguyên
+    monkeypatch.setattr(corpus_updates.os, "replace", crash)
+    with pytest.raises(OSError):
+        corpus_updates.compact(str(tmp_path), [], [], str(log_path))
+    assert corpus_updates.base_paths(str(tmp_path)) == (
+        str(tmp_path / "legal_corpus_chunks.jsonl"), str(tmp_path / "legal_corpus_chunks_tokenized.json"))
+    assert log_path.exists()
+
+
+def _load_base(directory):
+    chunks_path, tokenized_path = corpus_updates.base_paths(str(directory))
+    with open(chunks_path, encoding="utf-8") as f:
+        chunks = [json.loads(line) for line in f]
+    with open(tokenized_path, encoding="utf-8") as f:
+        return chunks, json.load(f)
@@ -0,0 +1,43 @@
+# tests/test_singleflight.py
+import threading
+
+import pytest
+
+from core.cancellation import Cancelled
+from core.singleflight import SingleFlight
+
+
+def _start_leader(flight, release, result="kết quả"):
+    started = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return result
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(flight.do("k", slow)))
+    thread.start()
+    assert started.wait(5)
+    return thread, results
+
+
+def test_waiters_share_leader_result():
+    flight, release = SingleFlight("test", poll_interval=0.01), threading.Event()
+    leader, leader_results = _start_leader(flight, release)
+    waiter_results = []
+    waiter = threading.Thread(target=lambda: waiter_results.append(flight.do("k", lambda: "chạy lại")))
+    waiter.start()
+    release.set()
+    leader.join(5), waiter.join(5)
+    assert leader_results == waiter_results == ["kết quả"]
+
+
+def test_cancelled_waiter_raises_cancelled_without_stopping_leader():
+    flight, release = SingleFlight("test", poll_interval=0.01), threading.Event()
+    leader, leader_results = _start_leader(flight, release)
+    with pytest.raises(Cancelled):
+        flight.do("k", lambda: "chạy lại", should_cancel=lambda: True)
+    release.set()
+    leader.join(5)
+    assert leader_results == ["kết quả"] and flight.in_flight == 0
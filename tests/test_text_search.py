@@ -0,0 +1,47 @@
+# tests/test_text_search.py
+import unicodedata
+
+from core import text_search
+
+
+def test_strip_diacritics_keeps_length():
+    assert text_search.strip_diacritics("Điều lương") == "Dieu luong"
+    assert len(text_search.strip_diacritics("người lao động")) == len("người lao động")
+
+
+def test_fold_strips_vietnamese_diacritics_and_keeps_length():
+    text = "Điều 35 Luật Lao động"
+    assert text_search.fold(text) == "dieu 35 luat lao dong"
+    assert len(text_search.fold(text)) == len(text)
+
+
+def test_search_terms_are_folded_deduplicated_and_capped():
+    assert text_search.search_terms("Nợ LƯƠNG, nợ lương_thưởng?") == ["no", "luong", "thuong"]
+    assert text_search.search_terms(" ?! ") == []
+    assert len(text_search.search_terms(" ".join(f"w{i}" for i in range(20)))) == text_search.MAX_SEARCH_TERMS
+
+
+def test_queries_use_prefix_match_on_last_term():
+    assert text_search.fts5_query(["xu", "ly"]) == '"xu" "ly"*'
+    assert text_search.fts5_query(["luong"]) == ' "luong"*'
+    assert text_search.tsquery(["xu", "ly"]) == "xu & ly:*"
+
+
+def test_make_snippet_highlights_whole_words_and_prefix():
+    snippet = text_search.make_snippet("Công ty nợ lương của người lao động", ["no", "luo"])
+    assert snippet == "Công ty **nợ** **lương** của người lao động"
+    # "no" không phải tiền tố (chỉ từ cuối mới khớp tiền tố)
+    assert text_search.make_snippet("nội dung", ["no", "x"]) == "nội dung"
+
+
+def test_make_snippet_windows_long_text_around_first_match():
+    text = "mở đầu " * 50 + "quy định về thừa kế theo pháp luật" + " phần sau" * 50
+    snippet = text_search.make_snippet(text, ["thua", "ke"], width=60)
+    assert snippet.startswith("…") and snippet.endswith("…")
+    assert "**thừa** **kế**" in snippet
+    assert len(snippet) <= 60 + 2 + 8
+
+
+def test_make_snippet_accepts_decomposed_unicode():
+    decomposed = unicodedata.normalize("NFD", "luật lao động")
+    assert text_search.make_snippet(decomposed, ["luat"]) == "**luật** lao động"
@@ -0,0 +1,56 @@
+# tests/test_vector_client.py
+import time
+
+import pytest
+
+from retriever.vector_client import CircuitBreaker, ResilientVectorSearch, VectorSearchUnavailable
+
+
+class FlakyIndex:
+    def __init__(self):
+        self.healthy = False
+        self.calls = 0
+
+    def query(self, **kwargs):
+        self.calls += 1
+        if not self.healthy:
+            raise ConnectionError("pinecone down")
+        return {"matches": [{"id": "a"}]}
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    assert breaker.state == "closed" and not breaker.is_open()
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.is_open()
+    assert not breaker.allow_request()
+
+
+def test_breaker_half_open_allows_single_probe():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    assert not breaker.is_open()
+    assert breaker.allow_request() and breaker.state == "half_open"
+    assert not breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_client_recovers_after_reset_timeout():
+    index = FlakyIndex()
+    client = ResilientVectorSearch(index, timeout=0.5, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.05))
+    with pytest.raises(VectorSearchUnavailable):
+        client.query(vector=[0.0], top_k=1)
+    assert not client.available
+    with pytest.raises(VectorSearchUnavailable):
+        client.query(vector=[0.0], top_k=1)
+    assert index.calls == 1  # breaker mở: không gọi backend
+
+    index.healthy = True
+    time.sleep(0.06)
+    # Hết reset_timeout: retrieval phải thử lại vector search (trước đây bị kẹt ở BM25)
+    assert client.available
+    assert client.query(vector=[0.0], top_k=1)["matches"] == [{"id": "a"}]
+    assert client.breaker.state == "closed" and client.available
@@ -0,0 +1,72 @@
+# tools/rerank_bench.py
+"""
+Đo throughput của reranker (cặp/giây) khi chạy trong process API và qua InferencePool với số worker khác nhau,
+để kiểm tra throughput tăng gần tuyến tính theo số core.
+
+Ví dụ:
+    python -m tools.rerank_bench --workers 1,2,4,8 --pairs 20 --concurrency 8
+"""
+import time
+import argparse
+import threading
+
+from retriever.inference_pool import InferencePool
+
+DEFAULT_RERANKER = "models/finetuned-reranker-base"
+_QUERY = "Người lao động được nghỉ hằng năm bao nhiêu ngày?"
+_PASSAGE = ("Người lao động làm việc đủ 12 tháng cho một người sử dụng lao động thì được nghỉ hằng năm, "
+            "hưởng nguyên lương theo hợp đồng lao động như sau: 12 ngày làm việc đối với người làm công việc "
+            "trong điều kiện bình thường; 14 ngày làm việc đối với người lao động chưa thành niên.")
+
+
+def _run(rerank, pairs: int, concurrency: int, rounds: int) -> float:
+    """Mô phỏng `concurrency` request đồng thời, mỗi request rerank `pairs` cặp. Trả về số cặp/giây."""
+    batch = [(_QUERY, f"{_PASSAGE} ({i})") for i in range(pairs)]
+    rerank(batch)  # warm-up
+
+    def worker():
+        for _ in range(rounds):
+            rerank(batch)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return pairs * rounds * concurrency / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark throughput reranker: in-process vs InferencePool")
+    parser.add_argument("--reranker", default=DEFAULT_RERANKER)
+    parser.add_argument("--workers", default="1,2,4", help="Danh sách số worker, phân tách bằng dấu phẩy")
+    parser.add_argument("--threads-per-worker", type=int, default=0, help="0 = chia đều số core")
+    parser.add_argument("--pairs", type=int, default=20, help="Số cặp mỗi request (top_k_retrieval)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--skip-in-process", action="store_true")
+    args = parser.parse_args()
+
+    if not args.skip_in_process:
+        from sentence_transformers import CrossEncoder
+        model = CrossEncoder(args.reranker, device='cpu')
+        baseline = _run(lambda batch: model.predict(batch, show_progress_bar=False, batch_size=128),
+                        args.pairs, args.concurrency, args.rounds)
+        print(f"in-process: {baseline:.1f} cặp/s")
+        del model
+
+    first = None
+    for workers in [int(w) for w in args.workers.split(",")]:
+        pool = InferencePool(None, args.reranker, workers=workers, threads_per_worker=args.threads_per_worker)
+        try:
+            throughput = _run(pool.rerank, args.pairs, args.concurrency, args.rounds)
+        finally:
+            pool.close()
+        first = first or throughput / workers
+        print(f"pool workers={workers}: {throughput:.1f} cặp/s "
+              f"(hiệu suất so với tuyến tính: {throughput / (first * workers):.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+# tools/sse_loadtest.py
+"""
+Load test nhiều luồng SSE `/generate_answer` đồng thời, replay chuỗi câu hỏi thật.
+
+    # 1. Xuất chuỗi câu hỏi từ bảng messages (theo CHAT_STORE_BACKEND hiện tại)
+    python -m tools.sse_loadtest export --output data/loadtest_sessions.jsonl
+
+    # 2. Tự chạy api.main:app với LLM/vector store giả lập rồi tăng dần số phiên đồng thời
+    python -m tools.sse_loadtest run --spawn --sessions data/loadtest_sessions.jsonl \\
+        --concurrency 1,4,8,16,32 --ttft-slo-ms 1500 --output report.json
+
+    # 3. Lưu baseline, các lần sau so sánh và trả exit code 1 nếu bị regression
+    python -m tools.sse_loadtest run --spawn --concurrency 8 --save-baseline loadtest_baseline.json
+    python -m tools.sse_loadtest run --spawn --concurrency 8 --baseline loadtest_baseline.json
+
+    # 4. So sánh goodput / p99 khi bật và tắt admission control
+    python -m tools.sse_loadtest run --spawn --admission both --concurrency 8,32,64 --ttft-slo-ms 1500
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+
+from core.storage import create_chat_store, get_chat_store
+
+# Dùng khi chưa có lịch sử thật để replay
+SAMPLE_SESSIONS = [
+    ["Công ty nợ lương 2 tháng thì phải làm sao?", "Tôi có được đơn phương chấm dứt hợp đồng không?"],
+    ["Người lao động được nghỉ phép bao nhiêu ngày một năm?", "Nếu làm chưa đủ 12 tháng thì sao?"],
+    ["Mức phạt khi vượt đèn đỏ đối với xe máy là bao nhiêu?"],
+    ["Thủ tục đăng ký kết hôn gồm những giấy tờ gì?", "Có cần xác nhận tình trạng hôn nhân không?"],
+    ["Tuổi nghỉ hưu của lao động nữ hiện nay là bao nhiêu?"],
+]
+
+# Request bị server từ chối do quá tải (admission control), không tính là lỗi của hệ thống
+SHED_ERRORS = ("http_429", "http_503", "shed_in_queue")
+# Chỉ số (càng thấp càng tốt) dùng để so sánh với baseline
+GATED_METRICS = ["ttft_ms.p95", "inter_token_ms.p95", "total_ms.p95"]
+
+
+def _percentiles(values) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    values = sorted(values)
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))], 2)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99)}
+
+
+class TurnResult:
+    __slots__ = ("ttft_ms", "inter_token_ms", "total_ms", "error", "status", "retry_after")
+
+    def __init__(self):
+        self.ttft_ms = None
+        self.inter_token_ms = []
+        self.total_ms = None
+        self.error = None
+        self.status = None
+        self.retry_after = None
+
+
+async def _run_turn(client, url, payload, timeout) -> tuple[TurnResult, str, str | None]:
+    """Gửi một lượt hỏi, đo TTFT / khoảng cách giữa các token / tổng thời gian. Trả về (kết quả, câu trả lời, conversation_id mới)."""
+    result = TurnResult()
+    answer, conversation_id = "", None
+    started = time.perf_counter()
+    last_token = None
+    try:
+        async with client.stream("POST", f"{url}/generate_answer", json=payload, timeout=timeout) as response:
+            result.status = response.status_code
+            if response.status_code != 200:
+                result.error = f"http_{response.status_code}"
+                retry_after = response.headers.get("Retry-After")
+                result.retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+                result.total_ms = (time.perf_counter() - started) * 1000
+                return result, answer, conversation_id
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[6:])
+                if "error" in event:
+                    # Request đã được nhận nhưng bị bỏ khi chờ stage inference quá lâu
+                    result.error = "shed_in_queue"
+                    result.retry_after = event.get("retry_after")
+                    break
+                if "new_conversation" in event:
+                    conversation_id = event["new_conversation"]["id"]
+                if "text" in event and event["text"]:
+                    now = time.perf_counter()
+                    if last_token is None:
+                        result.ttft_ms = (now - started) * 1000
+                    else:
+                        result.inter_token_ms.append((now - last_token) * 1000)
+                    last_token = now
+                    answer += event["text"]
+        if result.ttft_ms is None and result.error is None:
+            result.error = "no_tokens"
+    except (httpx.HTTPError, asyncio.TimeoutError) as e:
+        result.error = type(e).__name__
+    result.total_ms = (time.perf_counter() - started) * 1000
+    return result, answer, conversation_id
+
+
+async def _virtual_user(client, url, username, sessions, deadline, think_time, timeout, results):
+    """Một phiên chat: lần lượt hỏi các câu trong một session, gửi request giống frontend."""
+    rng = random.Random(username)
+    while time.monotonic() < deadline:
+        history, conversation_id = [], None
+        for question in rng.choice(sessions):
+            if time.monotonic() >= deadline:
+                return
+            history.append({"role": "user", "content": question})
+            payload = {"username": username, "conversation_id": conversation_id, "top_k_rerank": 5}
+            if conversation_id:
+                payload["message"] = question
+            else:
+                payload["chat_history"] = history
+            result, answer, new_conversation_id = await _run_turn(client, url, payload, timeout)
+            results.append(result)
+            conversation_id = new_conversation_id or conversation_id
+            if result.retry_after:
+                # Client lịch sự: bị từ chối do quá tải thì chờ theo Retry-After trước khi hỏi tiếp
+                await asyncio.sleep(max(0.0, min(result.retry_after, deadline - time.monotonic())))
+            history.append({"role": "assistant", "content": answer})
+            if think_time:
+                await asyncio.sleep(rng.uniform(0, think_time))
+
+
+async def run_step(url, sessions, concurrency, duration, think_time, timeout, ttft_slo_ms=None) -> dict:
+    """
+    Chạy `concurrency` phiên đồng thời trong `duration` giây và tổng hợp chỉ số.
+    Goodput: số request thành công mỗi giây có TTFT trong SLO (mọi request thành công nếu không đặt SLO).
+    """
+    limits = httpx.Limits(max_connections=concurrency + 4, max_keepalive_connections=concurrency + 4)
+    async with httpx.AsyncClient(limits=limits) as client:
+        usernames = [f"loadtest_{uuid.uuid4().hex[:8]}_{i}" for i in range(concurrency)]
+        await asyncio.gather(*[
+            client.post(f"{url}/register", json={"username": name, "hashed_password": "loadtest"}) for name in usernames
+        ])
+        results = []
+        started = time.monotonic()
+        deadline = started + duration
+        await asyncio.gather(*[
+            _virtual_user(client, url, name, sessions, deadline, think_time, timeout, results) for name in usernames
+        ])
+        elapsed = time.monotonic() - started
+
+    errors = [r for r in results if r.error]
+    error_kinds = {}
+    for r in errors:
+        error_kinds[r.error] = error_kinds.get(r.error, 0) + 1
+    ok = [r for r in results if not r.error]
+    good = [r for r in ok if ttft_slo_ms is None or r.ttft_ms <= ttft_slo_ms]
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": len(errors),
+        "error_rate": round(len(errors) / len(results), 4) if results else 0.0,
+        "error_kinds": error_kinds,
+        "shed": sum(count for kind, count in error_kinds.items() if kind in SHED_ERRORS),
+        "throughput_rps": round(len(results) / elapsed, 2),
+        "goodput_rps": round(len(good) / elapsed, 2),
+        "ttft_ms": _percentiles([r.ttft_ms for r in ok]),
+        "inter_token_ms": _percentiles([gap for r in ok for gap in r.inter_token_ms]),
+        "total_ms": _percentiles([r.total_ms for r in ok]),
+    }
+
+
+def _metric(step, dotted):
+    value = step
+    for part in dotted.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float, error_rate_tolerance: float) -> list[str]:
+    """So sánh từng mức concurrency có trong baseline; trả về danh sách regression."""
+    regressions = []
+    current = {step["concurrency"]: step for step in report["steps"]}
+    for base_step in baseline["steps"]:
+        step = current.get(base_step["concurrency"])
+        if step is None:
+            continue
+        for name in GATED_METRICS:
+            base_value, value = _metric(base_step, name), _metric(step, name)
+            if base_value and value is not None and value > base_value * (1 + tolerance):
+                regressions.append(f"c={step['concurrency']} {name}: {value} > {base_value} (+{tolerance:.0%})")
+        if step["error_rate"] > base_step["error_rate"] + error_rate_tolerance:
+            regressions.append(f"c={step['concurrency']} error_rate: {step['error_rate']} > {base_step['error_rate']}")
+    return regressions
+
+
+def _spawn_server(port, args, tmp_dir, admission=True):
+    """Chạy `uvicorn api.main:app` với Gemini và vector store giả lập, DB SQLite tạm."""
+    db_path = os.path.join(tmp_dir, "loadtest_chat_history.db")
+    create_chat_store("sqlite", db_path=db_path).init_schema()
+    env = dict(
+        os.environ,
+        LLM_BACKEND="fake",
+        VECTOR_BACKEND="fake",
+        CHAT_STORE_BACKEND="sqlite",
+        CHAT_DB_PATH=db_path,
+        ADMISSION_ENABLED="1" if admission else "0",
+        FAKE_LLM_LATENCY_MS=str(args.fake_llm_latency_ms),
+        FAKE_LLM_TOKEN_MS=str(args.fake_llm_token_ms),
+        FAKE_LLM_429_RATE=str(args.fake_llm_429_rate),
+        FAKE_VECTOR_LATENCY_MS=str(args.fake_vector_latency_ms),
+        FAKE_VECTOR_SLOW_RATE=str(args.fake_vector_slow_rate),
+        FAKE_VECTOR_ERROR_RATE=str(args.fake_vector_error_rate),
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", "1", "--log-level", "warning"],
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("API không khởi động được (xem log phía trên)")
+        try:
+            if httpx.get(f"{url}/metrics", timeout=1).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(1)
+    process.terminate()
+    raise RuntimeError("Quá thời gian chờ API khởi động")
+
+
+def load_sessions(path) -> list[list[str]]:
+    if not path:
+        return SAMPLE_SESSIONS
+    with open(path, "r", encoding="utf-8") as f:
+        sessions = [json.loads(line) for line in f if line.strip()]
+    return [session for session in sessions if session] or SAMPLE_SESSIONS
+
+
+def cmd_export(args):
+    sessions = get_chat_store().get_question_sequences(limit=args.limit)
+    with open(args.output, "w", encoding="utf-8") as f:
+        for session in sessions:
+            f.write(json.dumps(session, ensure_ascii=False) + "\n")
+    print(f"Đã xuất {len(sessions)} phiên ({sum(map(len, sessions))} câu hỏi) ra {args.output}")
+
+
+def _run_levels(args, sessions, levels, admission=True):
+    process = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            if args.spawn:
+                process, url = _spawn_server(args.port, args, tmp_dir, admission)
+            else:
+                url = args.url.rstrip("/")
+            steps = []
+            for level in levels:
+                step = asyncio.run(run_step(url, sessions, level, args.duration, args.think_time,
+                                            args.request_timeout, args.ttft_slo_ms))
+                steps.append(step)
+                print(f"c={level:>4} req={step['requests']:>5} err={step['error_rate']:.2%} shed={step['shed']} "
+                      f"goodput={step['goodput_rps']}/s "
+                      f"ttft p50/p95/p99={step['ttft_ms']['p50']}/{step['ttft_ms']['p95']}/{step['ttft_ms']['p99']}ms "
+                      f"itl p95={step['inter_token_ms']['p95']}ms total p95={step['total_ms']['p95']}ms")
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+    return url, steps
+
+
+def cmd_run(args):
+    sessions = load_sessions(args.sessions)
+    levels = [int(level) for level in args.concurrency.split(",")]
+    if args.admission == "both" and not args.spawn:
+        raise SystemExit("--admission both cần --spawn (server phải được khởi động lại với cấu hình khác)")
+    print(f"admission control: {'on' if args.admission != 'off' else 'off'}")
+    url, steps = _run_levels(args, sessions, levels, admission=args.admission != "off")
+
+    report = {"url": url, "sessions": len(sessions), "duration_s": args.duration, "steps": steps}
+    if args.admission == "both":
+        print("admission control: off")
+        _, report["without_admission"] = _run_levels(args, sessions, levels, admission=False)
+        print("So sánh (bật / tắt admission control):")
+        for on, off in zip(steps, report["without_admission"]):
+            print(f"c={on['concurrency']:>4} goodput={on['goodput_rps']}/{off['goodput_rps']} req/s "
+                  f"ttft p99={on['ttft_ms']['p99']}/{off['ttft_ms']['p99']}ms "
+                  f"total p99={on['total_ms']['p99']}/{off['total_ms']['p99']}ms")
+    if args.ttft_slo_ms:
+        # Mức concurrency cao nhất mà TTFT p95 vẫn trong SLO và không có lỗi đáng kể
+        within = [s["concurrency"] for s in steps
+                  if s["ttft_ms"]["p95"] is not None and s["ttft_ms"]["p95"] <= args.ttft_slo_ms
+                  and s["error_rate"] <= args.error_rate_tolerance]
+        report["max_concurrency_within_slo"] = max(within) if within else 0
+        print(f"Số phiên đồng thời tối đa trong SLO TTFT p95 <= {args.ttft_slo_ms}ms: {report['max_concurrency_within_slo']}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Đã lưu baseline vào {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(report, baseline, args.tolerance, args.error_rate_tolerance)
+        if regressions:
+            print("REGRESSION so với baseline:")
+            for line in regressions:
+                print(f"  - {line}")
+            raise SystemExit(1)
+        print("Không có regression so với baseline.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test SSE /generate_answer")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export = subparsers.add_parser("export", help="Xuất chuỗi câu hỏi từ bảng messages")
+    export.add_argument("--output", default="data/loadtest_sessions.jsonl")
+    export.add_argument("--limit", type=int, default=1000, help="Số cuộc trò chuyện gần nhất")
+    export.set_defaults(func=cmd_export)
+
+    run = subparsers.add_parser("run", help="Chạy load test")
+    run.add_argument("--url", default="http://127.0.0.1:8000")
+    run.add_argument("--spawn", action="store_true", help="Tự chạy api.main:app với LLM/vector store giả lập")
+    run.add_argument("--port", type=int, default=8765)
+    run.add_argument("--startup-timeout", type=float, default=300)
+    run.add_argument("--sessions", help="File JSONL từ lệnh export (mặc định: bộ câu hỏi mẫu)")
+    run.add_argument("--concurrency", default="1,4,8,16", help="Các mức số phiên đồng thời, cách nhau bởi dấu phẩy")
+    run.add_argument("--duration", type=float, default=30, help="Số giây chạy cho mỗi mức")
+    run.add_argument("--think-time", type=float, default=0.0, help="Thời gian nghỉ tối đa giữa hai lượt hỏi (giây)")
+    run.add_argument("--request-timeout", type=float, default=60)
+    run.add_argument("--ttft-slo-ms", type=float)
+    run.add_argument("--output")
+    run.add_argument("--admission", choices=["on", "off", "both"], default="on",
+                     help="Bật/tắt admission control của server khi dùng --spawn; both = chạy cả hai để so sánh")
+    run.add_argument("--baseline")
+    run.add_argument("--save-baseline")
+    run.add_argument("--tolerance", type=float, default=0.2, help="Cho phép p95 chậm hơn baseline tối đa bao nhiêu (tỉ lệ)")
+    run.add_argument("--error-rate-tolerance", type=float, default=0.01)
+    # Cấu hình các bản giả lập khi dùng --spawn
+    run.add_argument("--fake-llm-latency-ms", type=float, default=300)
+    run.add_argument("--fake-llm-token-ms", type=float, default=20)
+    run.add_argument("--fake-llm-429-rate", type=float, default=0.0)
+    run.add_argument("--fake-vector-latency-ms", type=float, default=20)
+    run.add_argument("--fake-vector-slow-rate", type=float, default=0.0)
+    run.add_argument("--fake-vector-error-rate", type=float, default=0.0)
+    run.set_defaults(func=cmd_run)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()